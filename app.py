@@ -11,15 +11,15 @@ import os
 import pathlib
 import re
 import secrets
+import shutil
+import time
 import traceback
 import unicodedata as ud
-import urllib
+import urllib.parse
 import uuid
-import xml.etree.ElementTree as ET
-import zipfile
 from collections import Counter, defaultdict
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import lru_cache, wraps
 from glob import glob
 from inspect import getcallargs
 from io import BytesIO, StringIO
@@ -28,9 +28,7 @@ from shapely.ops import unary_union
 
 import distinctipy
 import flask_monitoringdashboard as dashboard
-import geojson
 import git
-import gpxpy
 
 # Third-Party Imports
 import polyline
@@ -41,6 +39,7 @@ from flag import flag
 from flask import (
     Flask,
     Markup,
+    Response,
     abort,
     flash,
     jsonify,
@@ -52,8 +51,9 @@ from flask import (
     send_file,
     send_from_directory,
     session,
+    stream_with_context,
     url_for,
-    g
+    g,
 )
 from flask_caching import Cache
 from flask_compress import Compress
@@ -61,9 +61,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flaskext.autoversion import Autoversion
 from geopy.geocoders import Nominatim
 from PIL import Image
-from requests.adapters import HTTPAdapter, Retry
 from scgraph.geographs.marnet import marnet_geograph
-from sqlalchemy import and_, case, func, or_
+from sqlalchemy import and_, case, event, func, or_
+from sqlalchemy.orm import Session, object_session
 from sqlalchemy_utils import database_exists
 from timezonefinder import TimezoneFinder
 from werkzeug.exceptions import HTTPException
@@ -144,6 +144,7 @@ from py.motis import (
     handle_search_form,
     handle_search_params,
 )
+from py.string_similarity import stringSimmilarity
 from py.svg import generate_sprite
 from py.track import CustomMatomo
 from py.transit_routing import (
@@ -151,11 +152,13 @@ from py.transit_routing import (
     convert_here_response_to_trips,
 )
 from py.gps_cleaner import clean_gps_route
+from py.gps_preprocessing import simplify_track
+from py.gpx_reader import read_gpx_files
 from py.update_currency import run_currency_update
 from py.utils import (
     get_all_countries,
     get_flag_emoji,
-    getCountriesFromPath,
+    getCountryCodesFromCoordinates,
     getCountryFromCoordinates,
     getDistance,
     getDistanceFromPath,
@@ -168,7 +171,6 @@ from py.utils import (
     load_config,
     remove_diacritics,
     rgb_to_hex,
-    stringSimmilarity,
     unicodedata,
     validate_png_file,
     time_ago
@@ -178,7 +180,36 @@ from src.api.feature_requests import feature_requests_blueprint
 from src.api.news import news_blueprint
 from src.api.finance import finance_blueprint
 from src.consts import DbNames, TripTypes
+from src.country_split import get_countries_from_path
+from src.path_export import (
+    PATH_FORMATS,
+    get_path_trips,
+    get_trips_with_path,
+    iter_path_download,
+    path_filename,
+)
+from src.export import (
+    COLUMNAR_FORMATS,
+    GEOMETRY_ENCODINGS,
+    iter_export_csv,
+    write_export_columnar,
+    write_export_csv,
+)
+from src.jobs import (
+    JobError,
+    JobQueueFull,
+    JobStatus,
+    enqueue_job,
+    get_job,
+    get_user_jobs,
+    is_job_file,
+    job_handler,
+    job_owner,
+    last_done_job,
+    new_job_dir,
+)
 from src.pg import setup_db
+from src.routing import get_route, get_route_hedged
 from src.suspicious_activity import (
     check_denied_login,
     log_denied_login,
@@ -195,14 +226,15 @@ from src.utils import (
     owner,
     owner_required,
     pathConn,
-    readLang,
     sendOwnerEmail,
     sendEmail,    
-    getLocalDatetime
+    getLocalDatetime,
+    localDatetimeIn
 )
 from src.trips import (
     Trip,
     create_trip,
+    create_trips,
     duplicate_trip,
     update_trip,
     _update_trip_in_sqlite,
@@ -212,6 +244,13 @@ from src.trips import (
     delete_ticket_from_db
 )
 from src.paths import Path
+from src.trip_import import TripImportError, parse_trips_csv
+from src.airports import get_airports, preload_airports
+from src.fr24_import import AirlineLookup, parse_fr24_flight, read_fr24_csv
+from src.trip_paths import get_paths
+from src.user_cache import USER_FIELDS, get_user_record, invalidate_user
+from src.trip_facts import get_trip_types, invalidate_trip_facts
+from src.worker_stats import WorkerStats
 
 from py.co2_emissions import TravelEmissions
 
@@ -231,6 +270,12 @@ app.config["CACHE_TYPE"] = "SimpleCache"
 app.config["CACHE_DEFAULT_TIMEOUT"] = 864000
 cache = Cache(app)
 
+preload_airports(mainConn)
+
+# Lossy: GPX tracks are stored without their outliers, stops and redundant
+# points (see py/gps_preprocessing.py), they are simplified for routing anyway
+GPX_SIMPLIFY_ON_IMPORT = load_config().get("gpx", {}).get("simplify_on_import", False)
+
 matomo_config = load_config().get("matomo")
 
 if matomo_config:
@@ -245,7 +290,12 @@ if matomo_config:
             id_site=id_site,
             token_auth=token_auth,
             ignored_routes=["/static/<path:filename>"],
+            queue_size=matomo_config.get("queue_size", 10000),
+            batch_size=matomo_config.get("batch_size", 100),
+            flush_interval=matomo_config.get("flush_interval", 2.0),
+            max_retries=matomo_config.get("max_retries", 5),
         )
+        WorkerStats("matomo", gauges=matomo.get_stats)
 
 
 def getLoggedUserCurrency():
@@ -253,7 +303,7 @@ def getLoggedUserCurrency():
     if user == "public":
         return "EUR"
     else:
-        return User.query.filter_by(username=user).first().user_currency
+        return get_user_record(user).user_currency
 
 
 def generate_distinct_color(existing_hex_colors):
@@ -301,22 +351,14 @@ def public_required(f):
     def decorated_function(*args, **kwargs):
         inspection = getcallargs(f, *args, **kwargs)
         username = inspection["username"]
-        user = User.query.filter_by(username=username).first()
-
-        friends = (
-            authDb.session.query(User.uid, User.username)
-            .join(Friendship, User.uid == Friendship.friend_id)
-            .filter(Friendship.user_id == user.uid, Friendship.accepted != None)  # noqa: E711
-            .all()
-        )
-        friendsList = [username for (uid, username) in friends]
+        user = get_user_record(username)
         if user is None:
             abort(404)
         elif (
             not user.is_public()
             and not session.get(owner)
             and username != getUser()
-            and getUser() not in friendsList
+            and getUser() not in getFriendsList(user.uid)
         ):
             abort(401)
         else:
@@ -325,6 +367,16 @@ def public_required(f):
     return decorated_function
 
 
+def getFriendsList(user_id):
+    friends = (
+        authDb.session.query(User.uid, User.username)
+        .join(Friendship, User.uid == Friendship.friend_id)
+        .filter(Friendship.user_id == user_id, Friendship.accepted != None)  # noqa: E711
+        .all()
+    )
+    return [username for (uid, username) in friends]
+
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -349,7 +401,7 @@ def login_required(f):
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user = User.query.filter_by(username=session.get("logged_in")).first()
+        user = get_user_record(session.get("logged_in"))
         if not ((user and user.admin) or session.get(owner)):
             abort(401)
         return f(*args, **kwargs)
@@ -360,7 +412,7 @@ def admin_required(f):
 def translator_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user = User.query.filter_by(username=session.get("logged_in")).first()
+        user = get_user_record(session.get("logged_in"))
         if not ((user and user.translator) or session.get(owner)):
             abort(401)
         return f(*args, **kwargs)
@@ -371,7 +423,7 @@ def translator_required(f):
 def check_and_increment_fr24_usage(username, limit=5):
     month_key = datetime.utcnow().strftime("%Y-%m")
 
-    is_premium = bool(User.query.filter_by(username=username).first().premium)
+    is_premium = bool(get_user_record(username).premium)
 
     with managed_cursor(mainConn) as cursor:
         cursor.execute(
@@ -415,7 +467,7 @@ def check_and_increment_fr24_usage(username, limit=5):
 
 
 def fr24_usage(username):
-    if User.query.filter_by(username=username).first().premium:
+    if get_user_record(username).premium:
         return "premium"
 
     month_key = datetime.utcnow().strftime("%Y-%m")
@@ -502,88 +554,127 @@ class Friendship(authDb.Model):
     )
 
 
-def fetch_and_filter_flights(flight_filter_key, flight_filter_value, target_date):
-    from_iso = f"{target_date - timedelta(days=1)}T12:00:00"
-    to_iso = f"{target_date + timedelta(days=1)}T14:00:00"
+# cached user records are forgotten once a write to the user is committed
+def _invalidate_after_commit(target, *usernames):
+    object_session(target).info.setdefault("written_users", set()).update(usernames)
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_delete")
+def user_created_or_deleted(mapper, connection, target):
+    _invalidate_after_commit(target, target.username)
+
+
+@event.listens_for(User, "after_update")
+def user_updated(mapper, connection, target):
+    state = sqlalchemy.inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in USER_FIELDS):
+        _invalidate_after_commit(
+            target, target.username, *state.attrs.username.history.deleted
+        )
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_written_users(session):
+    written_users = session.info.pop("written_users", None)
+    if written_users:
+        invalidate_user(*written_users)
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_written_users(session):
+    session.info.pop("written_users", None)
+
+
+def fetch_fr24_flights(flight_filter_key, flight_filter_value, from_iso, to_iso):
+    """
+    Flights of the FR24 flight summary matching the filter, cached for a few
+    minutes so that repeated searches of the same flight don't hit the API.
+    """
+    cache_key = f"fr24_{flight_filter_key}_{flight_filter_value}_{from_iso}_{to_iso}"
+    flights = cache.get(cache_key)
+    if flights is not None:
+        return flights
+
     config = load_config()
     headers = {
         "Accept": "application/json",
         "Accept-Version": "v1",
         "Authorization": f"Bearer {config['FR24']['token_auth']}",
     }
+    response = requests.get(
+        "https://fr24api.flightradar24.com/api/flight-summary/light",
+        headers=headers,
+        params={
+            flight_filter_key: flight_filter_value,
+            "flight_datetime_from": from_iso,
+            "flight_datetime_to": to_iso,
+        },
+        timeout=25,
+    )
+    response.raise_for_status()
+    flights = response.json().get("data", [])
+    cache.set(cache_key, flights, timeout=config["FR24"].get("cache_ttl", 600))
+    return flights
+
+
+def fetch_and_filter_flights(flight_filter_key, flight_filter_value, target_date):
+    from_iso = f"{target_date - timedelta(days=1)}T12:00:00"
+    to_iso = f"{target_date + timedelta(days=1)}T14:00:00"
     try:
-        response = requests.get(
-            "https://fr24api.flightradar24.com/api/flight-summary/light",
-            headers=headers,
-            params={
-                flight_filter_key: flight_filter_value,
-                "flight_datetime_from": from_iso,
-                "flight_datetime_to": to_iso,
-            },
-            timeout=25,
+        flights = fetch_fr24_flights(
+            flight_filter_key, flight_filter_value, from_iso, to_iso
         )
-        response.raise_for_status()
     except requests.RequestException as e:
         return {"error": "Failed to fetch data from FR24 API", "details": str(e)}, 502
-    flights = response.json().get("data", [])
+    airports = get_airports(mainConn)
     filtered = []
-    with managed_cursor(mainConn) as cursor:
-        for f in flights:
-            orig_icao = f.get("orig_icao")
-            dest_icao = f.get("dest_icao")
-            takeoff_str = f.get("datetime_takeoff")
-            first_seen_str = f.get("first_seen")
-            landing_str = f.get("datetime_landed")
-            last_seen_str = f.get("last_seen")
-            
-            if orig_icao and (takeoff_str or first_seen_str):
-                cursor.execute(
-                    "SELECT latitude, longitude FROM airports WHERE ident = :icao",
-                    {"icao": orig_icao},
-                )
-                orig_coords = cursor.fetchone()
-                if orig_coords:
-                    try:
-                        # Use takeoff time if available, otherwise fall back to first_seen
-                        departure_str = takeoff_str if takeoff_str else first_seen_str
-                        utc_departure = datetime.fromisoformat(
-                            departure_str.replace("Z", "+00:00")
-                        )
-                        local_departure = getLocalDatetime(
-                            orig_coords[0], orig_coords[1], utc_departure
-                        )
-                        if local_departure.date() == target_date:
-                            # Set the appropriate field based on what we used
-                            if takeoff_str:
-                                f["datetime_takeoff_local"] = local_departure.isoformat()
-                            else:
-                                f["datetime_takeoff_local"] = local_departure.isoformat()
-                                f["_used_first_seen_for_takeoff"] = True  # Optional flag for debugging
-                            
-                            if dest_icao and (landing_str or last_seen_str):
-                                cursor.execute(
-                                    "SELECT latitude, longitude FROM airports WHERE ident = :icao",
-                                    {"icao": dest_icao},
+    for f in flights:
+        orig_icao = f.get("orig_icao")
+        dest_icao = f.get("dest_icao")
+        takeoff_str = f.get("datetime_takeoff")
+        first_seen_str = f.get("first_seen")
+        landing_str = f.get("datetime_landed")
+        last_seen_str = f.get("last_seen")
+
+        if orig_icao and (takeoff_str or first_seen_str):
+            orig_airport = airports.icao.get(orig_icao)
+            if orig_airport:
+                try:
+                    # Use takeoff time if available, otherwise fall back to first_seen
+                    departure_str = takeoff_str if takeoff_str else first_seen_str
+                    utc_departure = datetime.fromisoformat(
+                        departure_str.replace("Z", "+00:00")
+                    )
+                    local_departure = localDatetimeIn(
+                        orig_airport.timezone, utc_departure
+                    )
+                    if local_departure.date() == target_date:
+                        # Set the appropriate field based on what we used
+                        if takeoff_str:
+                            f["datetime_takeoff_local"] = local_departure.isoformat()
+                        else:
+                            f["datetime_takeoff_local"] = local_departure.isoformat()
+                            f["_used_first_seen_for_takeoff"] = True  # Optional flag for debugging
+
+                        if dest_icao and (landing_str or last_seen_str):
+                            dest_airport = airports.icao.get(dest_icao)
+                            if dest_airport:
+                                # Use landing time if available, otherwise fall back to last_seen
+                                arrival_str = landing_str if landing_str else last_seen_str
+                                utc_landing = datetime.fromisoformat(
+                                    arrival_str.replace("Z", "+00:00")
+                                )
+                                local_landing = localDatetimeIn(
+                                    dest_airport.timezone, utc_landing
                                 )
-                                dest_coords = cursor.fetchone()
-                                if dest_coords:
-                                    # Use landing time if available, otherwise fall back to last_seen
-                                    arrival_str = landing_str if landing_str else last_seen_str
-                                    utc_landing = datetime.fromisoformat(
-                                        arrival_str.replace("Z", "+00:00")
-                                    )
-                                    local_landing = getLocalDatetime(
-                                        dest_coords[0], dest_coords[1], utc_landing
-                                    )
-                                    f["datetime_landed_local"] = (
-                                        local_landing.isoformat()
-                                    )
-                                    # Optional flag for debugging
-                                    if not landing_str:
-                                        f["_used_last_seen_for_landing"] = True
-                            filtered.append(f)
-                    except Exception:
-                        pass
+                                f["datetime_landed_local"] = local_landing.isoformat()
+                                # Optional flag for debugging
+                                if not landing_str:
+                                    f["_used_last_seen_for_landing"] = True
+                        filtered.append(f)
+                except Exception:
+                    pass
     return {"data": filtered}, 200
 
 
@@ -681,30 +772,29 @@ def getLangDropdown(user):
     langs.append(
         {"code": user.lang, "name": lang[session["userinfo"]["lang"]][user.lang]}
     )
-    for code in readLang().keys():
+    for code in lang:
         if code != user.lang:
             langs.append({"code": code, "name": lang[code][code]})
     return langs
 
 
-def changeLang(langToSet, session=False):
-    available_languages = []
-    languages = readLang()
-    for language in languages:
-        available_languages.append(
-            {"id": language, "name": languages[language][language]}
-        )
+# seconds after which the user info of the session is read again
+USERINFO_TTL = 60
+
 
+def changeLang(langToSet, session=False):
     session["userinfo"] = {}
     session["userinfo"]["logged_in_user"] = getUser()
     session["userinfo"]["is_owner"] = True if getUser() == owner else False
-    user = User.query.filter_by(username=session.get("logged_in")).first()
+    user = get_user_record(session.get("logged_in"))
     session["userinfo"]["is_alpha"] = True if user and user.alpha else False
     session["userinfo"]["is_premium"] = True if user and user.premium else False
     session["userinfo"]["is_admin"] = True if user and user.admin else False
     session["userinfo"]["is_translator"] = True if user and user.translator else False
-    session["userinfo"]["available_languages"] = available_languages
+    session["userinfo"]["available_languages"] = lang.available_languages
     session["userinfo"]["lang"] = langToSet
+    session["userinfo_version"] = lang.version
+    session["userinfo_refreshed"] = time.time()
 
 
 def get_country_codes_from_files():
@@ -876,7 +966,7 @@ def saveTripToDb(username, newTrip, newPath, trip_type="train"):
         )
         countries = json.dumps(countries)
     else:
-        countries = getCountriesFromPath(newPath, newTrip["type"])
+        countries = get_countries_from_path(newPath, newTrip["type"])
 
     if "originManualToggle" in newTrip.keys():
         saveManualStation(
@@ -895,7 +985,7 @@ def saveTripToDb(username, newTrip, newPath, trip_type="train"):
             station_type=trip_type,
         )
 
-    user_id = User.query.filter_by(username=username).first().uid
+    user_id = get_user_id(username)
 
     trip = Trip(
         username=username,
@@ -1036,8 +1126,7 @@ def formatTrip(trip, public=False):
 
 
 def user_exists(username):
-    user = User.query.filter_by(username=username).first()
-    return user is not None
+    return get_user_record(username) is not None
 
 
 def getDistinctStatYears(username, tripType):
@@ -1083,7 +1172,6 @@ def airlineLogoProcess(newTrip):
 
 
 def resolveSnippets(langName):
-    lang = readLang()[langName]
     resolvedSnippets = {}
     for snippet_path in glob("snippets/*.html"):
         with open(snippet_path, "r", encoding="utf-8") as snippet:
@@ -1171,12 +1259,6 @@ def before_request():
     # Default language
     language = "en"
 
-    # List of supported languages based on language files
-    lang_files = os.listdir("lang")  # List all files in the 'lang' directory
-    supported_languages = [
-        file.split(".")[0] for file in lang_files if file.endswith(".json")
-    ]
-
     # Check if language is set in session
     if "userinfo" in session:
         language = session["userinfo"]["lang"]
@@ -1188,16 +1270,26 @@ def before_request():
         # Get the list of accepted languages from the request
         accepted_languages = [lang[0] for lang in request.accept_languages]
 
-        for lang in accepted_languages:
-            if lang in supported_languages:
-                language = lang
+        for accepted_language in accepted_languages:
+            if accepted_language in lang:
+                language = accepted_language
                 break
-            short_lang = lang.split("-")[0]
-            if short_lang in supported_languages:
+            short_lang = accepted_language.split("-")[0]
+            if short_lang in lang:
                 language = short_lang
                 break
 
-    changeLang(language, session)
+    # the user info is kept in the session, and only built again when the
+    # user, their language or the language files change, or once it is old
+    userinfo = session.get("userinfo")
+    if (
+        userinfo is None
+        or userinfo.get("logged_in_user") != getUser()
+        or userinfo.get("lang") != language
+        or session.get("userinfo_version") != lang.version
+        or time.time() - session.get("userinfo_refreshed", 0) > USERINFO_TTL
+    ):
+        changeLang(language, session)
 
 
 @app.context_processor
@@ -1232,19 +1324,10 @@ def inject_distinct_types():
         "car": "fa-solid fa-car-side",
     }
 
-    # 5) Query, but fail soft if DB is locked (or anything else goes wrong)
+    # 5) Cached types of the user's trips (see src/trip_facts.py), but fail
+    # soft if DB is locked (or anything else goes wrong)
     try:
-        with managed_cursor(mainConn) as cursor:
-            cursor.execute(
-                """
-                SELECT DISTINCT type
-                FROM trip
-                WHERE username = ?
-                  AND type NOT IN ('poi', 'accommodation', 'restaurant')
-                """,
-                (username,),
-            )
-            rows = cursor.fetchall()
+        trip_types = get_trip_types(username)
     except Exception as err:
         logger.exception("Context processor failed: inject_distinct_types")
         g.distinct_types_ctx = {}  # cache the empty fallback to avoid retries
@@ -1253,11 +1336,11 @@ def inject_distinct_types():
     # 6) Build the dict with localized labels
     lang_dict = lang.get(lang_code, {})
     types = {
-        r[0]: {
-            "label": lang_dict.get(r[0], r[0]),
-            "icon": icon_map.get(r[0], "fa-solid fa-question"),
+        trip_type: {
+            "label": lang_dict.get(trip_type, trip_type),
+            "icon": icon_map.get(trip_type, "fa-solid fa-question"),
         }
-        for r in rows
+        for trip_type in trip_types
     }
 
     g.distinct_types_ctx = types
@@ -1560,8 +1643,11 @@ def new_ticket(username):
     )
 
 
-def getAddressFromCoords(lat, lng):
-    geolocator = Nominatim(user_agent="Trainlog")
+geolocator = Nominatim(user_agent="Trainlog")
+
+
+@lru_cache(maxsize=4096)
+def _reverseGeocode(lat, lng):
     details = geolocator.reverse(
         (lat, lng),
         timeout=10,
@@ -1581,6 +1667,20 @@ def getAddressFromCoords(lat, lng):
     return f"{flag} {city}" + (f" - {suburb}" if suburb else "")
 
 
+def getAddressFromCoords(lat, lng):
+    # 4 decimals is ~10 m, trips starting from the same place share the lookup
+    return _reverseGeocode(round(lat, 4), round(lng, 4))
+
+
+def getAddressesFromCoords(coords):
+    """
+    Addresses of a batch of (lat, lng), each distinct place being looked up only
+    once (and only if it isn't cached yet). Return a dict keyed by the given
+    coordinates.
+    """
+    return {(lat, lng): getAddressFromCoords(lat, lng) for lat, lng in set(coords)}
+
+
 @app.route("/<username>/handle_gpx_upload/<source>", methods=["POST"])
 @login_required
 def handle_gpx_upload(username, source):
@@ -1591,132 +1691,113 @@ def handle_gpx_upload(username, source):
         return jsonify({"error": "No files uploaded"}), 400
 
     for file in files:
-        if file.filename.endswith(".gpx"):
-            gpx = gpxpy.parse(file.stream)
-
-            points = None
-            start_time = None
-            end_time = None
-            distance = 0
-
-            # Handle Tracks
-            if gpx.tracks and any(track.segments for track in gpx.tracks):
-                all_points = []
-                total_distance = 0
-                first_time = None
-                last_time = None
-
-                # 1. Gather all points from all segments
-                for track in gpx.tracks:
-                    for segment in track.segments:
-                        if segment.points:
-                            if first_time is None:
-                                first_time = segment.points[
-                                    0
-                                ].time  # Only set start once
-                            last_time = segment.points[
-                                -1
-                            ].time  # Continuously update end
-                            all_points.extend(segment.points)
-
-                # 2. Compute total distance across *all* points (including "gaps" between segments)
-                for i in range(1, len(all_points)):
-                    total_distance += getDistance(
-                        {
-                            "lat": all_points[i - 1].latitude,
-                            "lng": all_points[i - 1].longitude,
-                        },
-                        {"lat": all_points[i].latitude, "lng": all_points[i].longitude},
-                    )
-
-                # Assign them back to your existing variables so you don't change the rest of your code.
-                points = all_points
-                start_time = first_time
-                end_time = last_time
-                distance = total_distance
-
-            # Handle Routes
-            elif gpx.routes and gpx.routes[0].points:
-                points = gpx.routes[0].points
-                # Routes typically don't include timestamps; set start/end times to None
-                start_time = None
-                end_time = None
-                # Approximate route distance by summing distances between consecutive points
-                for i in range(len(points) - 1):
-                    distance += gpxpy.geo.distance(
-                        points[i].latitude,
-                        points[i].longitude,
-                        0,
-                        points[i + 1].latitude,
-                        points[i + 1].longitude,
-                        0,
-                    )
-
-            if points:
-                # Generate path in [[lat, lng], [lat, lng]] format
-                path = json.dumps(
-                    [[point.latitude, point.longitude] for point in points]
-                )
-
-                # Extract start and end points
-                start_point = points[0]
-                end_point = points[-1]
-
-                # Geocode start and end points
-                origin = getAddressFromCoords(
-                    lat=start_point.latitude, lng=start_point.longitude
-                )
-                destination = getAddressFromCoords(
-                    lat=end_point.latitude, lng=end_point.longitude
-                )
+        if not file.filename.endswith(".gpx"):
+            return jsonify({"error": f"{file.filename} is not a valid GPX file"}), 400
 
-                # Calculate duration (only for tracks with timestamps)
-                duration = 0
-                if start_time and end_time:
-                    duration = int(
-                        (end_time - start_time).total_seconds()
-                    )  # Duration in seconds
+    # Saved for the job worker, which reads the files in parallel
+    directory = new_job_dir()
+    for index, file in enumerate(files):
+        file.save(os.path.join(directory, f"{index}.gpx"))
 
-                    # Convert to local time
-                    start_time = getLocalDatetime(
-                        start_point.latitude, start_point.longitude, start_time
-                    )
-                    end_time = getLocalDatetime(
-                        end_point.latitude, end_point.longitude, end_time
-                    )
-
-                    # Format to "YYYY-MM-DD HH:MM"
-                    start_time = start_time.strftime("%Y-%m-%d %H:%M")
-                    end_time = end_time.strftime("%Y-%m-%d %H:%M")
+    job_id = enqueue_job(
+        username,
+        "gpx_import",
+        {
+            "username": username,
+            "source": source,
+            "notes": notes,
+            "directory": directory,
+            "filenames": [file.filename for file in files],
+        },
+    )
+    return job_started_response(job_id)
 
-                with managed_cursor(mainConn) as cursor:
-                    cursor.execute(
-                        """
-                        INSERT INTO gpx (source, username, origin, destination, start_time, end_time, duration, distance, path, notes)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        """,
-                        (
-                            source,
-                            username,
-                            origin,
-                            destination,
-                            start_time,
-                            end_time,
-                            duration,
-                            int(distance),
-                            path,
-                            notes,
-                        ),
-                    )
 
-            else:
-                return jsonify({"error": f"No points found in {file.filename}"}), 400
+@job_handler("gpx_import")
+def importGPXFiles(username, source, notes, directory, filenames, progress=None):
+    # The full path is stored unless lossy simplification is enabled, the
+    # distance is always computed on the raw points
+    summaries = read_gpx_files(
+        [os.path.join(directory, f"{index}.gpx") for index in range(len(filenames))],
+        simplify=GPX_SIMPLIFY_ON_IMPORT,
+    )
+    for filename, summary in zip(filenames, summaries):
+        if summary is None:
+            raise JobError(f"No points found in {filename}")
+    if progress:
+        progress(50)
+
+    addresses = getAddressesFromCoords(
+        tuple(point)
+        for summary in summaries
+        for point in (summary["start"], summary["end"])
+    )
+    if progress:
+        progress(90)
+
+    rows = []
+    simplified_points = []
+    for filename, summary in zip(filenames, summaries):
+        if GPX_SIMPLIFY_ON_IMPORT:
+            logger.info(f"Simplified {filename}: {summary['simplification']}")
+            simplified_points.append({"file": filename, **summary["simplification"]})
+
+        # Path in [[lat, lng], [lat, lng]] format
+        path = json.dumps(summary["points"])
+        start_point = summary["start"]
+        end_point = summary["end"]
+        origin = addresses[tuple(start_point)]
+        destination = addresses[tuple(end_point)]
+
+        # Calculate duration (only for tracks with timestamps)
+        start_time = summary["start_time"]
+        end_time = summary["end_time"]
+        duration = 0
+        if start_time and end_time:
+            duration = int(
+                (end_time - start_time).total_seconds()
+            )  # Duration in seconds
+
+            # Convert to local time
+            start_time = getLocalDatetime(start_point[0], start_point[1], start_time)
+            end_time = getLocalDatetime(end_point[0], end_point[1], end_time)
+
+            # Format to "YYYY-MM-DD HH:MM"
+            start_time = start_time.strftime("%Y-%m-%d %H:%M")
+            end_time = end_time.strftime("%Y-%m-%d %H:%M")
         else:
-            return jsonify({"error": f"{file.filename} is not a valid GPX file"}), 400
+            start_time = None
+            end_time = None
 
+        rows.append(
+            (
+                source,
+                username,
+                origin,
+                destination,
+                start_time,
+                end_time,
+                duration,
+                int(summary["distance"]),
+                path,
+                notes,
+            )
+        )
+
+    # Nothing is written before all the files are processed, so that a failed
+    # import can be retried
+    with managed_cursor(mainConn) as cursor:
+        cursor.executemany(
+            """
+            INSERT INTO gpx (source, username, origin, destination, start_time, end_time, duration, distance, path, notes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
     mainConn.commit()
+    shutil.rmtree(directory, ignore_errors=True)
 
-    return jsonify({"message": "Files processed successfully"}), 200
+    return {"message": "Files processed successfully", "simplification": simplified_points}
 
 
 @app.route("/<username>/upload_gpx")
@@ -1927,6 +2008,152 @@ def cluster_waypoints(waypoints, min_distance_meters=10):
     return simplified
 
 
+def forwardRoutingInContext(path, routingType, args=None):
+    """
+    forwardRouting callable from threads that don't have the app context
+    """
+    with app.app_context():
+        return forwardRouting(path, routingType, args)
+
+
+def simplify_waypoints(raw_waypoints):
+    """
+    Waypoints of a stored GPX path without its outliers, stops and redundant
+    points, for routing and display (the full path is what is stored)
+    """
+    kept, simplify_stats = simplify_track(
+        [[point["lat"], point["lng"]] for point in raw_waypoints]
+    )
+    logger.info(f"Simplified waypoints: {simplify_stats}")
+    return [raw_waypoints[i] for i in kept]
+
+
+def run_smart_routing(waypoints, trip_type, progress=None):
+    return clean_gps_route(
+        raw_waypoints=waypoints,
+        forwardRouting=forwardRoutingInContext,
+        trip_type=trip_type,
+        deviation_threshold=800,       # Kept: Now defines the "validation corridor" width
+        max_search_points=75,
+        progress_callback=progress,
+    )
+
+
+def get_requester_job(job_id):
+    """The job if it was started by the current user or visitor, 404 otherwise"""
+    job = get_job(job_id)
+    if job is None or (
+        job["username"] != job_owner(create=False) and not session.get(owner)
+    ):
+        abort(404)
+    return job
+
+
+def job_error(job):
+    """
+    Failure of a job shown to the user: the message of its JobError, a generic
+    one otherwise
+    """
+    return job["error"] or lang[session["userinfo"]["lang"]]["jobFailedBody"]
+
+
+def job_summary(job):
+    """Job as sent to the browser, with the URL of its file if it produced one"""
+    summary = {
+        key: job[key]
+        for key in ("uid", "type", "status", "progress", "error", "attempts", "created")
+    }
+    if job["status"] == JobStatus.FAILED:
+        summary["error"] = job_error(job)
+    if isinstance(job["result"], dict) and "file" in job["result"]:
+        summary["download_url"] = url_for("job_download", job_id=job["uid"])
+    else:
+        summary["result"] = job["result"]
+    return summary
+
+
+def job_started_response(job_id):
+    return jsonify({
+        "job_id": job_id,
+        "status_url": url_for("job_status", job_id=job_id),
+    }), 202
+
+
+def render_job_wait(job, running_key="jobRunning"):
+    """
+    Page of a job that isn't done, refreshed until it is, or of its failure
+    """
+    translations = lang[session["userinfo"]["lang"]]
+    failed = job["status"] == JobStatus.FAILED
+    progress = job["progress"] or 0
+    if failed:
+        title, message = translations["jobFailedTitle"], job_error(job)
+    elif job["status"] == JobStatus.QUEUED:
+        title, message = translations["jobWaitTitle"], translations["jobQueued"]
+    else:
+        title = translations["jobWaitTitle"]
+        message = translations[running_key].format(progress=round(progress))
+    nav = (
+        "bootstrap/no_user_nav.html"
+        if getUser() == "public"
+        else "bootstrap/navigation.html"
+    )
+    return render_template(
+        "job_wait.html",
+        nav=nav,
+        username=getUser(),
+        title=title,
+        message=message,
+        failed=failed,
+        progress=progress,
+        **translations,
+        **session["userinfo"],
+    ), 500 if failed else 200
+
+
+@app.route("/jobs")
+def list_jobs():
+    requester = job_owner(create=False)
+    jobs = get_user_jobs(requester) if requester else []
+    return jsonify([job_summary(job) for job in jobs])
+
+
+@app.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    return jsonify(job_summary(get_requester_job(job_id)))
+
+
+@app.route("/jobs/<int:job_id>/wait")
+def job_wait(job_id):
+    """
+    Progress page of a job, for links that used to return a file directly.
+    Redirects to the job's file (or shows its result) once it is done.
+    """
+    job = get_requester_job(job_id)
+    if job["status"] != JobStatus.DONE:
+        return render_job_wait(job)
+    summary = job_summary(job)
+    if "download_url" in summary:
+        return redirect(summary["download_url"])
+    return jsonify(summary["result"])
+
+
+@app.route("/jobs/<int:job_id>/download")
+def job_download(job_id):
+    job = get_requester_job(job_id)
+    result = job["result"]
+    if not isinstance(result, dict) or "file" not in result:
+        abort(404)
+    if not is_job_file(result["file"]) or not os.path.exists(result["file"]):
+        abort(410)
+    return send_file(
+        os.path.abspath(result["file"]),
+        as_attachment=result.get("as_attachment", True),
+        download_name=result.get("download_name"),
+        mimetype=result.get("mimetype"),
+    )
+
+
 @app.route("/<username>/save_trip_from_gpx/<gpx_id>", methods=["POST"])
 @login_required
 def saveTripFromGPX(username, gpx_id):
@@ -1946,6 +2173,42 @@ def saveTripFromGPX(username, gpx_id):
             {"error": "GPX file not found or does not belong to the user."}
         ), 404
 
+    # Process the route based on user preferences
+    if use_routing and trip_type in [
+        "train", "metro", "tram", "ferry", "aerialway", "bus", "car", "walk", "cycle"
+    ]:
+        # Smart routing takes a while, run it in the background
+        job_id = enqueue_job(
+            username,
+            "save_trip_from_gpx",
+            {"username": username, "gpx_id": gpx["uid"], "trip_type": trip_type},
+        )
+        return job_started_response(job_id)
+
+    return jsonify(saveGPXAsTrip(username, gpx, trip_type)), 200
+
+
+def getUserGPX(username, gpx_id):
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            "SELECT * FROM gpx WHERE uid = ? AND username = ?", (gpx_id, username)
+        )
+        gpx = cursor.fetchone()
+    if not gpx:
+        raise JobError("GPX file not found or does not belong to the user.")
+    return gpx
+
+
+# Not retried: the GPX is deleted before the trip is saved
+@job_handler("save_trip_from_gpx", max_attempts=1)
+def saveGPXAsTripJob(username, gpx_id, trip_type, progress=None):
+    gpx = getUserGPX(username, gpx_id)
+    return saveGPXAsTrip(username, gpx, trip_type, use_routing=True, progress=progress)
+
+
+def saveGPXAsTrip(username, gpx, trip_type, use_routing=False, progress=None):
+    gpx_id = gpx["uid"]
+
     # Extract GPX details
     origin = gpx["origin"]
     destination = gpx["destination"]
@@ -1965,6 +2228,8 @@ def saveTripFromGPX(username, gpx_id):
     raw_waypoints = [
         {"lat": point[0], "lng": point[1]} for point in json.loads(gpx["path"])
     ]
+    # what the routing and the clustering work on
+    simplified_waypoints = simplify_waypoints(raw_waypoints)
 
     # Create a new trip structure
     newTrip = {
@@ -1987,20 +2252,11 @@ def saveTripFromGPX(username, gpx_id):
         "waypoints": json.dumps([]),  # Will be updated below
     }
 
-    # Process the route based on user preferences
-    if use_routing and trip_type in [
-        "train", "metro", "tram", "ferry", "aerialway", "bus", "car", "walk", "cycle"
-    ]:
+    if use_routing:
         # Use advanced GPS cleaning instead of basic routing
         print(f"Processing GPS route with {len(raw_waypoints)} points using smart routing...")
         
-        cleaning_result = clean_gps_route(
-            raw_waypoints=raw_waypoints,
-            forwardRouting=forwardRouting,
-            trip_type=trip_type,
-            deviation_threshold=800,       # Kept: Now defines the "validation corridor" width
-            max_search_points=75
-        )
+        cleaning_result = run_smart_routing(simplified_waypoints, trip_type, progress)
         
         if cleaning_result["success"]:
             # Use cleaned route
@@ -2025,14 +2281,14 @@ def saveTripFromGPX(username, gpx_id):
         else:
             # Fallback to basic clustering if smart routing fails
             print(f"Smart routing failed: {cleaning_result.get('error')}. Using basic clustering.")
-            waypoints = cluster_waypoints(raw_waypoints, 20)
+            waypoints = cluster_waypoints(simplified_waypoints, 20)
             path = raw_waypoints
             newTrip["waypoints"] = json.dumps(waypoints)
             
     else:
         # No routing - use original GPX path with basic clustering
         path = raw_waypoints
-        waypoints = cluster_waypoints(raw_waypoints, 20)
+        waypoints = cluster_waypoints(simplified_waypoints, 20)
         newTrip["waypoints"] = json.dumps(waypoints)
 
     # Delete the GPX file after saving as a trip
@@ -2048,12 +2304,28 @@ def saveTripFromGPX(username, gpx_id):
         username=username, newTrip=newTrip, newPath=path, trip_type=trip_type
     )
 
-    return jsonify({
+    return {
         "success": True,
         "message": f"Trip saved with {'smart routing' if use_routing else 'original path'}",
         "points_processed": len(raw_waypoints),
         "final_points": len(path)
-    }), 200
+    }
+
+
+@job_handler("preview_smart_routing")
+def previewSmartRoutingJob(username, gpx_id, trip_type, progress=None):
+    gpx = getUserGPX(username, gpx_id)
+    # Convert to waypoints format
+    raw_waypoints = [
+        {"lat": point[0], "lng": point[1]} for point in json.loads(gpx["path"])
+    ]
+    waypoints = simplify_waypoints(raw_waypoints)
+    cleaning_result = run_smart_routing(waypoints, trip_type, progress)
+    # Only the shape of the original track is shown next to the cleaned route
+    return {
+        "raw_waypoints": waypoints,
+        "cleaning_result": cleaning_result,
+    }
 
 
 @app.route("/<username>/preview_smart_routing/<gpx_id>/<trip_type>", methods=["POST", "GET"])
@@ -2061,8 +2333,11 @@ def saveTripFromGPX(username, gpx_id):
 def previewSmartRouting(username, gpx_id, trip_type):
     """
     Preview smart routing results without saving the trip
-    GET: Shows interactive map with original vs cleaned route
-    POST: Returns JSON data for API usage
+    The routing runs as a background job:
+    GET: Starts the job, then shows a progress page until it is done, and finally
+         the interactive map with original vs cleaned route (?job_id=...)
+    POST: Starts the job and returns its id, the JSON preview is available
+          through the job's status URL once it is done
     """
    
     # Retrieve GPX data
@@ -2077,42 +2352,34 @@ def previewSmartRouting(username, gpx_id, trip_type):
             return render_template('error.html', error="GPX file not found"), 404
         return jsonify({"error": "GPX file not found"}), 404
 
-    # Convert to waypoints format
-    raw_waypoints = [
-        {"lat": point[0], "lng": point[1]} for point in json.loads(gpx["path"])
-    ]
-   
-    # Clean the GPS route with smart routing
-    cleaning_result = clean_gps_route(
-        raw_waypoints=raw_waypoints,
-        forwardRouting=forwardRouting,
-        trip_type=trip_type,
-        deviation_threshold=800,       # Kept: Now defines the "validation corridor" width
-        max_search_points=75
-    )
-   
-    if request.method == "POST":
-        # Return JSON for API usage
-        if cleaning_result["success"]:
-            return jsonify({
-                "success": True,
-                "original_points": len(raw_waypoints),
-                "cleaned_points": len(cleaning_result["path"]),
-                "waypoints_count": len(cleaning_result["waypoints"]),
-                "compression_ratio": cleaning_result["compression_ratio"],
-                "reroute_count": cleaning_result["reroute_count"],
-                "distance": cleaning_result["distance"],
-                "duration": cleaning_result["duration"],
-                "preview_path": cleaning_result["path"][:100]  # First 100 points for preview
-            })
-        else:
-            return jsonify({
-                "success": False,
-                "error": cleaning_result["error"],
-                "fallback_points": len(raw_waypoints)
-            })
-    
-    # GET request: Show interactive map
+    job_id = request.args.get("job_id", type=int)
+    job = get_job(job_id, username) if job_id is not None else None
+
+    if job is None:
+        job_id = enqueue_job(
+            username,
+            "preview_smart_routing",
+            {"username": username, "gpx_id": gpx["uid"], "trip_type": trip_type},
+        )
+        if request.method == "POST":
+            return job_started_response(job_id)
+        return redirect(
+            url_for(
+                "previewSmartRouting",
+                username=username,
+                gpx_id=gpx_id,
+                trip_type=trip_type,
+                job_id=job_id,
+            )
+        )
+
+    if job["status"] != JobStatus.DONE:
+        return render_job_wait(job, running_key="smartRoutingRunning")
+
+    raw_waypoints = job["result"]["raw_waypoints"]
+    cleaning_result = job["result"]["cleaning_result"]
+
+    # Show interactive map
     return render_template('preview_route.html',
                          gpx=gpx,
                          trip_type=trip_type,
@@ -2748,7 +3015,7 @@ def landing():
 
     # If the user is logged in and not forcing the landing page
     if username and not force_landing:
-        user = User.query.filter_by(username=username).first()
+        user = get_user_record(username)
         if user:
             # Redirect to the user's default landing page
             if user.default_landing == "trips":
@@ -2948,7 +3215,7 @@ def new_map(username):
     New General map (WebGl)
 
     """
-    user = User.query.filter_by(username=username).first()
+    user = get_user_record(username)
     return render_template(
         "new_map.html",
         title=lang[session["userinfo"]["lang"]]["map"],
@@ -3006,6 +3273,49 @@ def countries(username, cc):
 @app.route("/<username>/countryGeoJSON/<cc>")
 @public_required
 def getCountryGeoJSON(username, cc):
+    payload = {"username": username, "cc": cc}
+    # the file of the last job is still right if the user's trips didn't change
+    done = last_done_job("country_percent", payload)
+    if (
+        done is not None
+        and done["result"].get("trips") == trips_version(username)
+        and is_job_file(done["result"]["file"])
+        and os.path.exists(done["result"]["file"])
+    ):
+        return send_file(
+            os.path.abspath(done["result"]["file"]), mimetype="application/json"
+        )
+    # anonymous visitors of public profiles each get their own jobs
+    try:
+        job_id = enqueue_job(job_owner(), "country_percent", payload)
+    except JobQueueFull as e:
+        logger.warning(str(e))
+        return jsonify(
+            {"error": lang[session["userinfo"]["lang"]]["jobQueueFull"]}
+        ), 429, {"Retry-After": "60"}
+    return job_started_response(job_id)
+
+
+def trips_version(username):
+    """
+    Number of trips of the user and date of the last one modified, which change
+    with any of their trip writes
+    """
+    with managed_cursor(mainConn) as cursor:
+        count, last_modified = cursor.execute(
+            "SELECT COUNT(*), MAX(last_modified) FROM trip WHERE username = ?",
+            (username,),
+        ).fetchone()
+    return [count, last_modified]
+
+
+@job_handler("country_percent")
+def computeCountryPercent(username, cc, progress=None):
+    """
+    Mark the parts of the country crossed by the user's trips and store the
+    travelled percentage. Produces the [percent, geojson] JSON file.
+    """
+
     def midpoint(point1, point2):
         return ((point1[0] + point2[0]) / 2, (point1[1] + point2[1]) / 2)
 
@@ -3013,6 +3323,8 @@ def getCountryGeoJSON(username, cc):
         return geopip_country.search(cc=cc, lat=lat, lng=lng)
 
     start_time = datetime.now()
+    # before reading the trips, so that a trip written meanwhile isn't missed
+    trips = trips_version(username)
     # Prepare the parameters
     if "-" in cc:
         params = {"username": username, "country": "%" + cc.split("-")[0] + "%"}
@@ -3080,7 +3392,16 @@ def getCountryGeoJSON(username, cc):
     end_time = datetime.now()  # End the timer
     render_time = end_time - start_time  # Calculate the difference
     print(render_time)
-    return jsonify([percent, geojson_data])
+
+    output_path = os.path.join(new_job_dir(), f"{cc}.json")
+    with open(output_path, "w") as file:
+        json.dump([percent, geojson_data], file)
+    return {
+        "file": output_path,
+        "mimetype": "application/json",
+        "as_attachment": False,
+        "trips": trips,
+    }
 
 
 @app.route("/admin/editCountries/<cc>")
@@ -3148,12 +3469,21 @@ def convertCurrency(baseCurrency, targetCurrency, date, price):
 @app.route("/processQueue/<cc>", methods=["POST"])
 @admin_required
 def process_queue(cc):
+    operations = request.json
+
+    if not operations or len(operations) == 0:
+        return jsonify({"success": False, "message": "No operations to process"})
+
+    job_id = enqueue_job(
+        getUser(), "process_country_queue", {"cc": cc, "operations": operations}
+    )
+    return job_started_response(job_id)
+
+
+# Not retried: the operations are applied to the file in place
+@job_handler("process_country_queue", max_attempts=1)
+def processCountryQueue(cc, operations, progress=None):
     try:
-        operations = request.json
-        
-        if not operations or len(operations) == 0:
-            return jsonify({"success": False, "message": "No operations to process"})
-        
         directory_path = "country_percent/countries/processed/"
         file_path = os.path.join(directory_path, f"{cc}.geojson")
         
@@ -3188,10 +3518,7 @@ def process_queue(cc):
                 
             elif operation_type == "merge":
                 if len(polygon_ids) != 2:
-                    return jsonify({
-                        "success": False, 
-                        "message": f"Merge operation requires exactly 2 polygons, got {len(polygon_ids)}"
-                    })
+                    raise JobError(f"Merge operation requires exactly 2 polygons, got {len(polygon_ids)}")
                 
                 # Find the polygons to merge
                 polygons_to_merge = []
@@ -3204,10 +3531,7 @@ def process_queue(cc):
                         remaining_features.append(feature)
                 
                 if len(polygons_to_merge) != 2:
-                    return jsonify({
-                        "success": False, 
-                        "message": f"Could not find both polygons to merge (found {len(polygons_to_merge)})"
-                    })
+                    raise JobError(f"Could not find both polygons to merge (found {len(polygons_to_merge)})")
                 
                 print(f"  Merging polygons {polygon_ids}")
                 
@@ -3254,10 +3578,7 @@ def process_queue(cc):
                     return False
                 
                 if not polygons_are_contiguous(polygons_to_merge[0], polygons_to_merge[1]):
-                    return jsonify({
-                        "success": False, 
-                        "message": "Selected polygons are not contiguous and cannot be merged"
-                    })
+                    raise JobError("Selected polygons are not contiguous and cannot be merged")
                 
                 # Perform geometric union using Shapely
                 shapely_polygons = []
@@ -3300,17 +3621,17 @@ def process_queue(cc):
             json.dump(geojson_data, file)
         
         print(f"Successfully processed {len(operations)} operations")
-        return jsonify({
+        return {
             "success": True, 
             "message": f"Successfully processed {len(operations)} operation{'s' if len(operations) > 1 else ''}"
-        })
+        }
     
+    except JobError:
+        raise
     except Exception as e:
+        # failures are raised so that the job is marked as failed
         print(f"Error processing queue: {str(e)}")
-        return jsonify({
-            "success": False, 
-            "message": f"Error processing operations: {str(e)}"
-        })
+        raise JobError(f"Error processing operations: {str(e)}") from e
 
 
 @app.route("/about")
@@ -3377,6 +3698,7 @@ def edit_translations(langid):
             # Save the updated translations back to the JSON file
             with open(file_path, "w", encoding="utf-8") as file:
                 json.dump(translations, file, ensure_ascii=False, indent=4)
+            lang.reload()
 
             # Update session with saved keys
             session["saved_keys"] = saved_keys
@@ -3408,11 +3730,11 @@ def edit_translations(langid):
 
         with open(file_path, "w", encoding="utf-8") as file:
             json.dump(updated_translations, file, ensure_ascii=False, indent=4)
+        lang.reload()
 
         session["saved_keys"] = saved_keys
         flash(f"Translations for {langid} updated successfully!", "success")
         return redirect(url_for("edit_translations", langid=langid))
-    lang = readLang()
 
     # Render the template with saved keys
     response = render_template(
@@ -3455,7 +3777,7 @@ def public_new(username):
     """
     Public home
     """
-    user = User.query.filter_by(username=getUser()).first()
+    user = get_user_record(getUser())
     if user is not None:
         tileserver = (user.tileserver,)
         globe = (user.globe,)
@@ -3634,7 +3956,7 @@ def render_public_trip_page(
                     countries.append(country)
             length += trip["trip_length"]
             trip_list.append(dict(trip))
-            user = User.query.filter_by(username=trip["username"]).first()
+            user = get_user_record(trip["username"])
             if (
                 not session.get(user.username)
                 and not user.is_public_trips()
@@ -3672,7 +3994,7 @@ def render_public_trip_page(
             f"From {trip_list_sorted[0]['origin_station']} to {trip_list_sorted[-1]['destination_station']}"
         )
 
-    user = User.query.filter_by(username=getUser()).first()
+    user = get_user_record(getUser())
     if user is None:
         tileserver = "default"
         globe = False
@@ -3722,7 +4044,7 @@ def multi_trip(tripIds):
             trip = cursor.execute(getTrip, {"trip_id": trip}).fetchone()
         if trip is not None:
             trip_list.append(dict(trip))
-            user = User.query.filter_by(username=trip["username"]).first()
+            user = get_user_record(trip["username"])
             if (
                 not session.get(user.username)
                 and not user.is_public_trips()
@@ -3740,166 +4062,63 @@ def multi_trip(tripIds):
     )
 
 
-def convert_path_to_format(path, output_format):
-    """
-    Convert the path data to the specified format (GPX or GeoJSON).
-    """
-    # Load path data from JSON
-    coordinates = json.loads(path)
-
-    if output_format == "gpx":
-        # Create the GPX root element
-        gpx = ET.Element("gpx", version="1.1", creator="Trainlog.me")
-
-        # Create a GPX 'trk' (track) element
-        trk = ET.SubElement(gpx, "trk")
-        trk_name = ET.SubElement(trk, "name")
-        trk_name.text = "Trip Path"
-
-        # Create a 'trkseg' (track segment) and add 'trkpt' (track points) elements
-        trkseg = ET.SubElement(trk, "trkseg")
-
-        # Assuming 'coordinates' contains a list of lat, lon pairs
-        # TODO check if this code is needed, it looks like it does nothing as the
-        # variable is not read anywhere
-        for point in coordinates:
-            _trkpt = ET.SubElement(
-                trkseg, "trkpt", lat=str(point[0]), lon=str(point[1])
-            )
-
-        # Convert the ElementTree to a string in GPX format
-        output = ET.tostring(gpx, encoding="utf-8", method="xml").decode("utf-8")
-
-    elif output_format == "geojson":
-        # Convert to GeoJSON LineString format
-        # GeoJSON requires coordinates in [lon, lat] format
-        geojson_line = geojson.LineString(
-            [(point[1], point[0]) for point in coordinates]
-        )
-
-        # Create the FeatureCollection containing the LineString
-        feature = geojson.Feature(geometry=geojson_line)
-        feature_collection = geojson.FeatureCollection([feature])
-
-        # Convert FeatureCollection to GeoJSON string
-        output = geojson.dumps(feature_collection)
-
-    else:
-        raise ValueError("Unsupported format")
-
-    return output
-
-
-def sanitize_filename(filename):
-    """
-    Sanitize the filename by keeping only alphanumerical characters and
-    accentuated letters. Replace any other characters with underscores.
-    """
-    # Normalize Unicode to decompose characters
-    normalized = unicodedata.normalize("NFKC", filename)
-    # Replace invalid characters with an underscore
-    sanitized = re.sub(r"[^\w\s\-\.À-ÿ]", "", normalized, flags=re.UNICODE)
-    # Optionally replace spaces with underscores
-    return sanitized.strip()
-
-
 @app.route("/gpx/<trip_ids>", endpoint="download_gpx")
 @app.route("/geojson/<trip_ids>", endpoint="download_geojson")
 def download_path(trip_ids):
     """
     Download one or more paths in the specified format (GPX or GeoJSON) for
-    the given trip_ids (comma-separated).
+    the given trip_ids (comma-separated), zipped when there are several.
+    The file is streamed while it is generated.
     """
 
     # Determine requested format based on the path
     if request.path.startswith("/gpx"):
         format_type = "gpx"
-        file_extension = "gpx"
-        mimetype = "application/gpx+xml"
     elif request.path.startswith("/geojson"):
         format_type = "geojson"
-        file_extension = "geojson"
-        mimetype = "application/geo+json"
     else:
         abort(400, description="Unsupported format")
 
     # Split the incoming <trip_ids> on commas
-    trip_id_list = trip_ids.split(",")
-
-    # Prepare a list to store (trip_id, generated_file_data) tuples
-    files_to_zip = []
+    try:
+        trip_id_list = [int(trip_id) for trip_id in trip_ids.split(",")]
+    except ValueError:
+        abort(400, description="Invalid trip ids")
 
+    # 1) Check that the trips exist + permission logic, once per owner
+    trips = get_path_trips(mainConn, trip_id_list)
     for trip_id in trip_id_list:
-        trip_id = trip_id.strip()  # Just to be safe
-
-        # 1) Check if the trip exists + permission logic
-        with managed_cursor(mainConn) as cursor:
-            trip = cursor.execute(getTrip, {"trip_id": trip_id}).fetchone()
-            if trip is not None:
-                user = User.query.filter_by(username=trip["username"]).first()
-                # Verify that either user session is valid or the user has public trips
-                if (
-                    not session.get(user.username)
-                    and not user.is_public_trips()
-                    and not session.get(owner)
-                ):
-                    abort(401, description=f"Unauthorized for trip_id={trip_id}")
-            else:
-                abort(410, description=f"Trip with id={trip_id} is gone")
-
-        # 2) Retrieve the path from the database
-        with managed_cursor(pathConn) as cursor:
-            cursor.execute("SELECT path FROM paths WHERE trip_id = ?", (trip_id,))
-            path = cursor.fetchone()
-
-        if path is None:
-            abort(404, description=f"Path not found for trip_id={trip_id}")
-
-        # 3) Convert the path to the requested format
-        output_data = convert_path_to_format(path["path"], format_type)
-
-        # 4) Store (trip_id, file contents) for later use
-        files_to_zip.append(
-            (trip_id, trip["origin_station"], trip["destination_station"], output_data)
-        )
-
-    if len(files_to_zip) == 1:
-        # files_to_zip[0] is assumed to be a tuple like:
-        # (trip_id, origin, destination, file_contents)
-        single_id, single_origin, single_destination, single_data = files_to_zip[0]
-
-        output_io = BytesIO()
-        output_io.write(single_data.encode("utf-8"))
-        output_io.seek(0)
-
-        return send_file(
-            output_io,
-            as_attachment=True,
-            download_name=sanitize_filename(
-                f"{single_origin} -{single_destination}-{single_id}.{file_extension}"
-            ),
-            mimetype=mimetype,
-        )
-
-    # Otherwise, zip up all files.
-    from datetime import datetime
+        if trip_id not in trips:
+            abort(410, description=f"Trip with id={trip_id} is gone")
+    for username in {trip["username"] for trip in trips.values()}:
+        user = get_user_record(username)
+        # Verify that either user session is valid or the user has public trips
+        if (
+            not session.get(user.username)
+            and not user.is_public_trips()
+            and not session.get(owner)
+        ):
+            abort(401, description=f"Unauthorized for trips of {username}")
 
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-        for trip_id, origin, destination, data in files_to_zip:
-            filename = sanitize_filename(
-                f"{origin} -{destination}-{trip_id}.{file_extension}"
-            )
-            zf.writestr(filename, data)
+    # 2) Check that the paths exist
+    for trip_id in trips.keys() - get_trips_with_path(pathConn, trip_id_list):
+        abort(404, description=f"Path not found for trip_id={trip_id}")
 
-    zip_buffer.seek(0)
+    if len(trips) == 1:
+        mimetype = PATH_FORMATS[format_type]
+        filename = path_filename(next(iter(trips.values())), format_type)
+    else:
+        mimetype = "application/zip"
+        filename = f"Trainlog_{format_type}_export_{datetime.now().strftime('%Y-%m-%d')}.zip"
 
-    return send_file(
-        zip_buffer,
-        as_attachment=True,
-        download_name=f"Trainlog_{format_type}_export_{datetime.now().strftime('%Y-%m-%d')}.zip",
-        mimetype="application/zip",
+    response = Response(
+        stream_with_context(iter_path_download(pathConn, trips, format_type)),
+        mimetype=mimetype,
+    )
+    response.headers["Content-Disposition"] = (
+        f"attachment; filename*=UTF-8''{urllib.parse.quote(filename)}"
     )
+    return response
 
 
 @app.route("/<username>/current")
@@ -4173,7 +4392,7 @@ def check_current_user_owns_trip(trip_id):
 
 
 def get_user_id(username):
-    return User.query.filter_by(username=username).first().uid
+    return get_user_record(username).uid
 
 
 def get_trip(trip_id):
@@ -4260,7 +4479,7 @@ def update_trip_values_from_form_data(trip_id, formData, update_created_ts=False
     original_trip = get_trip(trip_id)
 
     if "estimated_trip_duration" in formData and "trip_length" in formData:
-        countries = getCountriesFromPath(
+        countries = get_countries_from_path(
             [{"lat": coord[0], "lng": coord[1]} for coord in path], formData["type"]
         )
         estimated_trip_duration = sanitize_param(formData["estimated_trip_duration"])
@@ -4544,16 +4763,9 @@ def forwardRouting(path, routingType, args=None):
         ]
 
         # Get country codes
-        countries = []
-        for wp in coord_pairs:
-            try:
-                countries.append(
-                    getCountryFromCoordinates(wp["lat"], wp["lng"])["countryCode"]
-                )
-            except Exception:
-                countries.append("UN")
-
-        unique_countries = set(countries)
+        unique_countries = set(
+            getCountryCodesFromCoordinates([(wp["lat"], wp["lng"]) for wp in coord_pairs])
+        )
 
         # Determine base router
         base, return_code = routers["fallback"]
@@ -4565,30 +4777,29 @@ def forwardRouting(path, routingType, args=None):
     if not args:
         args = request.query_string.decode("utf-8")
 
-    def build_url(base_url):
-        full_url = f"{base_url}/{path}?{args}"
+    def build_query():
+        query = args
         if routingType == "ferry" and radiuses:
-            full_url += f"&radiuses={radiuses}"
-        return full_url
+            query += f"&radiuses={radiuses}"
+        return query
 
     # Only apply try/fallback logic for BUS routing
     if routingType == "bus":
-        try:
-            response = requests.get(build_url(base), timeout=5)
-            if response.status_code != 200:
-                raise Exception("Non-200 response")
-            data = response.json()
-            if data.get("status") == "NoRoute":
-                raise Exception("Router responded with NoRoute")
-            print(base)
+        if base == routers["fallback"][0]:
+            response = get_route(base, path, args)
             return make_response(response.json(), return_code)
-        except Exception as e:
-            print(f"Router failed: {base}, falling back to OSRM. Reason: {e}")
-            fallback_url = build_url(routers["fallback"][0])
-            return make_response(requests.get(fallback_url).json(), 235)
+
+        # the fallback router is hedged after a short delay instead of waiting
+        # for the regional router to time out
+        response, used_fallback = get_route_hedged(
+            base, routers["fallback"][0], path, args
+        )
+        if used_fallback:
+            return make_response(response.json(), 235)
+        return make_response(response.json(), return_code)
     else:
         # Other routing types: no fallback
-        return requests.get(build_url(base)).text
+        return get_route(base, path, build_query()).text
 
 
 latin_letters = {}
@@ -4816,18 +5027,12 @@ def stationAutocomplete():
 
         # Add city name if not similar to name
         city = props.get("city")
-        if city and stringSimmilarity(city.lower(), props["name"].lower()) < 50:
+        if city and stringSimmilarity(city, props["name"]) < 50:
             district = props.get("district")
             locality = props.get("locality")
             if (
-                (
-                    district
-                    and stringSimmilarity(district.lower(), props["name"].lower()) < 50
-                )
-                or (
-                    locality
-                    and stringSimmilarity(locality.lower(), props["name"].lower()) < 50
-                )
+                (district and stringSimmilarity(district, props["name"]) < 50)
+                or (locality and stringSimmilarity(locality, props["name"]) < 50)
                 or (not district and not locality)
             ):
                 props["name"] = f"{city} - {props['name']}"
@@ -5150,7 +5355,7 @@ def getLeaderboardUsers(type):
     non_public_users = [
         username
         for username in user_list
-        if not User.query.filter_by(username=username).first().is_public()
+        if not get_user_record(username).is_public()
     ]
 
     if type not in ("train_countries", "world_squares", "country_count"):
@@ -5278,6 +5483,7 @@ def delete_user(uid):
         authDb.session.commit()
         pathConn.commit()
         mainConn.commit()
+        invalidate_trip_facts(user.username)
     except Exception as e:
         print(e)
 
@@ -5378,7 +5584,7 @@ def getCurrentTripPath(username):
             trip = formatTrip(
                 dict(cursor.execute(getTrip, {"trip_id": tripId}).fetchone())
             )
-        user = User.query.filter_by(username=trip["username"]).first()
+        user = get_user_record(trip["username"])
         if not session.get(user.username) and not user.is_public():
             abort(401)
         tripList.append(
@@ -5448,7 +5654,7 @@ def processPublicTrips(tripIds):
     for trip in tripIds.split(","):
         with managed_cursor(mainConn) as cursor:
             trip = cursor.execute(getTrip, {"trip_id": trip}).fetchone()
-        user = User.query.filter_by(username=trip["username"]).first()
+        user = get_user_record(trip["username"])
         if (
             not session.get(user.username)
             and not user.is_public_trips()
@@ -5526,7 +5732,7 @@ def processPublicTrips(tripIds):
             if trip["price_in_user_currency"] is not None:
                 total_price += trip["price_in_user_currency"]
 
-        user = User.query.filter_by(username=trip["username"]).first()
+        user = get_user_record(trip["username"])
         if (
             not session.get(user.username)
             and not user.is_public_trips()
@@ -5723,7 +5929,7 @@ def getMultiTrips(tripIds):
     userList = set()
     anonymous = {}
     for trip in sortedTripList:
-        user = User.query.filter_by(username=trip["trip"]["username"]).first()
+        user = get_user_record(trip["trip"]["username"])
         if (
             not session.get(user.username)
             and not user.is_public()
@@ -6125,7 +6331,7 @@ def admin():
         "admin/admin.html",
         title="Admin",
         username=getUser(),
-        langs=json.dumps(list(readLang().keys())),
+        langs=json.dumps(list(lang)),
         **lang[session["userinfo"]["lang"]],
         **session["userinfo"],
     )
@@ -6373,7 +6579,7 @@ def edit_copy_trip(username, tripId, edit_copy_type):
         path = json.loads(
             list(cursor.execute(formattedGetUserLines, (tripId,)).fetchone())[1]
         )
-    user = User.query.filter_by(username=trip["username"]).first()
+    user = get_user_record(trip["username"])
     if not (session.get(user.username) or session.get(owner)):
         abort(401)
     with managed_cursor(mainConn) as cursor:
@@ -6464,76 +6670,89 @@ def edit_copy_trip(username, tripId, edit_copy_type):
 @app.route("/<username>/export")
 @login_required
 def export(username):
+    """
+    CSV export of the user's trips (or of ?trips=1,2,3), gzipped with ?gzip=1.
+    Generated by a job, or streamed directly with ?stream=1.
+    With ?format=parquet or ?format=arrow, a columnar file is generated instead,
+    paths being [lat, lng] lists or WKB LineStrings with ?geometry=wkb.
+    """
     requestedTrips = request.args.get("trips", default=None)
-
-    si = StringIO()
-    cw = csv.writer(si)
-    with managed_cursor(mainConn) as cursor:
-        if requestedTrips is None:
-            cursor.execute(
-                "SELECT * FROM trip WHERE username = :username", {"username": username}
-            )
-        else:
-            query = "SELECT * FROM trip WHERE username = '{username}' AND uid IN ({requestedTrips})"
-            formattedQuery = query.format(
-                username=username,
-                requestedTrips=", ".join(("?",) * len(requestedTrips.split(","))),
-            )
-            cursor.execute(formattedQuery, requestedTrips.split(","))
-        rows = cursor.fetchall()
-        cw.writerow(
-            [i[0] for i in cursor.description if i[0] != "ticket_id"] + ["path"]
+    trip_ids = requestedTrips.split(",") if requestedTrips is not None else None
+    compress = request.args.get("gzip") == "1"
+    file_format = request.args.get("format", default="csv")
+
+    if file_format in COLUMNAR_FORMATS:
+        geometry = request.args.get("geometry", default="coordinates")
+        if geometry not in GEOMETRY_ENCODINGS:
+            abort(400, description="Unsupported geometry encoding")
+        job_id = enqueue_job(
+            username,
+            "export_columnar",
+            {
+                "username": username,
+                "trip_ids": trip_ids,
+                "file_format": file_format,
+                "geometry": geometry,
+            },
         )
-        processedRows = []
-
-        tripIds = []
-        for row in rows:
-            tripIds.append(row["uid"])
+        return redirect(url_for("job_wait", job_id=job_id))
+    elif file_format != "csv":
+        abort(400, description="Unsupported format")
 
-        formattedGetUserLines = getUserLines.format(
-            trip_ids=", ".join(("?",) * len(tripIds))
+    if request.args.get("stream") == "1":
+        response = Response(
+            stream_with_context(
+                iter_export_csv(mainConn, pathConn, username, trip_ids, compress)
+            ),
+            mimetype="application/gzip" if compress else "text/csv",
         )
-        with managed_cursor(pathConn) as cursor:
-            pathResult = cursor.execute(
-                formattedGetUserLines, tuple(tripIds)
-            ).fetchall()
-        paths = {}
-        for path in pathResult:
-            paths[path["trip_id"]] = path["path"]
-
-        for row in rows:
-            row = dict(row)
-            row.pop("ticket_id")
-            row["waypoints"] = json.dumps(row["waypoints"])
-            row["operator"] = (
-                row["operator"].replace(",", "&&")
-                if row["operator"] not in (None, "")
-                else row["operator"]
-            )
-            row["operator"] = (
-                urllib.parse.quote(row["operator"])
-                if row["operator"] not in (None, "")
-                else row["operator"]
-            )
-            row["line_name"] = (
-                urllib.parse.quote(row["line_name"])
-                if row["line_name"] not in (None, "")
-                else row["line_name"]
-            )
-            rowP = list(row.values())
-
-            rowP.append(polyline.encode(json.loads(paths[row["uid"]])))
-            processedRows.append(rowP)
-        cw.writerows(processedRows)
-        response = make_response(si.getvalue())
         response.headers["Content-Disposition"] = (
-            "attachment; filename=trainlog_{}_{}.csv".format(
-                username, datetime.strftime(datetime.now(), "%Y-%m-%d_%H%M%S")
-            )
+            f"attachment; filename={export_filename(username, compress)}"
         )
-        response.headers["Content-type"] = "text/csv"
+        return response
 
-    return response
+    job_id = enqueue_job(
+        username,
+        "export_csv",
+        {"username": username, "trip_ids": trip_ids, "compress": compress},
+    )
+    return redirect(url_for("job_wait", job_id=job_id))
+
+
+def export_filename(username, compress=False, extension="csv"):
+    return "trainlog_{}_{}.{}{}".format(
+        username,
+        datetime.strftime(datetime.now(), "%Y-%m-%d_%H%M%S"),
+        extension,
+        ".gz" if compress else "",
+    )
+
+
+@job_handler("export_csv")
+def exportCSV(username, trip_ids, compress=False, progress=None):
+    output_path = os.path.join(new_job_dir(), "trips.csv")
+    write_export_csv(
+        output_path, mainConn, pathConn, username, trip_ids, compress=compress
+    )
+    return {
+        "file": output_path,
+        "download_name": export_filename(username, compress),
+        "mimetype": "application/gzip" if compress else "text/csv",
+    }
+
+
+@job_handler("export_columnar")
+def exportColumnar(username, trip_ids, file_format, geometry, progress=None):
+    extension, mimetype = COLUMNAR_FORMATS[file_format]
+    output_path = os.path.join(new_job_dir(), "trips." + extension)
+    write_export_columnar(
+        output_path, file_format, mainConn, pathConn, username, trip_ids, geometry
+    )
+    return {
+        "file": output_path,
+        "download_name": export_filename(username, extension=extension),
+        "mimetype": mimetype,
+    }
 
 
 @app.route("/api/airlines")
@@ -6593,192 +6812,123 @@ def proxy_airlines():
 @app.route("/<username>/processMFR24", methods=["POST"])
 @login_required
 def processMFR24(username):
-    newTrip = {}
-    newPath = []
-    if request.form != {}:
-        data = list(request.form.to_dict().items())[0][0].split(",")
-
-        newTrip["material_type"] = data[8].rsplit("(")[1].rsplit(")")[0]
-        newTrip["seat"] = data[10]
-        newTrip["reg"] = data[9]
-        newTrip["notes"] = data[14]
-        newTrip["price"] = newTrip["currency"] = newTrip["purchasing_date"] = None
-
-        if "-" not in data[0]:
-            # data[0] contains only a year
-            data[0] = data[0] + "-01-01"  # Set to January 1st of that year
-            data[4] = data[5] = "00:00:01"  # Set time to 00:00:01
-            newTrip["precision"] = "onlyDate"
-            newTrip["onlyDate"] = data[0]
-            try:
-                # Handle estimated trip duration if available
-                hours, minutes, seconds = map(int, data[6].split(":"))
-                newTrip["onlyDateDuration"] = hours * 3600 + minutes * 60 + seconds
-            except (IndexError, ValueError):
-                # Default duration if data[6] is missing or invalid
-                newTrip["onlyDateDuration"] = 0
-        else:
-            # Existing code to handle full dates
-            if data[4] == "00:00:00":
-                data[4] = data[5] = "00:00:01"
-                newTrip["precision"] = "onlyDate"
-                newTrip["onlyDate"] = data[0]
-                try:
-                    hours, minutes, seconds = map(int, data[6].split(":"))
-                    newTrip["onlyDateDuration"] = hours * 3600 + minutes * 60 + seconds
-                except (IndexError, ValueError):
-                    newTrip["onlyDateDuration"] = 0
-            else:
-                newTrip["newTripStart"] = (data[0] + "T" + data[4])[0:16]
-                end_datetime = (data[0] + "T" + data[5])[0:16]
-                if datetime.strptime(data[5], "%H:%M:%S") - datetime.strptime(
-                    data[4], "%H:%M:%S"
-                ) < timedelta(0):
-                    end_datetime = datetime.strftime(
-                        datetime.strptime(end_datetime, "%Y-%m-%dT%H:%M")
-                        + timedelta(days=1),
-                        "%Y-%m-%dT%H:%M",
-                    )
-                newTrip["newTripEnd"] = end_datetime
-                newTrip["precision"] = "preciseDates"
+    """
+    Import a myFlightradar24 CSV export, the flights are imported by a job.
+    """
+    if getUser() not in (username, owner):
+        abort(403)
 
-        newTrip["lineName"] = data[1]
-        origIata = data[2].rsplit("(")[-1].split("/")[0]
-        destIata = data[3].rsplit("(")[-1].split("/")[0]
+    upload = request.files.get("file")
+    if upload is None or not upload.filename.lower().endswith(".csv"):
+        return jsonify({"error": "Upload CSV"}), 400
 
-        timedeltaObj = datetime.strptime(data[6], "%H:%M:%S") - datetime(1900, 1, 1)
-        newTrip["estimated_trip_duration"] = timedeltaObj.total_seconds()
+    directory = new_job_dir()
+    filename = os.path.join(directory, "flights.csv")
+    upload.save(filename)
+    job_id = enqueue_job(
+        username, "fr24_import", {"username": username, "filename": filename}
+    )
+    return job_started_response(job_id)
+
+
+# attributes of an already imported flight that are replaced on a new import
+FR24_UPDATED_ATTRIBUTES = (
+    "origin_station",
+    "destination_station",
+    "start_datetime",
+    "utc_start_datetime",
+    "end_datetime",
+    "utc_end_datetime",
+    "trip_length",
+    "estimated_trip_duration",
+    "manual_trip_duration",
+    "operator",
+    "countries",
+    "line_name",
+    "last_modified",
+    "seat",
+    "material_type",
+    "reg",
+    "waypoints",
+    "notes",
+    "price",
+    "currency",
+    "purchasing_date",
+    "ticket_id",
+    "is_project",
+)
 
-        for iata, index in (
-            (origIata, "originStation"),
-            (destIata, "destinationStation"),
-        ):
-            with managed_cursor(mainConn) as cursor:
-                airport = dict(
-                    cursor.execute(
-                        " SELECT * FROM airports WHERE iata = :searchPattern",
-                        {"searchPattern": iata},
-                    ).fetchone()
-                )
-            newTrip[index] = [
-                [airport["latitude"], airport["longitude"]],
-                "{} {} ({})".format(
-                    flag(airport["iso_country"]), airport["name"], airport["iata"]
-                ),
-            ]
-            newPath.append({"lat": airport["latitude"], "lng": airport["longitude"]})
-
-        airline = data[7].strip('"').rsplit(" ", 1)[0]
-        icao = data[7].strip('"').rsplit("/", 1)[1].replace(")", "")
-
-        s = requests.Session()
-        retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504])
-        s.mount("https://", HTTPAdapter(max_retries=retries))
-
-        api_ninjas_config = load_config().get("api_ninjas", {})
-        api_key = api_ninjas_config.get("api_key", "")
-        api_url = "https://api.api-ninjas.com/v1/airlines?icao={}".format(icao)
-        response = s.get(api_url, headers={"X-Api-Key": api_key})
-
-        if response.status_code == requests.codes.ok:
-            if response.json() != []:
-                operatorAPI = response.json()[0]
-                newTrip["operator"] = operatorAPI["name"]
-                if "logo_url" in operatorAPI.keys():
-                    newTrip["operatorLogoURL"] = operatorAPI["logo_url"]
-            else:
-                newTrip["operator"] = airline
-        else:
-            newTrip["operator"] = airline
 
-        newTrip["trip_length"] = getDistance(newPath[0], newPath[1])
+@job_handler("fr24_import", max_attempts=1)
+def importFR24(username, filename, progress=None):
+    """
+    Import all the flights of a myFlightradar24 export: airports come from an
+    in-memory index, new flights are inserted in bulk and flights that were
+    already imported are updated. Invalid rows are reported in the result.
+    """
+    with open(filename, encoding="utf-8-sig") as file:
+        rows = list(read_fr24_csv(file.read()))
+    if not rows:
+        raise JobError("No flight found in the file")
 
-        options = {
-            "orig": newTrip["originStation"][1],
-            "dest": newTrip["destinationStation"][1],
-            "username": username,
-        }
+    airports = get_airports(mainConn)
+    airlines = AirlineLookup(load_config().get("api_ninjas", {}).get("api_key", ""))
+    user_id = get_user_id(username)
 
-        if newTrip["precision"] != "onlyDate":
-            options["start_datetime"] = datetime.strftime(
-                datetime.strptime(newTrip["newTripStart"], "%Y-%m-%dT%H:%M"),
-                "%Y-%m-%d %H:%M:%S",
-            )
-            options["end_datetime"] = datetime.strftime(
-                datetime.strptime(newTrip["newTripEnd"], "%Y-%m-%dT%H:%M"),
-                "%Y-%m-%d %H:%M:%S",
-            )
-        else:
-            options["start_datetime"] = options["end_datetime"] = datetime.strftime(
-                datetime.strptime(newTrip["onlyDate"], "%Y-%m-%d")
-                + timedelta(seconds=1),
-                "%Y-%m-%d %H:%M:%S",
+    # trips of the user, to update flights imported before instead of duplicating them
+    with managed_cursor(mainConn) as cursor:
+        existing = {
+            (
+                trip["origin_station"],
+                trip["destination_station"],
+                str(trip["start_datetime"]),
+                str(trip["end_datetime"]),
+            ): trip["uid"]
+            for trip in cursor.execute(
+                """
+                SELECT uid, origin_station, destination_station, start_datetime, end_datetime
+                FROM trip WHERE username = ?
+                """,
+                (username,),
             )
+        }
 
-        limits = [
-            {
-                "lat": newPath[0]["lat"],
-                "lng": newPath[0]["lng"],
-            },
-            {
-                "lat": newPath[-1]["lat"],
-                "lng": newPath[-1]["lng"],
-            },
-        ]
-        (
-            manual_trip_duration,
-            start_datetime,
-            end_datetime,
-            utc_start_datetime,
-            utc_end_datetime,
-        ) = processDates(newTrip, limits)
-        countries = getCountriesFromPath(newPath, "air")
-        now = datetime.now()
-
-        with managed_cursor(mainConn) as cursor:
-            sqlite_trip = cursor.execute(getDuplicate, options).fetchone()
-
-        if sqlite_trip is not None:
-            trip = get_trip(sqlite_trip["uid"])
-
+    new_trips = {}
+    updated = 0
+    errors = []
+    logos = {}
+    try:
+        for index, (line, data) in enumerate(rows):
+            try:
+                newTrip, newPath = parse_fr24_flight(data, airports)
+                airline = airlines.get(newTrip["airline_icao"])
+            except Exception as e:
+                errors.append({"line": line, "error": f"{type(e).__name__}: {e}"})
+                continue
+
+            newTrip["operator"] = airline["name"] if airline else newTrip["airline"]
+            if airline and "logo_url" in airline:
+                logos[newTrip["operator"]] = airline["logo_url"]
+            newTrip["trip_length"] = getDistance(newPath[0], newPath[1])
             newTrip["origin_station"] = newTrip["originStation"][1]
             newTrip["destination_station"] = newTrip["destinationStation"][1]
             newTrip["type"] = "air"
 
-            trip.origin_station = sanitize_param(newTrip["originStation"][1])
-            trip.destination_station = sanitize_param(newTrip["destinationStation"][1])
-            trip.start_datetime = start_datetime
-            trip.utc_start_datetime = utc_start_datetime
-            trip.end_datetime = end_datetime
-            trip.utc_end_datetime = utc_end_datetime
-            trip.trip_length = sanitize_param(newTrip["trip_length"])
-            trip.estimated_trip_duration = sanitize_param(
-                newTrip["estimated_trip_duration"]
-            )
-            trip.manual_trip_duration = manual_trip_duration
-            trip.operator = sanitize_param(newTrip["operator"])
-            trip.countries = sanitize_param(countries)
-            trip.line_name = (sanitize_param(newTrip["lineName"]),)
-            trip.last_modified = now
-            trip.seat = sanitize_param(newTrip["seat"])
-            trip.material_type = sanitize_param(newTrip["material_type"])
-            trip.reg = sanitize_param(newTrip["reg"])
-            trip.waypoints = None
-            trip.notes = sanitize_param(newTrip["notes"])
-            trip.price = sanitize_param(newTrip["price"])
-            trip.currency = sanitize_param(newTrip["currency"])
-            trip.purchasing_date = sanitize_param(newTrip["purchasing_date"])
-            trip.ticket_id = None
-            trip.is_project = options["start_datetime"] == 1 or end_datetime == 1
-            trip.path = newPath
-
-            update_trip(trip.trip_id, trip, newTrip)
-        else:
+            (
+                manual_trip_duration,
+                start_datetime,
+                end_datetime,
+                utc_start_datetime,
+                utc_end_datetime,
+            ) = processDates(newTrip, newPath)
+            countries = get_countries_from_path(newPath, "air")
+            now = datetime.now()
+
             trip = Trip(
                 username=username,
-                user_id=get_user_id(username),
-                origin_station=sanitize_param(newTrip["originStation"][1]),
-                destination_station=sanitize_param(newTrip["destinationStation"][1]),
+                user_id=user_id,
+                origin_station=sanitize_param(newTrip["origin_station"]),
+                destination_station=sanitize_param(newTrip["destination_station"]),
                 start_datetime=start_datetime,
                 utc_start_datetime=utc_start_datetime,
                 end_datetime=end_datetime,
@@ -6799,18 +6949,45 @@ def processMFR24(username):
                 reg=sanitize_param(newTrip["reg"]),
                 waypoints=None,
                 notes=sanitize_param(newTrip["notes"]),
-                price=sanitize_param(newTrip["price"]),
-                currency=sanitize_param(newTrip["currency"]),
-                purchasing_date=sanitize_param(newTrip["purchasing_date"]),
+                price=None,
+                currency=None,
+                purchasing_date=None,
                 ticket_id=None,
-                is_project=options["start_datetime"] == 1 or end_datetime == 1,
-                path=newPath,
+                is_project=False,
+                path=[[point["lat"], point["lng"]] for point in newPath],
             )
-            create_trip(trip)
 
-        airlineLogoProcess(newTrip)
+            key = (
+                trip.origin_station,
+                trip.destination_station,
+                str(start_datetime),
+                str(end_datetime),
+            )
+            if key in existing:
+                existing_trip = get_trip(existing[key])
+                for attribute in FR24_UPDATED_ATTRIBUTES:
+                    setattr(existing_trip, attribute, getattr(trip, attribute))
+                existing_trip.path = newPath
+                update_trip(existing_trip.trip_id, existing_trip, newTrip)
+                updated += 1
+            else:
+                # the same flight twice in the file is only imported once
+                new_trips[key] = trip
 
-    return ""
+            if progress and index % 50 == 0:
+                progress(90 * (index + 1) / len(rows))
+
+        create_trips(list(new_trips.values()))
+
+        for operator, logo_url in logos.items():
+            airlines.save_logo(
+                operator, logo_url, "static/images/operator_logos/" + operator + ".png"
+            )
+    finally:
+        airlines.close()
+        shutil.rmtree(os.path.dirname(filename), ignore_errors=True)
+
+    return {"imported": len(new_trips), "updated": updated, "errors": errors}
 
 
 @app.route("/getCountry", methods=["GET"])
@@ -7013,135 +7190,35 @@ def importAll(username):
     if getUser() not in (username, owner):
         abort(403)
 
-    data = list(request.form.to_dict().items())[0][0]
-
-    csvfile = StringIO(data)
-    reader = csv.DictReader(csvfile)
-    preprocessed_rows = (
-        {k: (v if v != "" else None) for k, v in row.items()} for row in reader
-    )
-    dataDict = list(preprocessed_rows)[0]
-
-    now = datetime.now()
-
-    # Handle special cases
-    if dataDict.get("uid"):
-        dataDict.pop("uid")
-    if dataDict.get("countries") is not None:
-        dataDict["countries"] = (
-            dataDict["countries"].replace(' "', ', "').replace(",,", ",")
-        )
-    if dataDict.get("waypoints") is not None:
-        dataDict["waypoints"] = json.loads(dataDict["waypoints"])
-    if dataDict.get("operator") is not None:
-        dataDict["operator"] = dataDict["operator"].replace("&&", ",")
-    dataDict["created"] = now
-    dataDict["last_modified"] = now
-    dataDict["username"] = username
-    user_id = User.query.filter_by(username=username).first().uid
-    dataDict["user_id"] = user_id
-    dataDict["ticket_id"] = ""
-    # Remove path from main dict
-    if dataDict.get("path"):
-        rawPath = dataDict.pop("path")
-
-    decodedPath = polyline.decode(rawPath)
-    tmp_path = [{"lat": node[0], "lng": node[1]} for node in decodedPath]
-
-    path = Path(path=tmp_path, trip_id=None)
-
-    dataDict["precision"] = detect_precision(
-        dataDict["start_datetime"], dataDict["end_datetime"]
-    )
-    if dataDict["precision"] == "unknown":
-        dataDict["unknownType"] = (
-            "future"
-            if dataDict["start_datetime"] in [1, "1"]
-            or dataDict["end_datetime"] in [1, "1"]
-            else "past"
-        )
-    elif dataDict["precision"] == "preciseDates":
-        dataDict["newTripStart"] = datetime.strftime(
-            datetime.strptime(dataDict["start_datetime"], "%Y-%m-%d %H:%M:%S"),
-            "%Y-%m-%dT%H:%M",
-        )
-        dataDict["newTripEnd"] = datetime.strftime(
-            datetime.strptime(dataDict["end_datetime"], "%Y-%m-%d %H:%M:%S"),
-            "%Y-%m-%dT%H:%M",
-        )
+    upload = request.files.get("file")
+    if upload is not None:
+        data = upload.read().decode("utf-8-sig")
     else:
-        dataDict["unknownType"] = None
+        # former clients post the header and one row as the form's only key
+        data = list(request.form.to_dict().items())[0][0]
 
-    manDuration, start_datetime, end_datetime, utc_start_datetime, utc_end_datetime = (
-        processDates(dataDict, tmp_path)
-    )
-    dataDict["is_project"] = start_datetime in [1, "1"] or end_datetime in [1, "1"]
-    if start_datetime in [-1, 1, "-1", "1"]:
-        start_datetime = None
-    if end_datetime in [-1, 1, "-1", "1"]:
-        end_datetime = None
-
-    trip = Trip(
-        trip_id=None,
-        username=sanitize_param(dataDict["username"]),
-        user_id=dataDict["user_id"],
-        origin_station=sanitize_param(dataDict["origin_station"]),
-        destination_station=sanitize_param(dataDict["destination_station"]),
-        start_datetime=sanitize_param(start_datetime),
-        end_datetime=sanitize_param(end_datetime),
-        trip_length=sanitize_param(dataDict["trip_length"]),
-        estimated_trip_duration=sanitize_param(dataDict["estimated_trip_duration"]),
-        operator=sanitize_param(dataDict["operator"]),
-        countries=sanitize_param(dataDict["countries"]),
-        manual_trip_duration=manDuration,
-        utc_start_datetime=utc_start_datetime,
-        utc_end_datetime=utc_end_datetime,
-        created=sanitize_param(dataDict["created"]),
-        last_modified=sanitize_param(dataDict["last_modified"]),
-        line_name=sanitize_param(dataDict["line_name"]),
-        type=sanitize_param(dataDict["type"]),
-        material_type=sanitize_param(dataDict["material_type"]),
-        seat=sanitize_param(dataDict["seat"]),
-        reg=sanitize_param(dataDict["reg"]),
-        waypoints=sanitize_param(dataDict["waypoints"]),
-        notes=sanitize_param(dataDict["notes"]),
-        price=sanitize_param(dataDict["price"]),
-        currency=sanitize_param(dataDict["currency"]),
-        purchasing_date=sanitize_param(dataDict["purchasing_date"]),
-        ticket_id=sanitize_param(dataDict["ticket_id"]),
-        is_project=dataDict["start_datetime"] == 1 or dataDict["end_datetime"] == 1,
-        path=path,
-    )
+    user_id = get_user_id(username)
+    try:
+        trips = parse_trips_csv(data, username, user_id)
+    except TripImportError as e:
+        return (
+            jsonify(
+                {
+                    "error": "Invalid rows, nothing was imported",
+                    "rows": [{"line": line, "error": error} for line, error in e.errors],
+                }
+            ),
+            400,
+        )
 
     try:
-        create_trip(trip)
+        trip_ids = create_trips(trips)
     except Exception as e:
         # Return an appropriate error response
         logger.exception(e)
         return jsonify({"error": "Failed to import data"}), 500
 
-    return jsonify({"message": "Data imported successfully"}), 200
-
-
-def detect_precision(start_date, end_date):
-    if (
-        start_date is None
-        or start_date in ["", "1", 1, "-1", -1]
-        or end_date is None
-        or end_date in ["", "1", 1, "-1", -1]
-    ):
-        return "unknown"
-
-    try:
-        datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S")
-        datetime.strptime(end_date, "%Y-%m-%d %H:%M:%S")
-        return "preciseDates"
-    except ValueError:
-        pass
-
-    datetime.strptime(start_date, "%Y-%m-%d")
-    datetime.end_date(start_date, "%Y-%m-%d")
-    return "onlyDate"
+    return jsonify({"message": "Data imported successfully", "imported": len(trip_ids)}), 200
 
 
 @app.route("/admin/manual")
@@ -8096,7 +8173,7 @@ def admin_user_growth():
 @app.route("/<username>/friends")
 @login_required
 def friends(username):
-    user_id = User.query.filter_by(username=username).first().uid
+    user_id = get_user_id(username)
 
     outgoing_requests = (
         authDb.session.query(User.uid, User.username)
@@ -8141,7 +8218,7 @@ def friends(username):
 @app.route("/<username>/cancelFriendship/<int:friendId>", methods=["GET"])
 @login_required
 def cancelFriendship(username, friendId):
-    user_id = User.query.filter_by(username=username).first().uid
+    user_id = get_user_id(username)
 
     # Look for all existing friendships and friend requests, regardless of who initiated it
     friendships = Friendship.query.filter(
@@ -8169,7 +8246,7 @@ def cancelFriendship(username, friendId):
 @app.route("/<username>/acceptFriendship/<int:friendId>", methods=["GET"])
 @login_required
 def acceptFriendship(username, friendId):
-    user_id = User.query.filter_by(username=username).first().uid
+    user_id = get_user_id(username)
 
     # Look for the existing friendship request directed to the user
     friendship = Friendship.query.filter(
@@ -8204,7 +8281,7 @@ def acceptFriendship(username, friendId):
 @app.route("/<username>/requestFriend/<friendId>", methods=["GET"])
 @login_required
 def requestFriend(username, friendId):
-    user = User.query.filter_by(username=username).first()
+    user = get_user_record(username)
     try:
         friendId = int(friendId)
     except ValueError:
@@ -8247,7 +8324,7 @@ def requestFriend(username, friendId):
 
 
 def getFriendsRequestsNumber():
-    user_id = User.query.filter_by(username=getUser()).first().uid
+    user_id = get_user_id(getUser())
     incoming_requests = (
         authDb.session.query(User.uid, User.username)
         .join(Friendship, User.uid == Friendship.user_id)
@@ -8271,6 +8348,17 @@ def refreshCurrency():
     return run_currency_update()
 
 
+@app.route("/admin/refreshAirports", methods=["GET"])
+@owner_required
+def refreshAirports():
+    """
+    Reload the airports index of this worker after an edit of the airports
+    table, other workers pick the change up at their next periodic check
+    """
+    airports = get_airports(mainConn, refresh=True)
+    return jsonify({"airports": len(airports), "iata": len(airports.iata)})
+
+
 @app.route("/ship_route", methods=["POST"])
 def calculate_route():
     data = request.json
@@ -8465,64 +8553,60 @@ def generate_visited_squares_geojson(username):
         )
         trips = cursor.fetchall()
 
-        for trip in trips:
-            trip_id = trip["uid"]
-            trip_type = trip["type"]
-
-            with managed_cursor(pathConn) as cursor:
-                cursor.execute("SELECT path FROM paths WHERE trip_id = ?", (trip_id,))
-                paths = cursor.fetchall()
-
-            for path in paths:
-                coordinates = json.loads(path["path"])
-
-                for i in range(len(coordinates)):
-                    lat, lon = coordinates[i]
-                    square = (math.floor(lat), math.floor(lon))
-
-                    if trip_type in ("air", "helicopter"):
-                        if (
-                            visited_squares.get(square) not in ("stopped", "passed")
-                            and square not in land_squares
-                        ):
-                            visited_squares[square] = "air"
-                            air_squares.add(square)
-                    else:
-                        if visited_squares.get(square) != "stopped":
-                            visited_squares[square] = "passed"
-                        land_squares.add(square)
-                        air_squares.discard(square)
-
-                    # Override with "stopped" on first/last point
-                    if i == 0 or i == len(coordinates) - 1:
-                        visited_squares[square] = "stopped"
-                        land_squares.add(square)
-                        air_squares.discard(square)
-
-                    # Interpolate between points (only for air trips)
-                    if (
-                        trip_type in ("air", "helicopter")
-                        and len(coordinates) > 2
-                        and i < len(coordinates) - 1
-                    ):
-                        next_lat, next_lon = coordinates[i + 1]
-                        intermediates = interpolate_great_circle(
-                            (lat, lon), (next_lat, next_lon), max_distance_km=50
-                        )
+    paths = get_paths([trip["uid"] for trip in trips])
+    for trip in trips:
+        trip_type = trip["type"]
+        coordinates = paths.get(trip["uid"])
+        if not coordinates:
+            continue
+
+        for i in range(len(coordinates)):
+            lat, lon = coordinates[i]
+            square = (math.floor(lat), math.floor(lon))
+
+            if trip_type in ("air", "helicopter"):
+                if (
+                    visited_squares.get(square) not in ("stopped", "passed")
+                    and square not in land_squares
+                ):
+                    visited_squares[square] = "air"
+                    air_squares.add(square)
+            else:
+                if visited_squares.get(square) != "stopped":
+                    visited_squares[square] = "passed"
+                land_squares.add(square)
+                air_squares.discard(square)
+
+            # Override with "stopped" on first/last point
+            if i == 0 or i == len(coordinates) - 1:
+                visited_squares[square] = "stopped"
+                land_squares.add(square)
+                air_squares.discard(square)
+
+            # Interpolate between points (only for air trips)
+            if (
+                trip_type in ("air", "helicopter")
+                and len(coordinates) > 2
+                and i < len(coordinates) - 1
+            ):
+                next_lat, next_lon = coordinates[i + 1]
+                intermediates = interpolate_great_circle(
+                    (lat, lon), (next_lat, next_lon), max_distance_km=50
+                )
 
-                        for inter_lat, inter_lon in intermediates:
-                            inter_square = (
-                                math.floor(inter_lat),
-                                math.floor(inter_lon),
-                            )
+                for inter_lat, inter_lon in intermediates:
+                    inter_square = (
+                        math.floor(inter_lat),
+                        math.floor(inter_lon),
+                    )
 
-                            if (
-                                visited_squares.get(inter_square)
-                                not in ("stopped", "passed")
-                                and inter_square not in land_squares
-                            ):
-                                visited_squares[inter_square] = "air"
-                                air_squares.add(inter_square)
+                    if (
+                        visited_squares.get(inter_square)
+                        not in ("stopped", "passed")
+                        and inter_square not in land_squares
+                    ):
+                        visited_squares[inter_square] = "air"
+                        air_squares.add(inter_square)
 
     total_squares = 180 * 360  # entire world grid
     land_percentage = (len(land_squares) / total_squares) * 100
@@ -9074,20 +9158,13 @@ def get_bounds(username):
     if not trip_ids:
         return jsonify({"error": "No trips found for this user"}), 404
 
-    with managed_cursor(pathConn) as path_cursor:
-        # Fetch all paths associated with the user's trips using IN
-        path_cursor.execute(
-            f"SELECT trip_id, path FROM paths WHERE trip_id IN ({','.join(['?'] * len(trip_ids))})",
-            trip_ids,
-        )
-        paths = path_cursor.fetchall()
+    paths = get_paths(trip_ids)
 
     if not paths:
         return jsonify({"error": "No paths found for this user's trips"}), 404
 
     # Process each path to update the boundary values
-    for trip_id, path_row in paths:
-        path = json.loads(path_row)  # path is a list of lists with coordinates
+    for trip_id, path in paths.items():
         for coord in path:
             lat, lon = coord
             # Update bounds with coordinates, place information, and trip_id
@@ -1,12 +1,45 @@
 #!/usr/bin/env python3
+"""
+Online backup of the SQLite databases.
+
+Each database is copied with the SQLite backup API, a few pages at a time with
+a pause in between, so that the app keeps writing while it runs. SQLite starts
+such a copy over whenever the database is written between two steps, so after
+a few restarts the copy is done in one step instead, during which writers
+wait. Databases are
+copied in parallel, then trips missing from main.db or path.db are removed from
+the copies, each copy is checked, optionally compressed with zstd (needs the
+`zstandard` package) and its checksum verified after writing.
+
+Incremental backups still take a full, consistent copy, but only store the
+pages that changed since the previous backup (whose page hashes are kept in
+its manifest). A database is restored from any backup, full or incremental,
+with `--restore`.
+
+    python backup.py [--incremental] [--zstd]
+    python backup.py --restore backup/2025-01-02 main.db restored-main.db
+"""
+
+import argparse
+import hashlib
+import json
 import sqlite3
+import struct
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime
 from pathlib import Path
-from typing import Callable, Optional
+from typing import Optional
 from zoneinfo import ZoneInfo
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # ─── Configuration ──────────────────────────────────────────────────────────────
 
 # Folder where live DBs live, and where backups go
@@ -14,11 +47,22 @@ SRC_DIR = Path("databases")
 BASE_BACKUP_DIR = Path("backup")
 
 # List of DB filenames
-SIMPLE_DBS = ["auth.db", "error.db"]
+DATABASES = ["auth.db", "error.db", "main.db", "path.db"]
+# Tables whose rows are only kept for trips present in both main.db and path.db
 FILTERED_DBS = [("main.db", "trip", "uid"), ("path.db", "paths", "trip_id")]
 
-# Max parameters per SQLite query (keep below 999)
-CHUNK_SIZE = 900
+# Pages copied per backup step, and pause between steps to let writers in
+PAGES_PER_STEP = 1024
+STEP_PAUSE = 0.005
+# Restarts of a stepped copy (the database was written meanwhile) after which
+# it is copied in a single step
+MAX_RESTARTS = 3
+
+MANIFEST = "manifest.json"
+ZSTD_LEVEL = 3
+# Page records of incremental backups: page number, then the page
+DELTA_RECORD = struct.Struct(">I")
+COPY_BUFFER = 1024 * 1024
 
 # ─── Progress Bar Class ─────────────────────────────────────────────────────────
 
@@ -31,16 +75,18 @@ class ProgressBar:
         self.width = width
         self.start_time = time.time()
         self.last_update = 0
+        self.lock = threading.Lock()
 
     def update(self, amount: int = 1):
         """Update progress by amount and display if enough time has passed."""
-        self.current = min(self.current + amount, self.total)
+        with self.lock:
+            self.current = min(self.current + amount, self.total)
 
-        # Update display at most every 0.1 seconds to avoid flickering
-        current_time = time.time()
-        if current_time - self.last_update >= 0.1 or self.current == self.total:
-            self._display()
-            self.last_update = current_time
+            # Update display at most every 0.1 seconds to avoid flickering
+            current_time = time.time()
+            if current_time - self.last_update >= 0.1 or self.current == self.total:
+                self._display()
+                self.last_update = current_time
 
     def _display(self):
         """Display the current progress bar."""
@@ -97,8 +143,8 @@ def now_iso_date():
 
 
 def connect_readonly(path: Path):
-    """Open a read-only, immutable SQLite URI connection."""
-    uri = f"file:{path}?mode=ro&immutable=1"
+    """Open a read-only SQLite URI connection (the file may be written meanwhile)."""
+    uri = f"file:{path}?mode=ro"
     return sqlite3.connect(uri, uri=True)
 
 
@@ -107,244 +153,343 @@ def connect_writable(path: Path):
     return sqlite3.connect(path)
 
 
-def get_table_row_count(conn: sqlite3.Connection, table: str) -> int:
-    """Get the number of rows in a table."""
-    cur = conn.cursor()
-    cur.execute(f"SELECT COUNT(*) FROM {table}")
-    return cur.fetchone()[0]
+def format_size(size: int) -> str:
+    """Format a number of bytes into a human-readable size."""
+    if size < 1024:
+        return f"{size} B"
+    for unit in ("KB", "MB", "GB"):
+        size /= 1024
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
 
 
-def get_all_tables_row_count(conn: sqlite3.Connection) -> int:
-    """Get total row count across all user tables."""
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
-    )
-    total = 0
-    for (table,) in cur.fetchall():
-        total += get_table_row_count(conn, table)
-    return total
-
+def file_sha256(path: Path, compressed: bool = False) -> str:
+    """SHA-256 of a file's content, decompressed first if it's a zstd file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f) if compressed else f
+        while chunk := reader.read(COPY_BUFFER):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-def copy_schema_and_data(
-    src_conn, dst_conn, table_filter=None, progress_callback: Optional[Callable] = None
-):
-    """
-    Copy all tables/indexes/triggers/views from src to dst.
-    Skips sqlite_sequence and any tables rejected by table_filter(name)->bool.
-    """
-    src = src_conn.cursor()
-    dst = dst_conn.cursor()
-
-    # Grab all user-and-meta objects (tables, indexes, triggers, views)
-    src.execute("""
-        SELECT type, name, sql 
-          FROM sqlite_master 
-         WHERE name NOT LIKE 'sqlite_%' 
-           AND sql IS NOT NULL
-         ORDER BY type='table' DESC, type='index', type;
-    """)
-    schema_objects = src.fetchall()
-
-    # Create schema objects
-    for obj_type, name, sql in schema_objects:
-        if table_filter and not table_filter(name, obj_type):
-            continue
-        dst.execute(sql)
-    dst_conn.commit()
-
-    # Copy table data with progress tracking
-    src.execute(
-        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';"
-    )
-    tables = [row[0] for row in src.fetchall()]
 
-    for tbl in tables:
-        if table_filter and not table_filter(tbl, "table"):
-            continue
+def page_hashes(path: Path, page_size: int) -> list:
+    """Short hash of every page of a database file."""
+    hashes = []
+    with open(path, "rb") as f:
+        while page := f.read(page_size):
+            hashes.append(hashlib.blake2b(page, digest_size=16).hexdigest())
+    return hashes
 
-        # Get all rows for this table
-        rows = src.execute(f"SELECT * FROM {tbl}").fetchall()
-        if not rows:
-            continue
 
-        # Insert rows and update progress
-        placeholders = ", ".join(["?"] * len(rows[0]))
-        dst.executemany(f"INSERT INTO {tbl} VALUES ({placeholders})", rows)
+def compress_file(src: Path, dst: Path):
+    """Compress src into dst with zstd."""
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(f_in, f_out)
 
-        if progress_callback:
-            progress_callback(len(rows))
 
-    dst_conn.commit()
+def open_stored(path: Path):
+    """Open a stored backup file for reading, decompressing zstd files."""
+    f = open(path, "rb")
+    if path.suffix == ".zst":
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    return f
 
 
-def get_ids(src_path: Path, table: str, column: str) -> set:
-    """Fetch the set of values of `column` from `table` in src_path."""
-    conn = connect_readonly(src_path)
-    cur = conn.cursor()
-    cur.execute(f"SELECT DISTINCT {column} FROM {table}")
-    ids = {row[0] for row in cur.fetchall()}
-    conn.close()
-    return ids
+def find_previous_backup(dst_folder: Path) -> Optional[Path]:
+    """Latest backup folder with a manifest, other than dst_folder."""
+    folders = sorted(
+        folder
+        for folder in BASE_BACKUP_DIR.iterdir()
+        if folder != dst_folder and (folder / MANIFEST).exists()
+    )
+    return folders[-1] if folders else None
 
 
-def chunked(iterable, size):
-    """Yield successive chunks from iterable of length ≤ size."""
-    it = list(iterable)
-    for i in range(0, len(it), size):
-        yield it[i : i + size]
+# ─── Backup Routines ────────────────────────────────────────────────────────────
 
 
-# ─── Backup Routines ────────────────────────────────────────────────────────────
+class BackupRestarted(Exception):
+    """The stepped copy of a database restarted more than MAX_RESTARTS times."""
 
 
-def backup_simple(db_name: str, dst_folder: Path):
-    """Copy schema + all data from a simple DB (no cross-filtering)."""
+def snapshot(db_name: str, dst_folder: Path, progress: ProgressBar) -> dict:
+    """
+    Copy a live database into dst_folder with the backup API, in small steps,
+    or in one step if it keeps being written meanwhile.
+    """
     src = SRC_DIR / db_name
     dst = dst_folder / db_name
-
-    print(f"Analyzing {db_name}...")
-
-    # Get total row count for progress tracking
-    with connect_readonly(src) as src_conn:
-        total_rows = get_all_tables_row_count(src_conn)
-
-    if total_rows == 0:
-        print(f"✅ {db_name} is empty, skipping.")
-        return
-
-    # Create progress bar
-    progress = ProgressBar(total_rows, f"Backing up {db_name}")
-
-    def update_progress(rows_processed):
-        progress.update(rows_processed)
-
-    # Perform backup with progress tracking
-    with connect_readonly(src) as src_conn, connect_writable(dst) as dst_conn:
-        copy_schema_and_data(src_conn, dst_conn, progress_callback=update_progress)
-
-
-def backup_filtered(
-    main_db: str, table: str, column: str, valid_ids: set, dst_folder: Path
-):
+    start = time.perf_counter()
+    copied = reported = restarts = 0
+
+    def on_step(status, remaining, total):
+        nonlocal copied, reported, restarts
+        if total - remaining < copied:
+            # the source was written since the last step, SQLite started over
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise BackupRestarted
+        copied = total - remaining
+        progress.update(max(copied - reported, 0))
+        reported = max(reported, copied)
+        # the source is unlocked between steps, writers get it now
+        time.sleep(STEP_PAUSE)
+
+    with (
+        closing(connect_readonly(src)) as src_conn,
+        closing(connect_writable(dst)) as dst_conn,
+    ):
+        try:
+            src_conn.backup(dst_conn, pages=PAGES_PER_STEP, progress=on_step)
+        except BackupRestarted:
+            # the source stays locked until the copy is done, writers wait
+            src_conn.backup(dst_conn, pages=-1)
+            page_count = dst_conn.execute("PRAGMA page_count").fetchone()[0]
+            progress.update(max(page_count - reported, 0))
+        page_size = dst_conn.execute("PRAGMA page_size").fetchone()[0]
+    return {
+        "page_size": page_size,
+        "seconds": time.perf_counter() - start,
+        "restarts": restarts,
+    }
+
+
+def filter_trips(dst_folder: Path) -> int:
     """
-    Copy schema + all data *except* `table`, then create `table` and copy only rows
-    whose `column` is in valid_ids (in chunks).
+    Remove from the copies the trips that are missing from the other database.
+    Both copies are consistent snapshots, so this is done on them rather than
+    on the live databases.
     """
-    src = SRC_DIR / main_db
-    dst = dst_folder / main_db
-
-    print(f"Analyzing {main_db}...")
-
-    with connect_readonly(src) as src_conn:
-        # Get total rows excluding the filtered table
-        total_other_rows = 0
-        cur = src_conn.cursor()
-        cur.execute(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
-        )
-        for (tbl,) in cur.fetchall():
-            if tbl != table:
-                total_other_rows += get_table_row_count(src_conn, tbl)
-
-        # Get count of rows we'll copy from the filtered table
-        if valid_ids:
-            # Estimate based on a sample to avoid creating huge IN clauses
-            sample_size = min(100, len(valid_ids))
-            sample_ids = list(valid_ids)[:sample_size]
-            qmarks = ",".join("?" for _ in sample_ids)
-            sample_count = cur.execute(
-                f"SELECT COUNT(*) FROM {table} WHERE {column} IN ({qmarks})",
-                tuple(sample_ids),
-            ).fetchone()[0]
-            # Extrapolate to full set
-            filtered_rows = int(sample_count * len(valid_ids) / sample_size)
-        else:
-            filtered_rows = 0
-
-        total_rows = total_other_rows + filtered_rows
-
-    if total_rows == 0:
-        print(f"✅ {main_db} would be empty after filtering, skipping.")
-        return
-
-    # Create progress bar
-    progress = ProgressBar(total_rows, f"Backing up {main_db} (filtered)")
-
-    with connect_readonly(src) as src_conn, connect_writable(dst) as dst_conn:
-        # 1) Copy everything *except* our filtered table
-        def filter_out(name, obj_type):
-            return not (obj_type == "table" and name == table)
-
-        def update_progress_other(rows_processed):
-            progress.update(rows_processed)
+    ids = []
+    for db_name, table, column in FILTERED_DBS:
+        with closing(connect_writable(dst_folder / db_name)) as conn:
+            ids.append(
+                {row[0] for row in conn.execute(f"SELECT {column} FROM {table}")}
+            )
+    valid = set.intersection(*ids)
+    print(
+        f"🔍 {len(valid)} trips in both " + " and ".join(db for db, *_ in FILTERED_DBS)
+    )
 
-        copy_schema_and_data(
-            src_conn,
-            dst_conn,
-            table_filter=filter_out,
-            progress_callback=update_progress_other,
+    removed = 0
+    for db_name, table, column in FILTERED_DBS:
+        with closing(connect_writable(dst_folder / db_name)) as conn:
+            removed += conn.execute(
+                f"DELETE FROM {table} WHERE {column} NOT IN (SELECT value FROM json_each(?))",
+                (json.dumps(sorted(valid)),),
+            ).rowcount
+            conn.commit()
+    return removed
+
+
+def write_delta(raw: Path, delta: Path, hashes: list, previous: list, page_size: int):
+    """Write the pages of raw whose hash differs from the previous backup."""
+    changed = 0
+    with open(raw, "rb") as f, open(delta, "wb") as f_out:
+        for number, page_hash in enumerate(hashes, start=1):
+            if number <= len(previous) and previous[number - 1] == page_hash:
+                continue
+            f.seek((number - 1) * page_size)
+            f_out.write(DELTA_RECORD.pack(number))
+            f_out.write(f.read(page_size))
+            changed += 1
+    return changed
+
+
+def store(
+    db_name: str,
+    dst_folder: Path,
+    page_size: int,
+    previous: Optional[dict],
+    compress: bool,
+) -> dict:
+    """
+    Check the copy of a database, write what is kept of it (the whole file or
+    the changed pages, compressed or not) and verify the checksum of the
+    written file. Return the manifest entry of the database.
+    """
+    start = time.perf_counter()
+    raw = dst_folder / db_name
+    with closing(connect_writable(raw)) as conn:
+        check = conn.execute("PRAGMA quick_check").fetchone()[0]
+    if check != "ok":
+        raise RuntimeError(f"{db_name} copy is corrupted: {check}")
+
+    hashes = page_hashes(raw, page_size)
+    entry = {
+        "page_size": page_size,
+        "page_count": len(hashes),
+        "size": raw.stat().st_size,
+        "page_hashes": hashes,
+    }
+    if previous is not None and previous["page_size"] == page_size:
+        delta = dst_folder / f"{db_name}.delta"
+        entry["changed_pages"] = write_delta(
+            raw, delta, hashes, previous["page_hashes"], page_size
         )
+        entry["base"] = previous["folder"]
+        raw.unlink()
+        raw = delta
+
+    stored = raw
+    if compress:
+        stored = raw.with_name(raw.name + ".zst")
+        compress_file(raw, stored)
+    entry["file"] = stored.name
+    entry["sha256"] = file_sha256(raw)
+    if compress:
+        raw.unlink()
+
+    # read back what was written
+    if file_sha256(stored, compressed=compress) != entry["sha256"]:
+        raise RuntimeError(f"{stored} does not match its checksum")
+    entry["stored_size"] = stored.stat().st_size
+    entry["seconds"] = time.perf_counter() - start
+    return entry
+
+
+def restore(folder: Path, db_name: str, target: Path):
+    """Rebuild a database from a backup folder, following incremental backups."""
+    with open(folder / MANIFEST) as f:
+        entry = json.load(f)["databases"][db_name]
+    page_size = entry["page_size"]
+
+    if "base" in entry:
+        restore(BASE_BACKUP_DIR / entry["base"], db_name, target)
+        with open_stored(folder / entry["file"]) as delta, open(target, "r+b") as f:
+            while header := delta.read(DELTA_RECORD.size):
+                (number,) = DELTA_RECORD.unpack(header)
+                f.seek((number - 1) * page_size)
+                f.write(delta.read(page_size))
+            f.truncate(entry["page_count"] * page_size)
+    else:
+        with open_stored(folder / entry["file"]) as f_in, open(target, "wb") as f_out:
+            while chunk := f_in.read(COPY_BUFFER):
+                f_out.write(chunk)
+
+    if page_hashes(target, page_size) != entry["page_hashes"]:
+        raise RuntimeError(f"Restored {db_name} does not match the backup")
 
-        # 2) Now create the filtered table schema itself
-        schema_sql = src_conn.execute(
-            "SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)
-        ).fetchone()[0]
-        dst_conn.execute(schema_sql)
 
-        # 3) Copy filtered data in chunks
-        insert_cur = dst_conn.cursor()
-        for chunk in chunked(valid_ids, CHUNK_SIZE):
-            qmarks = ",".join("?" for _ in chunk)
-            rows = src_conn.execute(
-                f"SELECT * FROM {table} WHERE {column} IN ({qmarks})", tuple(chunk)
-            ).fetchall()
-            if rows:
-                ph = ",".join("?" for _ in rows[0])
-                insert_cur.executemany(f"INSERT INTO {table} VALUES ({ph})", rows)
-                progress.update(len(rows))
+# ─── Main Script ────────────────────────────────────────────────────────────────
 
-        dst_conn.commit()
 
+def main():
+    parser = argparse.ArgumentParser(description="Back up the SQLite databases.")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only store the pages changed since the previous backup",
+    )
+    parser.add_argument("--zstd", action="store_true", help="compress with zstd")
+    parser.add_argument(
+        "--restore",
+        nargs=3,
+        metavar=("FOLDER", "DB", "TARGET"),
+        help="rebuild DB from the backup in FOLDER into TARGET",
+    )
+    args = parser.parse_args()
 
-# ─── Main Script ────────────────────────────────────────────────────────────────
+    if args.zstd and zstandard is None:
+        raise RuntimeError("zstd compression needs the zstandard package")
 
+    if args.restore:
+        folder, db_name, target = args.restore
+        restore(Path(folder), db_name, Path(target))
+        print(f"✅ Restored {db_name} into {target}")
+        return
 
-def main():
     print("🔄 Starting database backup...\n")
+    start = time.perf_counter()
 
     # 1) Prepare destination folder
-    date_str = now_iso_date()
-    dst = BASE_BACKUP_DIR / date_str
+    dst = BASE_BACKUP_DIR / now_iso_date()
+    if (dst / MANIFEST).exists():
+        dst = dst.with_name(f"{dst.name}-{datetime.now():%H%M%S}")
     dst.mkdir(parents=True, exist_ok=True)
     print(f"📁 Backing up to folder: {dst}\n")
 
-    # 2) Simple DBs
-    for db in SIMPLE_DBS:
-        backup_simple(db, dst)
-        print()  # Add spacing between databases
-
-    # 3) Compute valid trip IDs = intersection of main.trip.uid and path.paths.trip_id
-    print("🔍 Computing valid trip IDs...")
-    main_ids = get_ids(SRC_DIR / "main.db", "trip", "uid")
-    path_ids = get_ids(SRC_DIR / "path.db", "paths", "trip_id")
-    valid = main_ids & path_ids
-
-    print(f"   Found {len(main_ids)} trip IDs in main.db")
-    print(f"   Found {len(path_ids)} trip IDs in path.db")
-    print(f"   Valid intersection: {len(valid)} trip IDs")
-
-    if not valid:
-        print("⚠️  Warning: no matching trip IDs between main.db and path.db")
-    print()
+    previous = {}
+    if args.incremental:
+        previous_folder = find_previous_backup(dst)
+        if previous_folder is None:
+            print("⚠️  No previous backup, making a full one")
+        else:
+            print(f"📎 Storing changes since {previous_folder.name}")
+            with open(previous_folder / MANIFEST) as f:
+                previous = json.load(f)["databases"]
+            for entry in previous.values():
+                entry["folder"] = previous_folder.name
+
+    databases = [db for db in DATABASES if (SRC_DIR / db).exists()]
+    for db_name in DATABASES:
+        if db_name not in databases:
+            print(f"⚠️  {db_name} not found, skipping")
+    if not databases:
+        raise RuntimeError(f"No database found in {SRC_DIR}")
+
+    # 2) Copy all databases at once
+    total_pages = 0
+    for db_name in databases:
+        with closing(connect_readonly(SRC_DIR / db_name)) as conn:
+            total_pages += conn.execute("PRAGMA page_count").fetchone()[0]
+    progress = ProgressBar(total_pages, "Copying databases")
+    with ThreadPoolExecutor(max_workers=len(databases)) as executor:
+        copies = dict(
+            zip(
+                databases,
+                executor.map(lambda db: snapshot(db, dst, progress), databases),
+            )
+        )
+    if progress.current < progress.total:
+        # the databases shrank while being copied
+        progress.update(progress.total - progress.current)
+
+    # 3) Keep only the trips present in both main.db and path.db
+    if all(db in copies for db, *_ in FILTERED_DBS):
+        print(f"   Removed {filter_trips(dst)} rows of incomplete trips\n")
+
+    # 4) Check, compress and verify the copies
+    with ThreadPoolExecutor(max_workers=len(databases)) as executor:
+        entries = dict(
+            zip(
+                databases,
+                executor.map(
+                    lambda db: store(
+                        db, dst, copies[db]["page_size"], previous.get(db), args.zstd
+                    ),
+                    databases,
+                ),
+            )
+        )
 
-    # 4) Filtered DBs
-    backup_filtered("main.db", "trip", "uid", valid, dst)
-    print()
-    backup_filtered("path.db", "paths", "trip_id", valid, dst)
-    print()
+    with open(dst / MANIFEST, "w") as f:
+        json.dump({"created": datetime.now().isoformat(), "databases": entries}, f)
 
-    print("✅ Backup complete!")
+    # 5) Report
+    for db_name, entry in entries.items():
+        pages = (
+            f"{entry['changed_pages']}/{entry['page_count']} pages changed"
+            if "base" in entry
+            else f"{entry['page_count']} pages"
+        )
+        print(
+            f"   {db_name}: {pages}, {format_size(entry['size'])} → "
+            f"{format_size(entry['stored_size'])} stored, copied in "
+            f"{copies[db_name]['seconds']:.1f}s"
+            + (
+                f" ({copies[db_name]['restarts']} restarts, then in one step)"
+                if copies[db_name]["restarts"] > MAX_RESTARTS
+                else ""
+            )
+            + f", stored in {entry['seconds']:.1f}s"
+        )
+    print(
+        f"\n✅ Backup complete in {time.perf_counter() - start:.1f}s: "
+        f"{format_size(sum(entry['size'] for entry in entries.values()))} of databases, "
+        f"{format_size(sum(entry['stored_size'] for entry in entries.values()))} stored"
+    )
 
 
 if __name__ == "__main__":
@@ -1,9 +1,34 @@
+"""
+Matomo tracking of the requests of a Flask app, adapted from flask_matomo2.
+
+Requests are not sent to Matomo while they are served: their tracking data is
+put in a bounded queue of the process, and a background thread sends it in
+batches with the bulk tracking API, retrying with an exponential backoff when
+Matomo fails. When Matomo is down for long enough that the queue fills up, the
+oldest requests are dropped. The queue depth and the drops of the process are
+reported by `Matomo.get_stats()`, added up across the workers by app.py for
+/admin/matomo_stats.
+
+The effect of a slow Matomo on the site is load-tested against a local stub of
+the bulk API, answering after a delay:
+
+    python -m py.flask_matomo --stub [port] [delay_ms]
+
+with `matomo.url` set to http://127.0.0.1:<port>/matomo.php.
+"""
+
+import atexit
 import json
 import logging
+import os
 import random
 import re
+import sys
+import threading
 import time
 import typing
+from collections import deque
+from urllib.parse import urlencode
 
 import flask
 import httpx
@@ -11,6 +36,10 @@ from flask import g, request
 
 logger = logging.getLogger("flask_matomo2")
 
+# longest wait between two tries of a batch, in seconds
+MAX_BACKOFF = 60
+
+
 class Matomo:
     """The Matomo object provides the central interface for interacting with Matomo.
 
@@ -28,6 +57,16 @@ class Matomo:
         url to the site that should be tracked
     ignored_patterns : str
         list of regexes to ignore. Default: None.
+    queue_size : int
+        requests waiting to be sent, beyond which the oldest are dropped
+    batch_size : int
+        requests sent to the bulk API at once
+    flush_interval : float
+        seconds a request waits at most for its batch to fill up
+    max_retries : int
+        tries of a failing batch after the first one, before it is dropped
+    retry_backoff : float
+        seconds before the first retry, doubled for each following one
     """
 
     def __init__(
@@ -43,6 +82,11 @@ class Matomo:
         routes_details: typing.Optional[typing.Dict[str, typing.Dict[str, str]]] = None,
         ignored_patterns: typing.Optional[typing.List[str]] = None,
         ignored_ua_patterns: typing.Optional[typing.List[str]] = None,
+        queue_size: int = 10000,
+        batch_size: int = 100,
+        flush_interval: float = 2.0,
+        max_retries: int = 5,
+        retry_backoff: float = 1.0,
     ):
         self.activate(
             app=app,
@@ -55,6 +99,11 @@ class Matomo:
             routes_details=routes_details,
             ignored_patterns=ignored_patterns,
             ignored_ua_patterns=ignored_ua_patterns,
+            queue_size=queue_size,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            max_retries=max_retries,
+            retry_backoff=retry_backoff,
         )
 
     @classmethod
@@ -74,6 +123,11 @@ class Matomo:
         routes_details: typing.Optional[typing.Dict[str, typing.Dict[str, str]]] = None,
         ignored_patterns: typing.Optional[typing.List[str]] = None,
         ignored_ua_patterns: typing.Optional[typing.List[str]] = None,
+        queue_size: int = 10000,
+        batch_size: int = 100,
+        flush_interval: float = 2.0,
+        max_retries: int = 5,
+        retry_backoff: float = 1.0,
     ):
         # Silence httpx request logging
         logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -97,6 +151,28 @@ class Matomo:
             self.ignored_patterns = [
                 re.compile(pattern) for pattern in ignored_patterns
             ]
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._queue = deque(maxlen=queue_size)
+        self._lock = threading.Lock()
+        self._batch_ready = threading.Condition(self._lock)
+        self._sender = None
+        self._sender_pid = None
+        self._stats = {
+            "queued": 0,
+            "sent": 0,
+            # requests refused by Matomo in batches it accepted
+            "invalid": 0,
+            # oldest requests dropped when the queue was full
+            "dropped": 0,
+            # requests of batches that still failed after all the retries
+            "failed": 0,
+            "batches": 0,
+            "retries": 0,
+            "last_batch_ms": None,
+        }
 
         if not matomo_url:
             raise ValueError("matomo_url has to be set")
@@ -111,6 +187,7 @@ class Matomo:
         app.before_request(self.before_request)
         app.after_request(self.after_request)
         app.teardown_request(self.teardown_request)
+        app.extensions["matomo"] = self
 
     def before_request(self):
         """Executed before every request, parses details about request"""
@@ -207,40 +284,134 @@ class Matomo:
         *,
         tracking_data: typing.Dict,
     ):
-        """Send request to Matomo
+        """Queue a request to be sent to Matomo by the background sender
 
         Parameters
         ----------
-        action_name : str
-            name of the site
-        url : str
-            url to track
-        user_agent : str
-            User-Agent of request
-        id : str
-            id of user
-        ip_address : str
-            ip address of request
-        lang : Optional[str]
-            The client's preferred language, defaults to None.
+        tracking_data : dict
+            parameters of the tracking API, cvar being a dict
         """
         if "cvar" in tracking_data:
             cvar = tracking_data.pop("cvar")
             tracking_data["cvar"] = json.dumps(cvar)
-        logger.debug("calling '%s' with '%s'", self.matomo_url, tracking_data)
-        try:
-            r = self.client.post(self.matomo_url, data=tracking_data)
-
-            if r.status_code >= 300:
-                logger.error(
-                    "Tracking call failed (status_code=%d)",
-                    r.status_code,
-                    extra={"status_code": r.status_code, "text": r.text},
-                )
-                # raise MatomoError(r.text)
-        except httpx.HTTPError as exc:
-            logger.exception("Tracking call failed:", extra={"exc": exc})
-            logger.exception(exc)
+        # the request is sent later, with the time it happened at
+        tracking_data["cdt"] = int(time.time())
+        # the token is given once per batch
+        tracking_data.pop("token_auth", None)
+        query = "?" + urlencode(
+            {
+                key: str(value)
+                for key, value in tracking_data.items()
+                if value is not None
+            }
+        )
+        logger.debug("queueing '%s'", query)
+        with self._lock:
+            if len(self._queue) == self._queue.maxlen:
+                self._stats["dropped"] += 1
+            self._queue.append(query)
+            self._stats["queued"] += 1
+            if len(self._queue) >= self.batch_size:
+                self._batch_ready.notify()
+            self._start_sender()
+
+    def _start_sender(self):
+        """Start the sender thread of this process, if needed (under _lock)"""
+        if (
+            self._sender is None
+            or self._sender_pid != os.getpid()
+            or not self._sender.is_alive()
+        ):
+            if self._sender_pid != os.getpid():
+                atexit.register(self.flush)
+            self._sender = threading.Thread(
+                target=self._run_sender, name="matomo-sender", daemon=True
+            )
+            self._sender_pid = os.getpid()
+            self._sender.start()
+
+    def _run_sender(self):
+        while True:
+            with self._lock:
+                if len(self._queue) < self.batch_size:
+                    self._batch_ready.wait(self.flush_interval)
+                batch = self._take_batch()
+            if batch:
+                self._send_batch(batch)
+
+    def _take_batch(self):
+        """Oldest queued requests, up to a batch (under _lock)"""
+        return [
+            self._queue.popleft() for _ in range(min(len(self._queue), self.batch_size))
+        ]
+
+    def _send_batch(self, batch, retries=None):
+        """Send a batch with the bulk API, return whether Matomo accepted it"""
+        payload = {"requests": batch}
+        if self.token_auth:
+            payload["token_auth"] = self.token_auth
+        retries = self.max_retries if retries is None else retries
+        start = time.perf_counter()
+        for attempt in range(retries + 1):
+            if attempt:
+                backoff = min(self.retry_backoff * 2 ** (attempt - 1), MAX_BACKOFF)
+                with self._lock:
+                    self._stats["retries"] += 1
+                # jitter, so that the workers don't retry all at once
+                time.sleep(backoff * random.uniform(0.5, 1.5))
+            try:
+                r = self.client.post(self.matomo_url, json=payload)
+            except httpx.HTTPError as exc:
+                logger.warning(f"Tracking call failed: {exc!r}")
+                continue
+            if r.status_code < 300:
+                try:
+                    invalid = int(r.json().get("invalid", 0))
+                except ValueError:
+                    invalid = 0
+                with self._lock:
+                    self._stats["batches"] += 1
+                    self._stats["sent"] += len(batch) - invalid
+                    self._stats["invalid"] += invalid
+                    self._stats["last_batch_ms"] = round(
+                        (time.perf_counter() - start) * 1000, 1
+                    )
+                return True
+            logger.warning(
+                "Tracking call failed (status_code=%d)",
+                r.status_code,
+                extra={"status_code": r.status_code, "text": r.text},
+            )
+            if r.status_code < 500 and r.status_code != 429:
+                # the same batch would be refused again
+                break
+        logger.error(f"Dropping {len(batch)} tracked requests after {attempt} retries")
+        with self._lock:
+            self._stats["failed"] += len(batch)
+        return False
+
+    def flush(self, retries=0):
+        """Send the queued requests now, from the calling thread (at exit)"""
+        while True:
+            with self._lock:
+                batch = self._take_batch()
+            if not batch:
+                return
+            self._send_batch(batch, retries)
+
+    def get_stats(self):
+        """Queue depth and counts of the sent and dropped requests of the process"""
+        with self._lock:
+            return {
+                **self._stats,
+                "queue_depth": len(self._queue),
+                "queue_size": self._queue.maxlen,
+                "senders_alive": int(
+                    self._sender is not None
+                    and self._sender_pid == os.getpid()
+                    and self._sender.is_alive()
+                ),
+            }
 
     def ignore(self, route: typing.Optional[str] = None):
         """Ignore a route and don't track it.
@@ -300,3 +471,36 @@ class Matomo:
             return f
 
         return wrap
+
+
+def run_stub(port=8765, delay_ms=200):
+    """
+    Stub of the Matomo bulk API, answering after `delay_ms`, to load-test the
+    site with a slow Matomo
+    """
+    from flask import Flask, jsonify
+
+    stub = Flask("matomo_stub")
+    received = {"batches": 0, "requests": 0}
+
+    @stub.route("/matomo.php", methods=["GET", "POST"])
+    def bulk():
+        time.sleep(delay_ms / 1000)
+        requests = (request.get_json(silent=True) or {}).get("requests", [None])
+        received["batches"] += 1
+        received["requests"] += len(requests)
+        return jsonify(status="success", tracked=len(requests), invalid=0)
+
+    @stub.route("/stats")
+    def stats():
+        return jsonify(received)
+
+    stub.run(port=port, threaded=True)
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if "--stub" in sys.argv:
+        run_stub(
+            int(args[0]) if args else 8765, float(args[1]) if len(args) > 1 else 200
+        )
@@ -0,0 +1,143 @@
+"""
+Vectorized geometry helpers working on [lng, lat] coordinates with NumPy
+"""
+
+import numpy as np
+import shapely
+
+EARTH_RADIUS = 6371000
+
+
+def haversine_distances(coords1, coords2):
+    """
+    Element-wise great circle distance in meters between two arrays of
+    [lng, lat] coordinates of the same shape
+    """
+    coords1 = np.radians(np.asarray(coords1, dtype=float))
+    coords2 = np.radians(np.asarray(coords2, dtype=float))
+    lon1, lat1 = coords1[..., 0], coords1[..., 1]
+    lon2, lat2 = coords2[..., 0], coords2[..., 1]
+
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    return EARTH_RADIUS * c
+
+
+def path_length(coords):
+    """Length in meters of a path given as a list of [lng, lat]"""
+    if len(coords) < 2:
+        return 0
+    coords = np.asarray(coords, dtype=float)
+    return float(haversine_distances(coords[:-1], coords[1:]).sum())
+
+
+def project_on_polyline(points, line):
+    """
+    Nearest point of `line` for each of the points, computed in the (lng, lat)
+    plane like shapely's `line.interpolate(line.project(point))`.
+    The nearest segment of each point is found through an STRtree, then all the
+    points are projected on their segment at once.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    line = np.asarray(line, dtype=float).reshape(-1, 2)
+
+    if len(line) == 1:
+        return np.repeat(line, len(points), axis=0)
+
+    starts = line[:-1]
+    ends = line[1:]
+    tree = shapely.STRtree(shapely.linestrings(np.stack([starts, ends], axis=1)))
+    point_indices, segment_indices = tree.query_nearest(shapely.points(points))
+
+    a = starts[segment_indices]
+    ab = ends[segment_indices] - a
+    ap = points[point_indices] - a
+    squared_lengths = (ab**2).sum(axis=1)
+    # position of the projection on the segment, clamped to the segment
+    t = np.divide(
+        (ap * ab).sum(axis=1),
+        squared_lengths,
+        out=np.zeros(len(a)),
+        where=squared_lengths > 0,
+    ).clip(0.0, 1.0)
+
+    projections = np.empty_like(points)
+    projections[point_indices] = a + t[:, None] * ab
+    return projections
+
+
+def distances_to_polyline(points, line):
+    """
+    Great circle distance in meters between each point and its projection on `line`
+    """
+    if len(points) == 0:
+        return np.empty(0)
+    points = np.asarray(points, dtype=float)
+    return haversine_distances(points, project_on_polyline(points, line))
+
+
+def all_within_distance(points, line, threshold):
+    """True if every point lies within `threshold` meters of `line`"""
+    return bool((distances_to_polyline(points, line) <= threshold).all())
+
+
+if __name__ == "__main__":
+    # Benchmark against the shapely/pure Python implementation used by the GPS
+    # cleaner on multi-thousand points tracks: python -m py.geometry
+    import math
+    import time
+
+    from shapely.geometry import LineString, Point
+
+    def haversine_distance(point1, point2):
+        R = 6371000
+        lat1, lon1 = math.radians(point1[1]), math.radians(point1[0])
+        lat2, lon2 = math.radians(point2[1]), math.radians(point2[0])
+        dlat = lat2 - lat1
+        dlon = lon2 - lon1
+        a = (
+            math.sin(dlat / 2) ** 2
+            + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+        )
+        return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+    def reference_distances(route_coords, points):
+        line = LineString(route_coords)
+        distances = []
+        for p_coords in points:
+            projected = line.interpolate(line.project(Point(p_coords)))
+            distances.append(haversine_distance(p_coords, [projected.x, projected.y]))
+        return distances
+
+    rng = np.random.default_rng(0)
+    for n_points, n_route in ((1000, 500), (5000, 2000), (20000, 5000)):
+        angles = np.linspace(0, math.pi, n_route)
+        route = np.column_stack([6 + 0.5 * np.cos(angles), 46 + 0.5 * np.sin(angles)])
+        angles = np.linspace(0, math.pi, n_points)
+        track = np.column_stack([6 + 0.5 * np.cos(angles), 46 + 0.5 * np.sin(angles)])
+        track += rng.normal(scale=0.002, size=track.shape)
+
+        start = time.perf_counter()
+        expected = reference_distances(route.tolist(), track.tolist())
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        distances = distances_to_polyline(track, route)
+        vectorized_time = time.perf_counter() - start
+
+        for threshold in (50, 100, 200, 400, 800):
+            assert (np.array(expected) > threshold).tolist() == (
+                distances > threshold
+            ).tolist()
+        assert math.isclose(
+            path_length(route),
+            sum(haversine_distance(a, b) for a, b in zip(route[:-1], route[1:])),
+        )
+        print(
+            f"{n_points} points / {n_route} route coords: shapely {reference_time:.3f}s, "
+            f"numpy {vectorized_time:.3f}s, max diff {np.abs(distances - expected).max():.2e}m"
+        )
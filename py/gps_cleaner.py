@@ -1,20 +1,38 @@
 import json
 import math
-from shapely.geometry import LineString, Point
+from concurrent.futures import ThreadPoolExecutor
+
 import polyline
 from flask.wrappers import Response
 
-def clean_gps_route(raw_waypoints, forwardRouting, trip_type="train", deviation_threshold=500, max_search_points=50):
+from py.geometry import all_within_distance, path_length
+
+
+def clean_gps_route(
+    raw_waypoints,
+    forwardRouting,
+    trip_type="train",
+    deviation_threshold=500,
+    max_search_points=50,
+    parallel_probes=4,
+    progress_callback=None,
+):
     """
     A much faster version of the cleaning algorithm using an exponential/binary search 
     to drastically reduce network calls.
+
+    Every probe (anchor, candidate) is routed at most once, and the probes of the
+    exponential search are sent to the router `parallel_probes` at a time.
     
     Args:
         raw_waypoints: List of raw GPS points [{'lat': y, 'lng': x}].
-        forwardRouting: The function to call the routing engine.
+        forwardRouting: The function to call the routing engine. It must be callable
+            from any thread.
         trip_type: Type of trip, e.g., "train", "car".
         deviation_threshold: Max distance (meters) a raw GPS point can be from a candidate route segment.
         max_search_points: DEPRECATED - No longer used in optimized version, kept for backward compatibility.
+        parallel_probes: Number of exponential search probes routed concurrently.
+        progress_callback: Optional function called with the completion percentage.
     """
     if len(raw_waypoints) < 2:
         return {"success": False, "error": "Need at least 2 waypoints"}
@@ -28,68 +46,85 @@ def clean_gps_route(raw_waypoints, forwardRouting, trip_type="train", deviation_
     
     last_anchor_idx = 0
     segment_counter = 0
-    
-    while last_anchor_idx < total_points - 1:
-        segment_counter += 1
-        percent_complete = (last_anchor_idx / (total_points - 1)) * 100
-        print(f"Processing segment {segment_counter} ({last_anchor_idx}/{total_points - 1}) [{percent_complete:.1f}% complete]")
-
-        start_point = [raw_waypoints[last_anchor_idx]["lng"], raw_waypoints[last_anchor_idx]["lat"]]
-        
-        lower_bound_idx = last_anchor_idx
-        upper_bound_idx = -1
-        probe_step = 1
-        
-        while True:
-            probe_idx = last_anchor_idx + probe_step
-            if probe_idx >= total_points:
-                upper_bound_idx = total_points - 1
-                break
-
-            probe_point = [raw_waypoints[probe_idx]["lng"], raw_waypoints[probe_idx]["lat"]]
-            segment_coords = get_route_via_forward_routing(
-                forwardRouting, router_type, [start_point, probe_point], trip_type=trip_type
-            )
-            intermediate_gps = [[wp["lng"], wp["lat"]] for wp in raw_waypoints[last_anchor_idx + 1 : probe_idx]]
-
-            if not segment_coords or not validate_segment(segment_coords, intermediate_gps, deviation_threshold):
-                upper_bound_idx = probe_idx
-                break
-            else:
-                lower_bound_idx = probe_idx
-                probe_step *= 2
-
-        best_next_idx = lower_bound_idx
-        while lower_bound_idx <= upper_bound_idx:
-            mid_idx = (lower_bound_idx + upper_bound_idx) // 2
-            if mid_idx <= last_anchor_idx:
-                break
-
-            candidate_point = [raw_waypoints[mid_idx]["lng"], raw_waypoints[mid_idx]["lat"]]
-            segment_coords = get_route_via_forward_routing(
-                forwardRouting, router_type, [start_point, candidate_point], trip_type=trip_type
-            )
-            intermediate_gps = [[wp["lng"], wp["lat"]] for wp in raw_waypoints[last_anchor_idx + 1 : mid_idx]]
-
-            if segment_coords and validate_segment(segment_coords, intermediate_gps, deviation_threshold):
-                best_next_idx = mid_idx
-                lower_bound_idx = mid_idx + 1
-            else:
-                upper_bound_idx = mid_idx - 1
-
-        if best_next_idx <= last_anchor_idx:
-            print(f"[WARNING] Could not find a valid route segment from point {last_anchor_idx}. Skipping.")
-            last_anchor_idx += 1
-            continue
-
-        final_segment_point = [raw_waypoints[best_next_idx]["lng"], raw_waypoints[best_next_idx]["lat"]]
-        final_segment_coords = get_route_via_forward_routing(
-            forwardRouting, router_type, [start_point, final_segment_point], trip_type=trip_type
+
+    # (anchor_idx, candidate_idx) -> route coords if the segment is valid, else None
+    probes = {}
+
+    def probe_segment(anchor_idx, candidate_idx):
+        start_point = [raw_waypoints[anchor_idx]["lng"], raw_waypoints[anchor_idx]["lat"]]
+        candidate_point = [raw_waypoints[candidate_idx]["lng"], raw_waypoints[candidate_idx]["lat"]]
+        segment_coords = get_route_via_forward_routing(
+            forwardRouting, router_type, [start_point, candidate_point], trip_type=trip_type
         )
+        intermediate_gps = [[wp["lng"], wp["lat"]] for wp in raw_waypoints[anchor_idx + 1 : candidate_idx]]
+
+        if segment_coords and validate_segment(segment_coords, intermediate_gps, deviation_threshold):
+            return segment_coords
+        return None
+
+    def run_probes(anchor_idx, candidate_indices):
+        missing = [idx for idx in candidate_indices if (anchor_idx, idx) not in probes]
+        if len(missing) == 1:
+            probes[(anchor_idx, missing[0])] = probe_segment(anchor_idx, missing[0])
+        elif missing:
+            results = executor.map(lambda idx: probe_segment(anchor_idx, idx), missing)
+            for idx, segment_coords in zip(missing, results):
+                probes[(anchor_idx, idx)] = segment_coords
+        return [probes[(anchor_idx, idx)] for idx in candidate_indices]
+
+    with ThreadPoolExecutor(max_workers=max(parallel_probes, 1)) as executor:
+        while last_anchor_idx < total_points - 1:
+            segment_counter += 1
+            percent_complete = (last_anchor_idx / (total_points - 1)) * 100
+            print(f"Processing segment {segment_counter} ({last_anchor_idx}/{total_points - 1}) [{percent_complete:.1f}% complete]")
+            if progress_callback:
+                progress_callback(percent_complete)
+
+            lower_bound_idx = last_anchor_idx
+            upper_bound_idx = -1
+            probe_step = 1
+
+            # Exponential search, probing the next `parallel_probes` steps at once
+            while upper_bound_idx == -1:
+                probe_indices = []
+                while len(probe_indices) < parallel_probes and last_anchor_idx + probe_step < total_points:
+                    probe_indices.append(last_anchor_idx + probe_step)
+                    probe_step *= 2
+
+                if not probe_indices:
+                    upper_bound_idx = total_points - 1
+                    break
+
+                for probe_idx, segment_coords in zip(probe_indices, run_probes(last_anchor_idx, probe_indices)):
+                    if segment_coords is None:
+                        upper_bound_idx = probe_idx
+                        break
+                    lower_bound_idx = probe_idx
+
+            best_next_idx = lower_bound_idx
+            while lower_bound_idx <= upper_bound_idx:
+                mid_idx = (lower_bound_idx + upper_bound_idx) // 2
+                if mid_idx <= last_anchor_idx:
+                    break
+
+                if run_probes(last_anchor_idx, [mid_idx])[0] is not None:
+                    best_next_idx = mid_idx
+                    lower_bound_idx = mid_idx + 1
+                else:
+                    upper_bound_idx = mid_idx - 1
 
-        final_route_coords.extend(final_segment_coords[:-1])
-        key_waypoints_coords.append(final_segment_point)
-        last_anchor_idx = best_next_idx
+            if best_next_idx <= last_anchor_idx:
+                print(f"[WARNING] Could not find a valid route segment from point {last_anchor_idx}. Skipping.")
+                last_anchor_idx += 1
+                continue
+
+            # the segment was validated during the search, no need to route it again
+            final_segment_point = [raw_waypoints[best_next_idx]["lng"], raw_waypoints[best_next_idx]["lat"]]
+            final_segment_coords = probes[(last_anchor_idx, best_next_idx)]
+
+            final_route_coords.extend(final_segment_coords[:-1])
+            key_waypoints_coords.append(final_segment_point)
+            last_anchor_idx = best_next_idx
 
     final_route_coords.append(key_waypoints_coords[-1])
     
@@ -98,6 +133,8 @@ def clean_gps_route(raw_waypoints, forwardRouting, trip_type="train", deviation_
     key_waypoints = [{"lat": wp[1], "lng": wp[0]} for wp in key_waypoints_coords]
 
     print("✅ Route cleaning completed: 100%")
+    if progress_callback:
+        progress_callback(100)
     return {
         "success": True, 
         "waypoints": key_waypoints, 
@@ -117,17 +154,7 @@ def validate_segment(route_coords, intermediate_points, threshold):
     if not intermediate_points:
         return True
 
-    line = LineString(route_coords)
-    for p_coords in intermediate_points:
-        p = Point(p_coords)
-        distance = p.distance(line)
-
-        projected_point = line.interpolate(line.project(p))
-        real_distance = haversine_distance(p_coords, [projected_point.x, projected_point.y])
-
-        if real_distance > threshold:
-            return False
-    return True
+    return all_within_distance(intermediate_points, route_coords, threshold)
 
 
 def get_router_type(trip_type):
@@ -187,9 +214,64 @@ def haversine_distance(point1, point2):
 
 
 def calculate_path_distance_coords(coords):
-    if len(coords) < 2:
-        return 0
-    total_distance = 0
-    for i in range(len(coords) - 1):
-        total_distance += haversine_distance(coords[i], coords[i+1])
-    return total_distance
+    return path_length(coords)
+
+
+if __name__ == "__main__":
+    # Benchmark against a mock OSRM server answering straight lines after a delay:
+    #   python -m py.gps_cleaner [points] [latency_ms]
+    import sys
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import requests
+
+    points = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = (int(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+
+    class MockOSRM(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            coordinates = self.path.split("?")[0].rsplit("/", 1)[-1].split(";")
+            line = [tuple(reversed([float(c) for c in pair.split(",")])) for pair in coordinates]
+            body = json.dumps({"code": "Ok", "routes": [{"geometry": polyline.encode(line)}]})
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body.encode("utf-8"))
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockOSRM)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    session = requests.Session()
+    calls = 0
+
+    def mock_forward_routing(path, routingType, args=None):
+        global calls
+        calls += 1
+        return session.get(f"{base_url}/{path}?{args}").text
+
+    # a track slowly turning on itself, so that straight segments eventually deviate
+    track = [
+        {
+            "lat": 46.0 + 0.05 * math.sin(i / points * 2 * math.pi),
+            "lng": 6.0 + 0.05 * math.cos(i / points * 2 * math.pi),
+        }
+        for i in range(points)
+    ]
+
+    for parallel_probes in (1, 4, 8):
+        calls = 0
+        start = time.perf_counter()
+        result = clean_gps_route(
+            track, mock_forward_routing, deviation_threshold=50, parallel_probes=parallel_probes
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            f"parallel_probes={parallel_probes}: {elapsed:.2f}s, {calls} router calls, "
+            f"{len(result['waypoints'])} waypoints, {result['distance']:.0f}m"
+        )
+    server.shutdown()
@@ -0,0 +1,234 @@
+"""
+Reduce raw GPS tracks (often one point per second) to the points that matter,
+before they are stored, clustered or routed.
+"""
+
+import math
+from datetime import datetime
+
+import numpy as np
+
+EARTH_RADIUS = 6371000
+
+
+def _to_local_meters(latlngs):
+    """
+    Equirectangular projection of [lat, lng] points around their mean latitude,
+    precise enough for the tolerances used here
+    """
+    lat = np.radians(latlngs[:, 0])
+    # unwrap longitudes so that tracks crossing the antimeridian stay continuous
+    lng = np.unwrap(np.radians(latlngs[:, 1]))
+    x = EARTH_RADIUS * lng * np.cos(lat.mean())
+    y = EARTH_RADIUS * lat
+    return np.column_stack([x, y])
+
+
+def _find_outliers(xy, seconds, spike_distance, max_speed):
+    """
+    A point is an outlier if it is far from both its neighbours while they are
+    close to each other (a spike), or if reaching it and leaving it both require
+    an impossible speed
+    """
+    outliers = np.zeros(len(xy), dtype=bool)
+    if len(xy) < 3:
+        return outliers
+
+    before = np.hypot(*(xy[1:-1] - xy[:-2]).T)
+    after = np.hypot(*(xy[2:] - xy[1:-1]).T)
+    shortcut = np.hypot(*(xy[2:] - xy[:-2]).T)
+
+    spikes = (
+        (before > spike_distance)
+        & (after > spike_distance)
+        & (before + after > 4 * np.maximum(shortcut, 1))
+    )
+
+    if seconds is not None:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            speed_before = before / np.diff(seconds[:-1])
+            speed_after = after / np.diff(seconds[1:])
+        spikes |= (speed_before > max_speed) & (speed_after > max_speed)
+
+    outliers[1:-1] = spikes
+    return outliers
+
+
+def _find_stops(xy, seconds, stop_radius, stop_min_duration, max_time_gap):
+    """
+    Return the (first, last) indices of the stationary stops: runs of points staying
+    within `stop_radius` of the first one for at least `stop_min_duration` seconds.
+    A stop ends at a gap longer than `max_time_gap`, so that the points around gaps
+    are never inside a stop.
+    """
+    # plain floats: this loop runs once per point, numpy scalars would slow it down
+    xy = xy.tolist()
+    stops = []
+    i = 0
+    while i < len(xy) - 1:
+        j = i
+        x0, y0 = xy[i]
+        while (
+            j + 1 < len(xy)
+            and seconds[j + 1] - seconds[j] <= max_time_gap
+            and math.hypot(xy[j + 1][0] - x0, xy[j + 1][1] - y0) <= stop_radius
+        ):
+            j += 1
+        if j > i and seconds[j] - seconds[i] >= stop_min_duration:
+            stops.append((i, j))
+        i = j + 1 if j > i else i + 1
+    return stops
+
+
+def _douglas_peucker(xy, tolerance):
+    """Indices of the points kept by the Douglas-Peucker algorithm"""
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[0] = keep[-1] = True
+    ranges = [(0, len(xy) - 1)]
+    while ranges:
+        start, end = ranges.pop()
+        if end - start < 2:
+            continue
+        a, b = xy[start], xy[end]
+        points = xy[start + 1 : end]
+        ab = b - a
+        length = np.hypot(*ab)
+        if length == 0:
+            distances = np.hypot(*(points - a).T)
+        else:
+            distances = (
+                np.abs(ab[0] * (points[:, 1] - a[1]) - ab[1] * (points[:, 0] - a[0]))
+                / length
+            )
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            ranges.append((start, index))
+            ranges.append((index, end))
+    return np.flatnonzero(keep)
+
+
+def simplify_track(
+    latlngs,
+    times=None,
+    tolerance=10,
+    stop_radius=30,
+    stop_min_duration=120,
+    spike_distance=500,
+    max_speed=340,
+    max_time_gap=300,
+):
+    """
+    Select the meaningful points of a GPS track.
+
+    Runs, in that order:
+      - outlier removal (spikes, and impossible speeds when times are known)
+      - stationary stop detection (only when times are known): only the first and
+        last points of each stop are kept
+      - Douglas-Peucker decimation with a `tolerance` in meters. Points around
+        gaps longer than `max_time_gap` seconds are always kept.
+
+    Args:
+        latlngs: list of [lat, lng]
+        times: optional list of datetimes (or None), or array of seconds (or NaN),
+            matching `latlngs`. Ignored if any time is missing.
+
+    Return a tuple (indices, stats) where `indices` are the indices of the kept
+    points in `latlngs`, in order, and `stats` counts the dropped points.
+    """
+    count = len(latlngs)
+    stats = {
+        "input": count,
+        "outliers": 0,
+        "stops": 0,
+        "stop_points": 0,
+        "simplified": 0,
+    }
+    if count < 3:
+        stats["output"] = count
+        return list(range(count)), stats
+
+    xy = _to_local_meters(np.asarray(latlngs, dtype=float))
+    seconds = None
+    if times is not None and len(times) and isinstance(times[0], datetime):
+        if all(t is not None for t in times):
+            seconds = np.array([(t - times[0]).total_seconds() for t in times])
+    elif times is not None:
+        seconds = np.asarray(times, dtype=float)
+        if np.isnan(seconds).any():
+            seconds = None
+
+    indices = np.flatnonzero(~_find_outliers(xy, seconds, spike_distance, max_speed))
+    stats["outliers"] = count - len(indices)
+
+    # points that Douglas-Peucker must keep
+    fixed = {0, len(indices) - 1}
+    if seconds is not None:
+        kept_seconds = seconds[indices]
+        for gap in np.flatnonzero(np.diff(kept_seconds) > max_time_gap):
+            fixed.update((int(gap), int(gap) + 1))
+
+        # stops end at gaps, the points around gaps are first or last points of
+        # stops at most
+        stops = _find_stops(
+            xy[indices], kept_seconds, stop_radius, stop_min_duration, max_time_gap
+        )
+        stationary = np.zeros(len(indices), dtype=bool)
+        for first, last in stops:
+            stationary[first + 1 : last] = True
+            fixed.update((first, last))
+        stats["stops"] = len(stops)
+        stats["stop_points"] = int(stationary.sum())
+
+        remaining = np.flatnonzero(~stationary)
+        positions = {index: position for position, index in enumerate(remaining)}
+        fixed = {positions[index] for index in fixed}
+        indices = indices[remaining]
+
+    # run Douglas-Peucker between each pair of consecutive fixed points
+    track_xy = xy[indices]
+    kept = set()
+    fixed = sorted(fixed)
+    for start, end in zip(fixed[:-1], fixed[1:]):
+        kept.update(
+            start + i for i in _douglas_peucker(track_xy[start : end + 1], tolerance)
+        )
+    kept = sorted(kept)
+
+    stats["simplified"] = len(indices) - len(kept)
+    stats["output"] = len(kept)
+    return indices[kept].tolist(), stats
+
+
+if __name__ == "__main__":
+    # Simplify a synthetic one point per second track: python -m py.gps_preprocessing
+    import time
+    from datetime import timedelta
+
+    from py.geometry import path_length
+
+    rng = np.random.default_rng(0)
+    seconds = 4 * 3600
+    t = np.arange(seconds)
+    # 30 m/s along a winding line, with a 10 minutes stop and GPS noise
+    moving = np.where((t > 3600) & (t < 4200), 3600, np.where(t >= 4200, t - 600, t))
+    lat = 46 + moving * 30 / 111_000 * 0.7 + 0.01 * np.sin(moving / 600)
+    lng = 6 + moving * 30 / 77_000 * 0.7 + 0.01 * np.cos(moving / 900)
+    latlngs = np.column_stack([lat, lng]) + rng.normal(scale=0.00003, size=(seconds, 2))
+    latlngs[5000] += 0.05  # one outlier
+    times = [datetime(2025, 1, 1) + timedelta(seconds=int(s)) for s in t]
+
+    start = time.perf_counter()
+    indices, stats = simplify_track(latlngs.tolist(), times)
+    elapsed = time.perf_counter() - start
+    print(f"{elapsed:.2f}s: {stats}")
+
+    def length(points):
+        return path_length([[p[1], p[0]] for p in points])
+
+    clean = np.delete(latlngs, 5000, axis=0)
+    smooth = np.column_stack([lat, lng])
+    print(f"raw length {length(clean) / 1000:.1f} km (noise included)")
+    print(f"noise-free length {length(smooth) / 1000:.1f} km")
+    print(f"simplified length {length(latlngs[indices]) / 1000:.1f} km")
@@ -0,0 +1,250 @@
+"""
+Streaming GPX reader: points are read with `iterparse` and handed over one
+segment at a time as NumPy arrays, so the XML tree is never built in memory.
+"""
+
+import multiprocessing
+import os
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from xml.etree.ElementTree import iterparse
+
+import numpy as np
+
+from py.geometry import haversine_distances, path_length
+from py.gps_preprocessing import simplify_track
+
+GPX_WORKERS = min(4, os.cpu_count() or 1)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _local_name(tag):
+    # "{http://www.topografix.com/GPX/1/1}trkpt" -> "trkpt"
+    return tag.rpartition("}")[2]
+
+
+def _parse_time(text):
+    """Epoch seconds of a GPX time, naive times being read as UTC, NaN if invalid"""
+    try:
+        parsed = datetime.fromisoformat(text.strip())
+    except (AttributeError, ValueError):
+        return float("nan")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def iter_gpx_segments(source):
+    """
+    Yield a tuple (kind, latlngs, seconds) for each track segment ("track") and
+    route ("route") of a GPX file, where `latlngs` is an (n, 2) array of
+    [lat, lng] and `seconds` an array of epoch seconds (NaN when unknown).
+
+    `source` is a filename or a binary file object. Points are removed from the
+    tree as soon as they are read, memory only grows with the current segment.
+    """
+    containers = []
+    lats, lngs, seconds = array("d"), array("d"), array("d")
+    point_time = float("nan")
+
+    for event, elem in iterparse(source, events=("start", "end")):
+        name = _local_name(elem.tag)
+        if event == "start":
+            if name in ("trkseg", "rte"):
+                containers.append(elem)
+                lats, lngs, seconds = array("d"), array("d"), array("d")
+            elif name in ("trkpt", "rtept"):
+                point_time = float("nan")
+            continue
+
+        if name == "time" and containers:
+            point_time = _parse_time(elem.text)
+        elif name in ("trkpt", "rtept") and containers:
+            lats.append(float(elem.get("lat")))
+            lngs.append(float(elem.get("lon")))
+            seconds.append(point_time)
+            elem.clear()
+            containers[-1].remove(elem)
+        elif name in ("trkseg", "rte"):
+            containers.pop()
+            elem.clear()
+            latlngs = np.column_stack(
+                [np.frombuffer(lats, dtype=float), np.frombuffer(lngs, dtype=float)]
+            )
+            yield (
+                "track" if name == "trkseg" else "route",
+                latlngs,
+                np.frombuffer(seconds, dtype=float),
+            )
+
+
+def _to_datetime(seconds):
+    if np.isnan(seconds):
+        return None
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+
+def read_gpx(source, simplify=False, **simplify_options):
+    """
+    Summary of a GPX file, with the same rules as the former gpxpy based import:
+    all the track segments are joined, or the first route is used if there is
+    no track point. With `simplify`, each segment is simplified (see
+    `simplify_track`) as soon as it is read, which is lossy. The distance is
+    always computed on the raw points.
+
+    Return a dict with "points" ([lat, lng], all of them unless simplified),
+    "start"/"end" (first and last raw points), "start_time"/"end_time" (UTC
+    datetimes or None), "distance" in meters and "simplification" (dropped
+    points counts, empty unless simplified), or None if the file has no point.
+    """
+    points = []
+    distance = 0
+    stats = {}
+    start = end = None
+    start_time = end_time = None
+    route = None
+
+    for kind, latlngs, seconds in iter_gpx_segments(source):
+        if not len(latlngs):
+            continue
+        if kind == "route":
+            if route is None:
+                route = (latlngs.copy(), seconds.copy())
+            continue
+
+        if start is None:
+            start = latlngs[0]
+            start_time = _to_datetime(seconds[0])
+        elif start_time is None:
+            # like before, the start time is the first one that is known
+            start_time = _to_datetime(seconds[0])
+        # the distance includes the gaps between segments
+        if end is not None:
+            distance += float(haversine_distances(end[::-1], latlngs[0][::-1]))
+        end = latlngs[-1]
+        end_time = _to_datetime(seconds[-1])
+
+        distance += path_length(latlngs[:, ::-1])
+        if not simplify:
+            points.extend(latlngs.tolist())
+            continue
+        kept, segment_stats = simplify_track(latlngs, seconds, **simplify_options)
+        points.extend(latlngs[kept].tolist())
+        for key, value in segment_stats.items():
+            stats[key] = stats.get(key, 0) + value
+
+    if start is None and route is not None:
+        # routes usually don't have times, they are ignored like before
+        latlngs, _ = route
+        start, end = latlngs[0], latlngs[-1]
+        distance = path_length(latlngs[:, ::-1])
+        if simplify:
+            kept, stats = simplify_track(latlngs, **simplify_options)
+            points = latlngs[kept].tolist()
+        else:
+            points = latlngs.tolist()
+
+    if start is None:
+        return None
+
+    return {
+        "points": points,
+        "start": start.tolist(),
+        "end": end.tolist(),
+        "start_time": start_time,
+        "end_time": end_time,
+        "distance": distance,
+        "simplification": stats,
+    }
+
+
+def _get_executor():
+    """
+    Process pool used to read several files at once, created once per process.
+    Processes are spawned rather than forked, as the web workers hold database
+    connections and threads.
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(
+                max_workers=GPX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _executor_pid = os.getpid()
+    return _executor
+
+
+def read_gpx_files(filenames, simplify=False):
+    """
+    `read_gpx` for each file, in parallel when there are several files.
+    Results are in the same order as `filenames`.
+    """
+    read = partial(read_gpx, simplify=simplify)
+    if len(filenames) < 2:
+        return [read(filename) for filename in filenames]
+    return list(_get_executor().map(read, filenames))
+
+
+if __name__ == "__main__":
+    # Peak memory and time of the gpxpy import vs the streaming reader, each in
+    # its own process: python -m py.gpx_reader [size_mb]
+    import resource
+    import subprocess
+    import sys
+    import tempfile
+    import time
+
+    if len(sys.argv) > 2 and sys.argv[1] == "--run":
+        mode, filename = sys.argv[2], sys.argv[3]
+        start = time.perf_counter()
+        if mode == "gpxpy":
+            import gpxpy
+
+            with open(filename) as f:
+                gpx = gpxpy.parse(f)
+            points = [p for t in gpx.tracks for s in t.segments for p in s.points]
+            path = [[p.latitude, p.longitude] for p in points]
+            count = len(path)
+        else:
+            count = len(read_gpx(filename)["points"])
+        elapsed = time.perf_counter() - start
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"{mode:>9}: {elapsed:6.2f}s, peak RSS {rss:7.1f} MB, {count} points")
+        sys.exit()
+
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with tempfile.NamedTemporaryFile("w", suffix=".gpx", delete=False) as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx version="1.1" creator="benchmark" '
+            'xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>\n'
+        )
+        rng = np.random.default_rng(0)
+        i = 0
+        while f.tell() < size_mb * 1024 * 1024:
+            lat = 46 + i * 0.0002 + 0.01 * np.sin(i / 600) + rng.normal(scale=3e-5)
+            lng = 6 + i * 0.0003 + 0.01 * np.cos(i / 900) + rng.normal(scale=3e-5)
+            f.write(
+                f'<trkpt lat="{lat:.7f}" lon="{lng:.7f}"><ele>{400 + i % 50}</ele>'
+                f"<time>{datetime.fromtimestamp(1.7e9 + i, timezone.utc):%Y-%m-%dT%H:%M:%SZ}</time>"
+                "</trkpt>\n"
+            )
+            i += 1
+        f.write("</trkseg></trk></gpx>\n")
+    print(f"{os.path.getsize(f.name) / 1024 / 1024:.0f} MB, {i} points")
+
+    try:
+        for mode in ("gpxpy", "streaming"):
+            subprocess.run(
+                [sys.executable, "-m", "py.gpx_reader", "--run", mode, f.name],
+                check=True,
+            )
+    finally:
+        os.remove(f.name)
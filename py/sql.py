@@ -63,6 +63,7 @@ leaderboardStats = open("sql/stats/leaderboardStats.sql", "r").read()
 typeAvailable = open("sql/stats/typeAvailable.sql", "r").read()
 getManualStationsQuery = open("sql/getManualStations.sql", "r").read()
 getCurrentTrip = open("sql/getCurrentTrip.sql", "r").read()
+getCurrentTripState = open("sql/getCurrentTripState.sql", "r").read()
 getAirports = open("sql/getAirports.sql", "r").read()
 getTrainStations = open("sql/getTrainStations.sql", "r").read()
 getDuplicate = open("sql/getDuplicate.sql", "r").read()
@@ -0,0 +1,118 @@
+from functools import lru_cache
+
+from py.utils import remove_accents
+
+
+@lru_cache(maxsize=8192)
+def normalize(text):
+    """Lowercase and remove accents for better similarity detection."""
+    return remove_accents(text.lower())
+
+
+def longest_common_substring(s1, s2):
+    """
+    Length of the longest common substring of s1 and s2.
+
+    Classic O(len(s1) * len(s2)) dynamic programming, but only the previous and
+    current rows of the table are kept, and the row is sized on the shorter string.
+    """
+    if len(s2) > len(s1):
+        s1, s2 = s2, s1
+    if not s2:
+        return 0
+
+    longest = 0
+    previous = [0] * (len(s2) + 1)
+    for c1 in s1:
+        current = [0] * (len(s2) + 1)
+        for y, c2 in enumerate(s2, 1):
+            if c1 == c2:
+                length = previous[y - 1] + 1
+                current[y] = length
+                if length > longest:
+                    longest = length
+        previous = current
+    return longest
+
+
+def _similarity(a, b):
+    # a and b must already be normalized
+    if set(a).isdisjoint(b):
+        lcs_val = 0
+    else:
+        lcs_val = longest_common_substring(a, b)
+
+    ratioA = lcs_val / len(a)
+    ratioB = lcs_val / len(b)
+
+    combined = (ratioA + ratioB) / 2.0
+
+    return combined * 100.0
+
+
+def stringSimmilarity(a, b):
+    return _similarity(normalize(a), normalize(b))
+
+
+def stringSimmilarities(query, candidates):
+    """
+    Similarity of one query against many candidates, in the same order as
+    `candidates`. The query is normalized only once.
+    """
+    query = normalize(query)
+    return [_similarity(query, normalize(candidate)) for candidate in candidates]
+
+
+if __name__ == "__main__":
+    # Micro-benchmark against the original full-table implementation
+    import timeit
+
+    def _reference_lcs(s1, s2):
+        m = [[0] * (1 + len(s2)) for _ in range(1 + len(s1))]
+        longest, x_longest = 0, 0
+        for x in range(1, 1 + len(s1)):
+            for y in range(1, 1 + len(s2)):
+                if s1[x - 1] == s2[y - 1]:
+                    m[x][y] = m[x - 1][y - 1] + 1
+                    if m[x][y] > longest:
+                        longest = m[x][y]
+                        x_longest = x
+                else:
+                    m[x][y] = 0
+        return len(s1[x_longest - longest : x_longest])
+
+    def _reference_similarity(a, b):
+        a = remove_accents(a.lower())
+        b = remove_accents(b.lower())
+        lcs_val = _reference_lcs(a, b)
+        return ((lcs_val / len(a) + lcs_val / len(b)) / 2.0) * 100.0
+
+    pairs = [
+        ("Zürich HB", "Zürich"),
+        ("Paris Gare de Lyon", "Paris"),
+        ("Deutsche Bahn", "DB Fernverkehr"),
+        ("Société nationale des chemins de fer français", "SNCF Voyageurs"),
+        ("Frankfurt (Main) Hauptbahnhof", "Frankfurt am Main"),
+        ("København H", "Copenhagen"),
+    ]
+    for a, b in pairs:
+        assert stringSimmilarity(a, b) == _reference_similarity(a, b), (a, b)
+
+    operators = [a for a, _ in pairs] + [b for _, b in pairs]
+    assert stringSimmilarities("SNCF", operators) == [
+        _reference_similarity("SNCF", o) for o in operators
+    ]
+
+    number = 2000
+    reference = timeit.timeit(
+        lambda: [_reference_similarity(a, b) for a, b in pairs], number=number
+    )
+    current = timeit.timeit(
+        lambda: [stringSimmilarity(a, b) for a, b in pairs], number=number
+    )
+    batch = timeit.timeit(
+        lambda: stringSimmilarities("Deutsche Bahn", operators), number=number
+    )
+    print(f"reference: {reference * 1e6 / number:.1f} µs per {len(pairs)} pairs")
+    print(f"rolling:   {current * 1e6 / number:.1f} µs per {len(pairs)} pairs")
+    print(f"batch:     {batch * 1e6 / number:.1f} µs per {len(operators)} candidates")
@@ -4,11 +4,11 @@ import dateutil
 import polyline
 from flexpolyline import decode as decode_flexpolyline
 
+from py.string_similarity import stringSimmilarities
 from py.utils import (
     get_flag_emoji,
     getCountryFromCoordinates,
     getDistanceFromPath,
-    stringSimmilarity,
 )
 
 
@@ -124,12 +124,13 @@ def build_operator_info(operator_name_api, start_utc_str, mainConn, managed_curs
                 "SELECT uid, short_name, long_name FROM operators"
             ).fetchall()
 
+        similarities = stringSimmilarities(
+            operator_name_api, [row["short_name"] for row in db_operators]
+        )
+
         best_operator = None
         best_similarity = -1.0
-        for row in db_operators:
-            sim = stringSimmilarity(
-                operator_name_api.lower(), row["short_name"].lower()
-            )
+        for row, sim in zip(db_operators, similarities):
             if sim > best_similarity:
                 best_similarity = sim
                 best_operator = row
@@ -5,6 +5,7 @@ import time
 import unicodedata
 from urllib.request import urlopen
 from datetime import datetime, timezone
+from functools import lru_cache
 
 import pycountry
 import yaml
@@ -18,36 +19,6 @@ def remove_accents(input_str):
     return "".join([c for c in nfkd_form if not unicodedata.combining(c)])
 
 
-def longest_common_substring(s1, s2):
-    m = [[0] * (1 + len(s2)) for _ in range(1 + len(s1))]
-    longest, x_longest = 0, 0
-    for x in range(1, 1 + len(s1)):
-        for y in range(1, 1 + len(s2)):
-            if s1[x - 1] == s2[y - 1]:
-                m[x][y] = m[x - 1][y - 1] + 1
-                if m[x][y] > longest:
-                    longest = m[x][y]
-                    x_longest = x
-            else:
-                m[x][y] = 0
-    return len(s1[x_longest - longest : x_longest])
-
-
-def stringSimmilarity(a, b):
-    # Lowercase and remove accents for better similarity detection
-    a = remove_accents(a.lower())
-    b = remove_accents(b.lower())
-
-    lcs_val = longest_common_substring(a, b)
-
-    ratioA = lcs_val / len(a)
-    ratioB = lcs_val / len(b)
-
-    combined = (ratioA + ratioB) / 2.0
-
-    return combined * 100.0
-
-
 def getCountryFromCoordinates(lat, lng):
     country = geopip_perso.search(lat=lat, lng=lng)
     if not country:
@@ -55,6 +26,27 @@ def getCountryFromCoordinates(lat, lng):
     return country
 
 
+@lru_cache(maxsize=65536)
+def _getCountryCode(lat, lng):
+    try:
+        return getCountryFromCoordinates(lat, lng)["countryCode"]
+    except Exception:
+        return "UN"
+
+
+def getCountryCodesFromCoordinates(coordinates, precision=4):
+    """
+    Country codes of a list of (lat, lng) points, in the same order.
+    Points are rounded to `precision` decimals, deduplicated and looked up
+    through a process-wide cache. Points that can't be resolved get "UN".
+    """
+    rounded = [
+        (round(lat, precision), round(lng, precision)) for lat, lng in coordinates
+    ]
+    codes = {point: _getCountryCode(*point) for point in set(rounded)}
+    return [codes[point] for point in rounded]
+
+
 def load_config(filename="config.yaml"):
     with open(filename, "r", encoding="utf-8") as file:
         return yaml.safe_load(file)
@@ -0,0 +1,29 @@
+WITH UTC_Filtered AS (
+    SELECT
+    CASE
+        WHEN utc_start_datetime IS NOT NULL
+        THEN utc_start_datetime
+        ELSE start_datetime 
+    END AS 'utc_filtered_start_datetime',
+    CASE
+        WHEN utc_end_datetime IS NOT NULL
+        THEN utc_end_datetime
+        ELSE end_datetime 
+    END AS 'utc_filtered_end_datetime'
+    FROM trip
+    WHERE username == :username
+)
+
+-- whether the user is on a trip, and the seconds until that changes: the end
+-- of the current trip or the start of the next one (NULL if neither exists)
+SELECT
+    COALESCE(MAX(julianday('now') BETWEEN julianday(utc_filtered_start_datetime) AND julianday(utc_filtered_end_datetime)), 0) AS current,
+    (MIN(
+        CASE
+            WHEN julianday('now') < julianday(utc_filtered_start_datetime)
+            THEN julianday(utc_filtered_start_datetime)
+            WHEN julianday('now') <= julianday(utc_filtered_end_datetime)
+            THEN julianday(utc_filtered_end_datetime)
+        END
+    ) - julianday('now')) * 86400 AS seconds_valid
+FROM UTC_Filtered
@@ -0,0 +1,111 @@
+"""
+Airports of the `airports` table indexed in memory by IATA and ICAO codes, for
+imports and flight lookups that would otherwise query the table per flight.
+
+Each process keeps one index, with the timezone of every airport computed when
+it is loaded. It is loaded in the background when the app starts, and reloaded
+when the table changes (checked every few minutes) or on demand by an admin.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from src.utils import timezone_at
+
+logger = logging.getLogger(__name__)
+
+# seconds between two checks of the table for changes
+AIRPORTS_CHECK_INTERVAL = 300
+
+Airport = namedtuple(
+    "Airport",
+    ["ident", "iata", "name", "iso_country", "latitude", "longitude", "timezone"],
+)
+
+
+class AirportIndex:
+    def __init__(self, airports, fingerprint=None):
+        self.iata = {}
+        self.icao = {}
+        self.fingerprint = fingerprint
+        for airport in airports:
+            if airport.iata:
+                self.iata.setdefault(airport.iata, airport)
+            if airport.ident:
+                self.icao.setdefault(airport.ident, airport)
+
+    def __len__(self):
+        return len(self.icao)
+
+
+def _fingerprint(conn):
+    # the table is replaced or edited as a whole, its size and coordinates are
+    # enough to tell that it changed
+    cursor = conn.execute(
+        "SELECT COUNT(*), MAX(rowid), TOTAL(latitude), TOTAL(longitude) FROM airports"
+    )
+    try:
+        return tuple(cursor.fetchone())
+    finally:
+        cursor.close()
+
+
+def load_airports(conn):
+    """AirportIndex of all the airports, with their timezones"""
+    start = time.perf_counter()
+    fingerprint = _fingerprint(conn)
+    cursor = conn.execute(
+        "SELECT ident, iata, name, iso_country, latitude, longitude FROM airports"
+    )
+    try:
+        index = AirportIndex(
+            (
+                Airport(*airport, timezone_at(lat=airport[4], lng=airport[5]))
+                for airport in cursor.fetchall()
+            ),
+            fingerprint,
+        )
+    finally:
+        cursor.close()
+    logger.info(f"Loaded {len(index)} airports in {time.perf_counter() - start:.1f}s")
+    return index
+
+
+_airports = None
+_airports_pid = None
+_airports_checked = 0
+_airports_lock = threading.Lock()
+
+
+def get_airports(conn, refresh=False):
+    """
+    The airports index of this process, loaded on first use and reloaded if
+    the table changed since it was last checked (or if `refresh` is set).
+    """
+    global _airports, _airports_pid, _airports_checked
+    with _airports_lock:
+        now = time.monotonic()
+        if _airports is None or _airports_pid != os.getpid() or refresh:
+            _airports = load_airports(conn)
+            _airports_pid = os.getpid()
+            _airports_checked = now
+        elif now - _airports_checked > AIRPORTS_CHECK_INTERVAL:
+            _airports_checked = now
+            if _fingerprint(conn) != _airports.fingerprint:
+                _airports = load_airports(conn)
+        return _airports
+
+
+def preload_airports(conn):
+    """Load the index in a background thread, so that startup isn't delayed"""
+
+    def load():
+        try:
+            get_airports(conn)
+        except Exception as e:
+            logger.warning(f"Airports preload failed: {e}")
+
+    threading.Thread(target=load, name="airports-preload", daemon=True).start()
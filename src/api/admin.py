@@ -1,8 +1,9 @@
 import logging
 
-from flask import Blueprint, render_template, request, session
+from flask import Blueprint, current_app, jsonify, render_template, request, session
 
 from py.utils import get_flag_emoji
+from src import pg, routing, trip_facts, trip_verification, user_cache, worker_stats
 from src.suspicious_activity import list_denied_logins, list_suspicious_activity
 from src.utils import getUser, isCurrentTrip, lang, owner_required
 
@@ -61,3 +62,65 @@ def suspicious_activity():
         **lang[session["userinfo"]["lang"]],
         **session["userinfo"],
     )
+
+
+@admin_blueprint.route("/routing_stats")
+@owner_required
+def routing_stats():
+    """
+    Hit rate and latency of each router across the worker processes, along
+    with the size of the shared route cache
+    """
+    return jsonify(routing.stats.gather())
+
+
+@admin_blueprint.route("/verification_stats")
+@owner_required
+def verification_stats():
+    """
+    Counters of the SQLite/PG verification of written trips, across the worker
+    processes
+    """
+    return jsonify(trip_verification.stats.gather())
+
+
+@admin_blueprint.route("/pg_pool_stats")
+@owner_required
+def pg_pool_stats():
+    """
+    State of the PG connection pools and timings of the sessions (wait for a
+    connection, time held) across the worker processes
+    """
+    return jsonify(pg.stats.gather())
+
+
+@admin_blueprint.route("/user_cache_stats")
+@owner_required
+def user_cache_stats():
+    """
+    Hit rates of the user caches, and user lookups per request, across the
+    worker processes
+    """
+    return jsonify(user_cache.stats.gather())
+
+
+@admin_blueprint.route("/trip_facts_stats")
+@owner_required
+def trip_facts_stats():
+    """
+    Hit rates of the cached trip types and current trips, and trip queries
+    saved per rendered page, across the worker processes
+    """
+    return jsonify(trip_facts.stats.gather())
+
+
+@admin_blueprint.route("/matomo_stats")
+@owner_required
+def matomo_stats():
+    """
+    Depth of the queues of requests waiting to be sent to Matomo, and counts of
+    the sent and dropped ones, across the worker processes
+    """
+    if "matomo" not in current_app.extensions:
+        return jsonify(None)
+    return jsonify(worker_stats.gather("matomo"))
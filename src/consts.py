@@ -11,6 +11,9 @@ class DbNames(str, Enum):
     AUTH_DB = "databases/auth.db"
     PATH_DB = "databases/path.db"
     MAIN_DB = "databases/main.db"
+    ROUTING_CACHE_DB = "databases/routing_cache.db"
+    WORKER_STATS_DB = "databases/worker_stats.db"
+    JOBS_DB = "databases/jobs.db"
 
 
 class TripTypes(str, Enum):
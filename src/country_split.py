@@ -0,0 +1,329 @@
+"""
+Split of trip paths into the length travelled in each country, as stored in
+the `countries` column of trips. Two engines are available:
+
+- "python" (py.utils.getCountriesFromPath) looks up the country of the points
+  of the path, one at a time, in the polygons of countries-filtered.geojson;
+- "postgis" intersects the paths with the same polygons, loaded into the
+  `country_polygons` table (migration 0008), in one query for any number of
+  trips.
+
+The engine is chosen with the `countries.engine` setting. The table is filled
+(and refreshed after the geojson changes) with:
+
+    python -m src.country_split --load
+
+the engines are compared on real trips with `--parity [trips]`, and timed on
+the recomputation of all trips with `--bench [trips]`.
+"""
+
+import json
+import logging
+import sys
+import time
+import traceback
+
+from py.utils import getCountriesFromPath, load_config
+from src.pg import get_or_create_pg_session, pg_session
+from src.trip_paths import _ewkb, _iter_sqlite_paths, to_coordinates
+from src.utils import mainConn, managed_cursor, pathConn
+
+logger = logging.getLogger(__name__)
+
+countries_config = load_config().get("countries", {})
+
+ENGINES = ("python", "postgis")
+ENGINE = countries_config.get("engine", "python")
+COUNTRIES_FILE = "static/data/countries-filtered.geojson"
+# max vertices of the parts the country polygons are cut into
+SUBDIVIDE_VERTICES = 256
+CHUNK_SIZE = 1000
+UNKNOWN_COUNTRY = "UN"
+# py.utils.getDistance uses a sphere of 6373 km, ST_Length(geography, false)
+# the mean radius of WGS84
+EARTH_RADIUS = 6373000.0
+POSTGIS_SPHERE_RADIUS = 6371008.7714
+# meters of a path outside of every polygon below which they are ignored
+OUTSIDE_TOLERANCE = 1
+# difference between the engines, in share of the trip length, that is
+# reported by the parity check
+PARITY_TOLERANCE = 0.01
+
+INSERT_COUNTRY_QUERY = """
+    INSERT INTO country_polygons (country_code, feature_area, geom)
+    SELECT :country_code, ST_Area(feature.geom), ST_Multi(part.geom)
+    FROM (
+        SELECT ST_CollectionExtract(
+            ST_MakeValid(ST_SetSRID(ST_GeomFromGeoJSON(:geometry), 4326)), 3
+        ) AS geom
+    ) AS feature,
+    LATERAL ST_Subdivide(feature.geom, :max_vertices) AS part(geom)
+"""
+
+# lengths are only intersected for the trips split along their path, air
+# trips being split between their two ends
+SPLIT_QUERY = """
+    WITH paths AS ({paths}),
+    lengths AS (
+        SELECT paths.trip_id, country_code,
+            SUM(ST_Length(ST_Intersection(paths.path, geom)::geography, false)) AS length
+        FROM paths JOIN country_polygons ON ST_Intersects(paths.path, geom)
+        WHERE paths.trip_type NOT IN ('air', 'helicopter')
+        GROUP BY paths.trip_id, country_code
+    )
+    SELECT paths.trip_id, paths.trip_type, ST_Length(paths.path::geography, false),
+        (
+            SELECT country_code FROM country_polygons
+            WHERE ST_Intersects(geom, ST_StartPoint(paths.path))
+            ORDER BY feature_area LIMIT 1
+        ),
+        (
+            SELECT country_code FROM country_polygons
+            WHERE ST_Intersects(geom, ST_EndPoint(paths.path))
+            ORDER BY feature_area LIMIT 1
+        ),
+        lengths.country_code,
+        lengths.length
+    FROM paths LEFT JOIN lengths USING (trip_id)
+"""
+
+GIVEN_PATHS = """
+    SELECT trip_id, trip_type, ST_GeomFromEWKB(decode(path, 'hex')) AS path
+    FROM unnest(CAST(:trip_ids AS integer[]), CAST(:types AS text[]), CAST(:paths AS text[]))
+        AS given(trip_id, trip_type, path)
+"""
+
+STORED_PATHS = """
+    SELECT trip_id, trip_type, path FROM trip_paths JOIN trips USING (trip_id)
+    WHERE trip_id = ANY(:trip_ids)
+"""
+
+
+def load_countries(filename=COUNTRIES_FILE, pg_session=None):
+    """Replace the polygons of country_polygons with the features of the geojson"""
+    start = time.perf_counter()
+    with open(filename, "r") as f:
+        features = json.load(f)["features"]
+    rows = [
+        {
+            "country_code": feature["properties"]["countryCode"],
+            "geometry": json.dumps(feature["geometry"]),
+            "max_vertices": SUBDIVIDE_VERTICES,
+        }
+        for feature in features
+        if feature.get("geometry")
+    ]
+    with get_or_create_pg_session(pg_session) as pg:
+        pg.execute("TRUNCATE country_polygons")
+        pg.execute(INSERT_COUNTRY_QUERY, rows)
+        pg.execute("ANALYZE country_polygons")
+        parts = pg.execute("SELECT COUNT(*) FROM country_polygons").scalar()
+    logger.info(
+        f"Loaded {len(rows)} countries as {parts} polygons in "
+        f"{time.perf_counter() - start:.1f}s"
+    )
+    return {"countries": len(rows), "polygons": parts}
+
+
+def _split(trip_type, total, start_country, end_country, lengths):
+    """{country: meters} of a trip, from the lengths computed by PostGIS"""
+    scale = EARTH_RADIUS / POSTGIS_SPHERE_RADIUS
+    total *= scale
+    start_country = start_country or UNKNOWN_COUNTRY
+    end_country = end_country or UNKNOWN_COUNTRY
+
+    if trip_type in ("air", "helicopter"):
+        countries = {start_country: total / 2}
+        countries[end_country] = countries.get(end_country, 0) + total / 2
+        return countries
+
+    countries = {
+        country: length * scale for country, length in lengths.items() if length > 0
+    }
+    outside = total - sum(countries.values())
+    if outside > OUTSIDE_TOLERANCE:
+        # ferries are at sea outside of the polygons, other trips are counted
+        # by the python engine in the last country they were in, here the one
+        # they spend the most time in
+        if trip_type == "ferry" or not countries:
+            country = UNKNOWN_COUNTRY
+        else:
+            country = max(countries, key=countries.get)
+        countries[country] = countries.get(country, 0) + outside
+    if not countries:
+        countries = {start_country: 0}
+    return countries
+
+
+def _run_split(pg, paths_query, params):
+    trips = {}
+    rows = pg.execute(SPLIT_QUERY.format(paths=paths_query), params).fetchall()
+    for trip_id, trip_type, total, start_country, end_country, country, length in rows:
+        trip = trips.setdefault(
+            trip_id, (trip_type, total, start_country, end_country, {})
+        )
+        if country is not None:
+            trip[4][country] = length
+    return {trip_id: _split(*trip) for trip_id, trip in trips.items()}
+
+
+def split_paths(paths, pg_session=None):
+    """
+    {trip_id: {country: meters}} of the paths given as {trip_id: (type, path)},
+    in one query
+    """
+    params = {"trip_ids": [], "types": [], "paths": []}
+    for trip_id, (trip_type, path) in paths.items():
+        coordinates = to_coordinates(path)
+        if coordinates:
+            params["trip_ids"].append(int(trip_id))
+            params["types"].append(trip_type)
+            params["paths"].append(_ewkb(coordinates))
+    if not params["trip_ids"]:
+        return {}
+    with get_or_create_pg_session(pg_session) as pg:
+        return _run_split(pg, GIVEN_PATHS, params)
+
+
+def split_trips(trip_ids, pg_session=None):
+    """{trip_id: {country: meters}} of trips whose path is in trip_paths, in one query"""
+    with get_or_create_pg_session(pg_session) as pg:
+        return _run_split(
+            pg, STORED_PATHS, {"trip_ids": [int(trip_id) for trip_id in trip_ids]}
+        )
+
+
+def get_countries_from_path(path, type, pg_session=None):
+    """
+    JSON of the length of the path in each country, with the configured
+    engine. A failing PostGIS split falls back to the python engine.
+    """
+    if ENGINE == "postgis":
+        try:
+            with get_or_create_pg_session(pg_session) as pg:
+                # in a savepoint, so that a failure leaves the session usable
+                with pg.begin_nested():
+                    countries = split_paths({0: (type, path)}, pg)
+            if countries:
+                return json.dumps(countries[0])
+        except Exception:
+            logger.warning(f"PostGIS country split failed: {traceback.format_exc()}")
+    return getCountriesFromPath(path, type)
+
+
+def _trip_types(trip_ids):
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            "SELECT uid, type FROM trip WHERE uid IN (SELECT value FROM json_each(?))",
+            (json.dumps([int(trip_id) for trip_id in trip_ids]),),
+        )
+        return dict(cursor.fetchall())
+
+
+def _iter_sqlite_trips(trip_ids):
+    """Yield (trip_id, type, [{"lat", "lng"}, ...]) for the trips of path.db"""
+    for i in range(0, len(trip_ids), CHUNK_SIZE):
+        chunk = trip_ids[i : i + CHUNK_SIZE]
+        types = _trip_types(chunk)
+        for trip_id, coordinates in _iter_sqlite_paths(chunk):
+            if coordinates and trip_id in types:
+                yield (
+                    trip_id,
+                    types[trip_id],
+                    [{"lat": lat, "lng": lng} for lat, lng in coordinates],
+                )
+
+
+def _sample_trip_ids(count=None):
+    with managed_cursor(pathConn) as cursor:
+        if count is None:
+            cursor.execute("SELECT trip_id FROM paths ORDER BY trip_id")
+        else:
+            cursor.execute(
+                "SELECT trip_id FROM paths ORDER BY random() LIMIT ?", (count,)
+            )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def check_parity(count=1000):
+    """
+    Split `count` random trips of path.db with both engines, and report the
+    trips where a country differs by more than PARITY_TOLERANCE of the trip.
+    """
+    trips = list(_iter_sqlite_trips(_sample_trip_ids(count)))
+    postgis = {}
+    with pg_session() as pg:
+        for i in range(0, len(trips), CHUNK_SIZE):
+            postgis.update(
+                split_paths(
+                    {
+                        trip_id: (trip_type, path)
+                        for trip_id, trip_type, path in trips[i : i + CHUNK_SIZE]
+                    },
+                    pg,
+                )
+            )
+
+    mismatches = {}
+    for trip_id, trip_type, path in trips:
+        python_split = json.loads(getCountriesFromPath(path, trip_type))
+        postgis_split = postgis.get(trip_id, {})
+        tolerance = max(
+            OUTSIDE_TOLERANCE, sum(python_split.values()) * PARITY_TOLERANCE
+        )
+        differences = {
+            country: round(postgis_split.get(country, 0) - python_split.get(country, 0))
+            for country in python_split.keys() | postgis_split.keys()
+        }
+        if any(abs(difference) > tolerance for difference in differences.values()):
+            mismatches[trip_id] = (trip_type, differences)
+
+    for trip_id, (trip_type, differences) in list(mismatches.items())[:20]:
+        print(f"trip {trip_id} ({trip_type}): {differences}")
+    print(
+        f"{len(trips) - len(mismatches)}/{len(trips)} trips split the same "
+        f"(within {PARITY_TOLERANCE:.0%})"
+    )
+    return {"trips": len(trips), "mismatches": len(mismatches)}
+
+
+def benchmark(count=None):
+    """
+    Time the split of all the trips (or of `count` random ones) with both
+    engines, the PostGIS one reading the paths of trip_paths.
+    """
+    trip_ids = _sample_trip_ids(count)
+
+    start = time.perf_counter()
+    python_trips = 0
+    for _, trip_type, path in _iter_sqlite_trips(trip_ids):
+        getCountriesFromPath(path, trip_type)
+        python_trips += 1
+    python_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    postgis_trips = 0
+    with pg_session() as pg:
+        for i in range(0, len(trip_ids), CHUNK_SIZE):
+            postgis_trips += len(split_trips(trip_ids[i : i + CHUNK_SIZE], pg))
+    postgis_seconds = time.perf_counter() - start
+
+    for engine, trips, seconds in (
+        ("python", python_trips, python_seconds),
+        ("postgis", postgis_trips, postgis_seconds),
+    ):
+        print(
+            f"{engine:>7}: {trips} trips in {seconds:.1f}s "
+            f"({trips / seconds if seconds else 0:.0f} trips/s)"
+        )
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if "--load" in sys.argv:
+        load_countries(args[0] if args else COUNTRIES_FILE)
+    elif "--parity" in sys.argv:
+        report = check_parity(int(args[0]) if args else 1000)
+        sys.exit(1 if report["mismatches"] else 0)
+    elif "--bench" in sys.argv:
+        benchmark(int(args[0]) if args else None)
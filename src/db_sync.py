@@ -1,24 +1,78 @@
 import csv
+import datetime
+import hashlib
 import io
+import json
 import logging
 import logging.config
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from functools import partial
 
-from src.pg import get_or_create_pg_session, pg_session
-from src.trips import Trip, compare_trip, parse_date
-from src.utils import get_user_id, mainConn, managed_cursor
+from src.consts import DbNames
+from src.pg import copy_expert, get_or_create_pg_session, pg_session
+from src.trips import (
+    COMPARED_FIELDS,
+    Trip,
+    _normalize_sqlite_trip,
+    ensure_values_equal,
+    parse_date,
+)
+from src.utils import authConn, mainConn, managed_cursor
 
 logging.config.fileConfig("logging.conf", disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 
 
-def sync_db_from_sqlite():
+def sync_db_from_sqlite(incremental=True):
     """
     Sync the PostgreSQL database with the SQLite database.
     """
 
     logger.info("Syncing SQLite database with PostgreSQL...")
     with pg_session() as pg:
-        sync_trips_from_sqlite(pg)
+        sync_trips_from_sqlite(pg, incremental)
+
+
+# columns of the pg trips table, in the order of `trip_to_csv`
+TRIP_COLUMNS = (
+    "trip_id",
+    "user_id",
+    "origin_station",
+    "destination_station",
+    "start_datetime",
+    "end_datetime",
+    "is_project",
+    "utc_start_datetime",
+    "utc_end_datetime",
+    "estimated_trip_duration",
+    "manual_trip_duration",
+    "trip_length",
+    "operator",
+    "countries",
+    "line_name",
+    "created",
+    "last_modified",
+    "trip_type",
+    "material_type",
+    "seat",
+    "reg",
+    "waypoints",
+    "notes",
+    "price",
+    "currency",
+    "ticket_id",
+    "purchase_date",
+)
+
+# trips modified up to that long before the watermark of the last sync are
+# synced again, in case they were committed in sqlite in a different order
+SYNC_OVERLAP = datetime.timedelta(hours=1)
+# name of the trips sync in the sync_state table (migration 0009)
+TRIPS_SYNC = "trips"
 
 
 def trip_to_csv(trip: Trip):
@@ -54,155 +108,407 @@ def trip_to_csv(trip: Trip):
     return items
 
 
-def sync_trips_from_sqlite(pg_session=None):
-    logger.info("Syncing trips from SQLite to PostgreSQL...")
+def get_user_ids():
+    """Id of every user, by username"""
+    with managed_cursor(authConn) as cursor:
+        cursor.execute("SELECT username, uid FROM user")
+        return {row["username"]: row["uid"] for row in cursor.fetchall()}
 
-    # fetch all trips from sqlite
+
+def _changed_trips(pg, incremental):
+    """
+    SQLite trips to write to pg, ids of the trips to delete from pg, and the
+    watermark of this sync. Incremental syncs only read the trips modified
+    since the watermark of the last successful sync (and not since the latest
+    modification in pg, which dual writes keep current even when some of them
+    failed), the ones missing from pg and the ones with no valid last_modified.
+    """
     with managed_cursor(mainConn) as cursor:
-        cursor.execute("SELECT count(*) FROM trip")
-        num_trips = cursor.fetchone()[0]
-        logger.info(f"Syncing {num_trips} trips from SQLite to PostgreSQL")
+        # read first, trips written meanwhile are synced again next time
+        watermark = cursor.execute(
+            "SELECT MAX(datetime(last_modified)) FROM trip"
+        ).fetchone()[0]
+        cursor.execute("SELECT uid FROM trip")
+        sqlite_ids = {row[0] for row in cursor.fetchall()}
+    pg_ids = {row[0] for row in pg.execute("SELECT trip_id FROM trips").fetchall()}
+    deleted_ids = pg_ids - sqlite_ids
 
-        cursor.execute("SELECT * FROM trip ORDER BY uid")
-        sqlite_trips = cursor.fetchall()
+    since = pg.execute(
+        "SELECT watermark FROM sync_state WHERE name = :name", {"name": TRIPS_SYNC}
+    ).scalar()
+    with managed_cursor(mainConn) as cursor:
+        if not incremental or since is None:
+            cursor.execute("SELECT * FROM trip ORDER BY uid")
+        else:
+            cursor.execute(
+                """
+                SELECT * FROM trip
+                WHERE datetime(last_modified) IS NULL
+                OR datetime(last_modified) >= datetime(?)
+                OR uid IN (SELECT value FROM json_each(?))
+                ORDER BY uid
+                """,
+                (
+                    (since - SYNC_OVERLAP).isoformat(sep=" "),
+                    json.dumps(sorted(sqlite_ids - pg_ids)),
+                ),
+            )
+        return cursor.fetchall(), deleted_ids, watermark
 
-    csv_buf = io.StringIO()
-    csv_writer = csv.writer(csv_buf, delimiter="\t", quoting=csv.QUOTE_MINIMAL)
 
-    for i, row in enumerate(sqlite_trips):
-        if i % 20000 == 0:
-            logger.info(f"Converting trip {i}/{num_trips}")
+def sync_trips_from_sqlite(pg_session=None, incremental=True):
+    """
+    Write the SQLite trips into pg, in one transaction so that readers always
+    see a complete table. Trips are copied into a staging table and upserted
+    from it, trips that no longer exist in SQLite are deleted. Unless
+    `incremental` is False, only the trips modified since the previous
+    successful sync are copied.
+    """
+    logger.info(
+        f"Syncing trips from SQLite to PostgreSQL ({'incremental' if incremental else 'full'})..."
+    )
+    start = time.perf_counter()
+    user_ids = get_user_ids()
 
-        start_datetime = (
-            row["start_datetime"] if row["start_datetime"] not in [-1, 1] else None
-        )
-        parsed_start_datetime = parse_date(start_datetime) if start_datetime else None
-        end_datetime = (
-            row["end_datetime"] if row["end_datetime"] not in [-1, 1] else None
-        )
-        parsed_end_datetime = parse_date(end_datetime) if end_datetime else None
-        parsed_utc_start_datetime = (
-            parse_date(row["utc_start_datetime"]) if row["utc_start_datetime"] else None
-        )
-        parsed_utc_end_datetime = (
-            parse_date(row["utc_end_datetime"]) if row["utc_end_datetime"] else None
-        )
-        trip = Trip(
-            trip_id=row["uid"],
-            username=row["username"],
-            user_id=get_user_id(row["username"]),
-            origin_station=row["origin_station"],
-            destination_station=row["destination_station"],
-            start_datetime=parsed_start_datetime,
-            end_datetime=parsed_end_datetime,
-            trip_length=row["trip_length"],
-            estimated_trip_duration=row["estimated_trip_duration"],
-            operator=row["operator"],
-            countries=row["countries"],
-            manual_trip_duration=row["manual_trip_duration"],
-            utc_start_datetime=parsed_utc_start_datetime,
-            utc_end_datetime=parsed_utc_end_datetime,
-            created=row["created"],
-            last_modified=row["last_modified"],
-            line_name=row["line_name"],
-            type=row["type"],
-            material_type=row["material_type"],
-            seat=row["seat"],
-            reg=row["reg"],
-            waypoints=row["waypoints"],
-            notes=row["notes"],
-            price=row["price"] if row["price"] != "" else None,
-            currency=row["currency"],
-            purchasing_date=row["purchasing_date"]
-            if row["purchasing_date"] != ""
-            else None,
-            ticket_id=row["ticket_id"] if row["ticket_id"] != "" else None,
-            is_project=row["start_datetime"] == 1 or row["end_datetime"] == 1,
-            path=None,  # not needed when inserting trips
-        )
-        csv_writer.writerow(trip_to_csv(trip))
+    with get_or_create_pg_session(pg_session) as pg:
+        sqlite_trips, deleted_ids, watermark = _changed_trips(pg, incremental)
+        num_trips = len(sqlite_trips)
+        logger.info(f"Syncing {num_trips} trips from SQLite to PostgreSQL")
 
-    csv_buf.seek(0)
+        csv_buf = io.StringIO()
+        csv_writer = csv.writer(csv_buf, delimiter="\t", quoting=csv.QUOTE_MINIMAL)
 
-    with get_or_create_pg_session(pg_session) as pg:
-        # remove existing trips from pg
-        logger.info("Deleting existing trips in pg...")
-        query = "DELETE FROM trips;"
-        pg.execute(query)
-
-        query = """
-            COPY trips (
-                trip_id,
-                user_id,
-                origin_station,
-                destination_station,
-                start_datetime,
-                end_datetime,
-                is_project,
-                utc_start_datetime,
-                utc_end_datetime,
-                estimated_trip_duration,
-                manual_trip_duration,
-                trip_length,
-                operator,
-                countries,
-                line_name,
-                created,
-                last_modified,
-                trip_type,
-                material_type,
-                seat,
-                reg,
-                waypoints,
-                notes,
-                price,
-                currency,
-                ticket_id,
-                purchase_date
-            ) FROM STDIN WITH (
+        for i, row in enumerate(sqlite_trips):
+            if i % 20000 == 0:
+                logger.info(f"Converting trip {i}/{num_trips}")
+
+            start_datetime = (
+                row["start_datetime"] if row["start_datetime"] not in [-1, 1] else None
+            )
+            parsed_start_datetime = (
+                parse_date(start_datetime) if start_datetime else None
+            )
+            end_datetime = (
+                row["end_datetime"] if row["end_datetime"] not in [-1, 1] else None
+            )
+            parsed_end_datetime = parse_date(end_datetime) if end_datetime else None
+            parsed_utc_start_datetime = (
+                parse_date(row["utc_start_datetime"])
+                if row["utc_start_datetime"]
+                else None
+            )
+            parsed_utc_end_datetime = (
+                parse_date(row["utc_end_datetime"]) if row["utc_end_datetime"] else None
+            )
+            trip = Trip(
+                trip_id=row["uid"],
+                username=row["username"],
+                user_id=user_ids.get(row["username"]),
+                origin_station=row["origin_station"],
+                destination_station=row["destination_station"],
+                start_datetime=parsed_start_datetime,
+                end_datetime=parsed_end_datetime,
+                trip_length=row["trip_length"],
+                estimated_trip_duration=row["estimated_trip_duration"],
+                operator=row["operator"],
+                countries=row["countries"],
+                manual_trip_duration=row["manual_trip_duration"],
+                utc_start_datetime=parsed_utc_start_datetime,
+                utc_end_datetime=parsed_utc_end_datetime,
+                created=row["created"],
+                last_modified=row["last_modified"],
+                line_name=row["line_name"],
+                type=row["type"],
+                material_type=row["material_type"],
+                seat=row["seat"],
+                reg=row["reg"],
+                waypoints=row["waypoints"],
+                notes=row["notes"],
+                price=row["price"] if row["price"] != "" else None,
+                currency=row["currency"],
+                purchasing_date=row["purchasing_date"]
+                if row["purchasing_date"] != ""
+                else None,
+                ticket_id=row["ticket_id"] if row["ticket_id"] != "" else None,
+                is_project=row["start_datetime"] == 1 or row["end_datetime"] == 1,
+                path=None,  # not needed when inserting trips
+            )
+            csv_writer.writerow(trip_to_csv(trip))
+
+        csv_buf.seek(0)
+        del sqlite_trips
+
+        columns = ", ".join(TRIP_COLUMNS)
+        pg.execute(
+            "CREATE TEMPORARY TABLE trips_staging "
+            "(LIKE trips INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        logger.info("Bulk copying trips in the pg staging table...")
+        copy_expert(
+            pg,
+            f"""
+            COPY trips_staging ({columns}) FROM STDIN WITH (
                 FORMAT csv,
                 DELIMITER E'\t',
                 QUOTE '"'
             )
-        """
+            """,
+            csv_buf,
+        )
 
-        logger.info("Bulk inserting trips in pg...")
-        cursor = pg.connection().connection.cursor()
-        cursor.copy_expert(query, csv_buf)
-    logger.info("Finished migrating trips from sqlite to pg!")
+        # rows that didn't change are left alone rather than rewritten
+        updated_columns = [column for column in TRIP_COLUMNS if column != "trip_id"]
+        upserted = pg.execute(
+            f"""
+            INSERT INTO trips ({columns})
+            SELECT {columns} FROM trips_staging
+            ON CONFLICT (trip_id) DO UPDATE SET
+                {", ".join(f"{column} = EXCLUDED.{column}" for column in updated_columns)}
+            WHERE ({", ".join(f"trips.{column}" for column in updated_columns)})
+                IS DISTINCT FROM
+                ({", ".join(f"EXCLUDED.{column}" for column in updated_columns)})
+            """
+        ).rowcount
 
+        deleted = 0
+        if deleted_ids:
+            deleted = pg.execute(
+                "DELETE FROM trips WHERE trip_id = ANY(:trip_ids)",
+                {"trip_ids": sorted(deleted_ids)},
+            ).rowcount
 
-def compare_all_trips():
-    # Fetch trip IDs from SQLite
-    with managed_cursor(mainConn) as cursor:
-        cursor.execute("SELECT uid FROM trip ORDER BY uid")
-        sqlite_trips = {row[0] for row in cursor.fetchall()}
+        if watermark is not None:
+            pg.execute(
+                """
+                INSERT INTO sync_state (name, watermark, synced)
+                VALUES (:name, :watermark, now())
+                ON CONFLICT (name) DO UPDATE
+                SET watermark = EXCLUDED.watermark, synced = EXCLUDED.synced
+                """,
+                {"name": TRIPS_SYNC, "watermark": watermark},
+            )
 
-    # Fetch trip IDs from PostgreSQL
-    with pg_session() as pg:
-        pg_trips = {row[0] for row in pg.execute("SELECT trip_id FROM trips ORDER BY trip_id").fetchall()}
-
-    # Compare the counts
-    if len(sqlite_trips) != len(pg_trips):
-        only_in_sqlite = sqlite_trips - pg_trips
-        only_in_pg = pg_trips - sqlite_trips
-
-        msg = (
-            f"Mismatch in trip counts! "
-            f"SQLite has {len(sqlite_trips)} trips, PG has {len(pg_trips)} trips.\n"
-            f"Trips only in SQLite: {sorted(only_in_sqlite)}\n"
-            f"Trips only in PG: {sorted(only_in_pg)}"
-        )
-        logger.error(msg)
-        raise Exception(msg)
+    logger.info(
+        f"Finished syncing trips from sqlite to pg in {time.perf_counter() - start:.1f}s: "
+        f"{num_trips} read, {upserted} written, {deleted} deleted"
+    )
+    return {"read": num_trips, "written": upserted, "deleted": deleted}
 
-    # If counts match, do full comparison
+
+# columns compared by the consistency check, with their pg type
+CHECKED_COLUMNS = {
+    "trip_id": "int",
+    "user_id": "int",
+    "origin_station": "text",
+    "destination_station": "text",
+    "start_datetime": "timestamp",
+    "end_datetime": "timestamp",
+    "is_project": "bool",
+    "utc_start_datetime": "timestamp",
+    "utc_end_datetime": "timestamp",
+    "estimated_trip_duration": "float",
+    "manual_trip_duration": "float",
+    "trip_length": "float",
+    "operator": "text",
+    "countries": "text",
+    "line_name": "text",
+    "created": "timestamp",
+    "last_modified": "timestamp",
+    "trip_type": "text",
+    "material_type": "text",
+    "seat": "text",
+    "reg": "text",
+    "waypoints": "text",
+    "notes": "text",
+    "price": "float",
+    "currency": "text",
+    "ticket_id": "int",
+    "purchase_date": "timestamp",
+}
+CHECK_CHUNK_SIZE = 5000
+NULL = "\\N"
+SEPARATOR = "\x1f"
+
+
+def _pg_column_text(column, column_type):
+    if column_type == "timestamp":
+        text = f"to_char({column}, 'YYYY-MM-DD HH24:MI:SS')"
+    else:
+        text = f"{column}::text"
+    return f"coalesce({text}, '{NULL}')"
+
+
+# md5 of the rows of a range of trips, in the text form built by `_row_text`
+CHUNK_HASH_QUERY = f"""
+    SELECT md5(string_agg(
+        concat_ws(
+            E'\\x1f',
+            {", ".join(_pg_column_text(c, t) for c, t in CHECKED_COLUMNS.items())}
+        ),
+        E'\\n' ORDER BY trip_id
+    ))
+    FROM trips WHERE trip_id >= :start AND trip_id < :end
+"""
+
+
+def _value_text(value):
+    """Text of a value as pg prints it (see CHUNK_HASH_QUERY)"""
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
+
+def _row_text(trip):
+    return SEPARATOR.join(_value_text(trip[column]) for column in CHECKED_COLUMNS)
+
+
+_check_conn = None
+_check_user_ids = None
+
+
+def _init_checker():
+    """Worker process of the check: own sqlite connection and user ids"""
+    global _check_conn, _check_user_ids
+    _check_conn = sqlite3.connect(DbNames.MAIN_DB.value, timeout=10)
+    _check_conn.row_factory = sqlite3.Row
+    _check_user_ids = get_user_ids()
+
+
+def _check_range(bounds, use_hash=True):
+    """
+    Compare the trips with start <= id < end. The sqlite trips are normalized
+    and hashed like pg does: when the hashes are equal, the pg trips aren't
+    fetched. Otherwise both sides, ordered by id, are merge-joined.
+    """
+    start, end = bounds
+    cursor = _check_conn.execute(
+        "SELECT * FROM trip WHERE uid >= ? AND uid < ? ORDER BY uid", (start, end)
+    )
     try:
-        for i, trip_id in enumerate(sorted(sqlite_trips)):
-            if i % 20000 == 0:
-                logger.info(f"Checking consistency of trip {i}/{len(sqlite_trips)}")
-            compare_trip(trip_id)
-    except Exception:
-        logger.error(f"Found exception while processing trip {trip_id}")
-        raise
+        sqlite_trips = [
+            _normalize_sqlite_trip(dict(row), _check_user_ids.get(row["username"]))
+            for row in cursor.fetchall()
+        ]
+    finally:
+        cursor.close()
+
+    result = {"trips": len(sqlite_trips), "hash_match": False, "mismatches": []}
+    with pg_session() as pg:
+        if use_hash:
+            sqlite_hash = (
+                hashlib.md5(
+                    "\n".join(_row_text(trip) for trip in sqlite_trips).encode("utf-8")
+                ).hexdigest()
+                if sqlite_trips
+                else None
+            )
+            pg_hash = pg.execute(
+                CHUNK_HASH_QUERY, {"start": start, "end": end}
+            ).scalar()
+            if sqlite_hash == pg_hash:
+                result["hash_match"] = True
+                return result
+        pg_trips = pg.execute(
+            "SELECT * FROM trips WHERE trip_id >= :start AND trip_id < :end "
+            "ORDER BY trip_id",
+            {"start": start, "end": end},
+        ).fetchall()
+
+    i = j = 0
+    while i < len(sqlite_trips) or j < len(pg_trips):
+        sqlite_trip = sqlite_trips[i] if i < len(sqlite_trips) else None
+        pg_trip = pg_trips[j] if j < len(pg_trips) else None
+        if pg_trip is None or (
+            sqlite_trip is not None and sqlite_trip["trip_id"] < pg_trip["trip_id"]
+        ):
+            result["mismatches"].append(
+                f"Trip {sqlite_trip['trip_id']} is missing in pg"
+            )
+            i += 1
+        elif sqlite_trip is None or pg_trip["trip_id"] < sqlite_trip["trip_id"]:
+            result["mismatches"].append(
+                f"Trip {pg_trip['trip_id']} is missing in sqlite"
+            )
+            j += 1
+        else:
+            try:
+                for field in COMPARED_FIELDS:
+                    ensure_values_equal(sqlite_trip, pg_trip, field)
+            except Exception as e:
+                result["mismatches"].append(str(e))
+            i += 1
+            j += 1
+    result["trips"] = max(len(sqlite_trips), len(pg_trips))
+    return result
+
+
+def compare_all_trips(workers=None, chunk_size=CHECK_CHUNK_SIZE, use_hash=True):
+    """
+    Check that all trips are the same in sqlite and pg. The id range is split
+    in chunks compared in parallel by `workers` processes (see `_check_range`).
+    Return a report with the mismatches found and the throughput.
+    """
+    start_time = time.perf_counter()
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute("SELECT MIN(uid), MAX(uid) FROM trip")
+        sqlite_min, sqlite_max = cursor.fetchone()
+    with pg_session() as pg:
+        pg_min, pg_max = pg.execute(
+            "SELECT MIN(trip_id), MAX(trip_id) FROM trips"
+        ).fetchone()
+    bounds = [
+        value for value in (sqlite_min, sqlite_max, pg_min, pg_max) if value is not None
+    ]
+    if not bounds:
+        return {"trips": 0, "mismatches": []}
+    ranges = [
+        (start, start + chunk_size)
+        for start in range(min(bounds), max(bounds) + 1, chunk_size)
+    ]
+
+    workers = workers or os.cpu_count()
+    logger.info(
+        f"Checking consistency of trips {min(bounds)} to {max(bounds)} "
+        f"in {len(ranges)} chunks with {workers} workers"
+    )
+    report = {"trips": 0, "chunks": len(ranges), "hash_matches": 0, "mismatches": []}
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_checker) as pool:
+        for i, result in enumerate(
+            pool.imap_unordered(partial(_check_range, use_hash=use_hash), ranges)
+        ):
+            report["trips"] += result["trips"]
+            report["hash_matches"] += result["hash_match"]
+            report["mismatches"].extend(result["mismatches"])
+            if i % 20 == 0:
+                logger.info(
+                    f"Checked {i}/{len(ranges)} chunks ({report['trips']} trips)"
+                )
+
+    report["seconds"] = round(time.perf_counter() - start_time, 1)
+    report["trips_per_second"] = round(report["trips"] / max(report["seconds"], 0.1))
+    for mismatch in report["mismatches"]:
+        logger.error(mismatch)
+    logger.info(
+        f"Checked {report['trips']} trips in {report['seconds']}s "
+        f"({report['trips_per_second']} trips/s, {report['hash_matches']}/"
+        f"{len(ranges)} chunks identical): {len(report['mismatches'])} mismatches"
+    )
+    return report
+
 
+if __name__ == "__main__":
+    # python -m src.db_sync [--full]: sync pg from sqlite
+    # python -m src.db_sync --check [--no-hash]: compare all trips
+    if "--check" in sys.argv:
+        report = compare_all_trips(use_hash="--no-hash" not in sys.argv)
+        sys.exit(1 if report["mismatches"] else 0)
+    sync_db_from_sqlite(incremental="--full" not in sys.argv)
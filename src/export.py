@@ -0,0 +1,511 @@
+"""
+Trips export, read in chunks so that memory doesn't grow with the user's
+history: trips are iterated with a cursor and paths fetched chunk by chunk.
+Trips are exported as CSV, or as Parquet / Arrow IPC files written one record
+batch per chunk.
+"""
+
+import csv
+import json
+import urllib.parse
+import zlib
+from datetime import datetime
+from io import StringIO
+
+import numpy as np
+import polyline
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from py.sql import getUserLines
+
+EXPORT_CHUNK_SIZE = 500
+
+COLUMNAR_FORMATS = {
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+    "arrow": ("arrow", "application/vnd.apache.arrow.file"),
+}
+GEOMETRY_ENCODINGS = ("coordinates", "wkb")
+
+# Arrow types of the trip columns, the others are strings
+TRIP_ARROW_TYPES = {
+    "uid": pa.int64(),
+    "start_datetime": pa.timestamp("us"),
+    "end_datetime": pa.timestamp("us"),
+    "is_project": pa.bool_(),
+    "estimated_trip_duration": pa.float64(),
+    "manual_trip_duration": pa.float64(),
+    "trip_length": pa.float64(),
+    "utc_start_datetime": pa.timestamp("us"),
+    "utc_end_datetime": pa.timestamp("us"),
+    "created": pa.timestamp("us"),
+    "last_modified": pa.timestamp("us"),
+    "price": pa.float64(),
+    "purchasing_date": pa.timestamp("us"),
+}
+DATE_FORMATS = ("%Y/%m/%d %H:%M:%S", "%d/%m/%Y %H:%M")
+
+
+def iter_trip_chunks(
+    main_conn, path_conn, username, trip_ids=None, chunk_size=EXPORT_CHUNK_SIZE
+):
+    """
+    Yield (columns, rows, paths) for each chunk of the user's trips (or of the
+    given trip ids), where `paths` maps the trip ids of the chunk to their path
+    as stored (a JSON list of [lat, lng]).
+    """
+    cursor = main_conn.cursor()
+    try:
+        if trip_ids is None:
+            cursor.execute(
+                "SELECT * FROM trip WHERE username = :username", {"username": username}
+            )
+        else:
+            cursor.execute(
+                "SELECT * FROM trip WHERE username = ? AND uid IN ({})".format(
+                    ", ".join(("?",) * len(trip_ids))
+                ),
+                (username, *trip_ids),
+            )
+        columns = [column[0] for column in cursor.description]
+        while rows := cursor.fetchmany(chunk_size):
+            path_cursor = path_conn.cursor()
+            try:
+                paths = {
+                    path["trip_id"]: path["path"]
+                    for path in path_cursor.execute(
+                        getUserLines.format(trip_ids=", ".join(("?",) * len(rows))),
+                        tuple(row["uid"] for row in rows),
+                    )
+                }
+            finally:
+                path_cursor.close()
+            yield columns, rows, paths
+    finally:
+        cursor.close()
+
+
+def format_csv_row(row, path):
+    """CSV row of a trip, its polyline encoded path being the last column"""
+    row = dict(row)
+    row.pop("ticket_id")
+    row["waypoints"] = json.dumps(row["waypoints"])
+    row["operator"] = (
+        row["operator"].replace(",", "&&")
+        if row["operator"] not in (None, "")
+        else row["operator"]
+    )
+    row["operator"] = (
+        urllib.parse.quote(row["operator"])
+        if row["operator"] not in (None, "")
+        else row["operator"]
+    )
+    row["line_name"] = (
+        urllib.parse.quote(row["line_name"])
+        if row["line_name"] not in (None, "")
+        else row["line_name"]
+    )
+    return list(row.values()) + [polyline.encode(json.loads(path))]
+
+
+def iter_export_csv(
+    main_conn,
+    path_conn,
+    username,
+    trip_ids=None,
+    compress=False,
+    chunk_size=EXPORT_CHUNK_SIZE,
+):
+    """
+    Generate the CSV export of the user's trips chunk by chunk, as strings, or
+    as gzip compressed bytes when `compress` is set.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def flush():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data.encode("utf-8")) if compress else data
+
+    header_written = False
+    for columns, rows, paths in iter_trip_chunks(
+        main_conn, path_conn, username, trip_ids, chunk_size
+    ):
+        if not header_written:
+            writer.writerow(
+                [column for column in columns if column != "ticket_id"] + ["path"]
+            )
+            header_written = True
+            # sent right away, so that the download starts immediately
+            yield flush()
+        writer.writerows(format_csv_row(row, paths[row["uid"]]) for row in rows)
+        yield flush()
+
+    if not header_written:
+        # no trip, the header is still expected
+        cursor = main_conn.execute("SELECT * FROM trip LIMIT 0")
+        writer.writerow(
+            [column[0] for column in cursor.description if column[0] != "ticket_id"]
+            + ["path"]
+        )
+        cursor.close()
+        yield flush()
+
+    if compress:
+        yield compressor.flush()
+
+
+def write_export_csv(filename, *args, **kwargs):
+    """Write the output of `iter_export_csv` to a file"""
+    mode = "wb" if kwargs.get("compress") else "w"
+    options = {} if kwargs.get("compress") else {"newline": "", "encoding": "utf-8"}
+    with open(filename, mode, **options) as file:
+        for chunk in iter_export_csv(*args, **kwargs):
+            file.write(chunk)
+
+
+def _to_datetime(value):
+    if value in (None, "", 1, -1, "1", "-1"):
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_string(value):
+    return None if value is None else str(value)
+
+
+def trip_arrow_schema(columns, geometry="coordinates"):
+    """
+    Arrow schema of the trip table columns (ticket_id excepted, like in the CSV
+    export), with is_project after the dates and the path last: [lat, lng]
+    pairs for "coordinates", a WGS84 LineString (lng, lat) for "wkb".
+    """
+    fields = []
+    for column in columns:
+        if column == "ticket_id":
+            continue
+        fields.append(pa.field(column, TRIP_ARROW_TYPES.get(column, pa.string())))
+        if column == "end_datetime":
+            fields.append(pa.field("is_project", pa.bool_()))
+    if geometry == "wkb":
+        fields.append(pa.field("geometry", pa.binary()))
+        # GeoParquet metadata, so that geopandas & co read it as a geometry
+        metadata = {
+            "geo": json.dumps(
+                {
+                    "version": "1.0.0",
+                    "primary_column": "geometry",
+                    "columns": {
+                        "geometry": {
+                            "encoding": "WKB",
+                            "geometry_types": ["LineString"],
+                        }
+                    },
+                }
+            )
+        }
+        return pa.schema(fields, metadata=metadata)
+    fields.append(pa.field("path", pa.list_(pa.list_(pa.float64(), 2))))
+    return pa.schema(fields)
+
+
+def _paths_column(rows, paths, geometry):
+    coordinates = [json.loads(paths[row["uid"]]) for row in rows]
+    if geometry == "coordinates":
+        return pa.array(coordinates, type=pa.list_(pa.list_(pa.float64(), 2)))
+
+    # a LineString needs two points, paths without any point have no geometry
+    present = [index for index, path in enumerate(coordinates) if path]
+    lines = [path if len(path) > 1 else path * 2 for path in coordinates if path]
+    wkb = [None] * len(rows)
+    if lines:
+        counts = np.fromiter(
+            (len(line) for line in lines), dtype=np.int64, count=len(lines)
+        )
+        points = np.array([point for line in lines for point in line], dtype=float)
+        geometries = shapely.linestrings(
+            points[:, ::-1], indices=np.repeat(np.arange(len(lines)), counts)
+        )
+        for index, value in zip(present, shapely.to_wkb(geometries)):
+            wkb[index] = value
+    return pa.array(wkb, type=pa.binary())
+
+
+def trip_record_batch(schema, rows, paths, geometry="coordinates"):
+    """Record batch of a chunk of trip rows and their paths"""
+    arrays = []
+    for field in schema:
+        name = field.name
+        if name in ("path", "geometry"):
+            arrays.append(_paths_column(rows, paths, geometry))
+        elif name == "is_project":
+            arrays.append(
+                pa.array(
+                    [
+                        row["start_datetime"] == 1 or row["end_datetime"] == 1
+                        for row in rows
+                    ],
+                    type=field.type,
+                )
+            )
+        else:
+            if pa.types.is_timestamp(field.type):
+                convert = _to_datetime
+            elif pa.types.is_floating(field.type):
+                convert = _to_float
+            elif pa.types.is_integer(field.type):
+                convert = int
+            else:
+                convert = _to_string
+            arrays.append(
+                pa.array([convert(row[name]) for row in rows], type=field.type)
+            )
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _parquet_options(schema):
+    # coordinates don't repeat, dictionaries only make them bigger, and
+    # splitting the bytes of the floats helps zstd a lot
+    return {
+        "compression": "zstd",
+        "use_dictionary": [
+            field.name for field in schema if field.name not in ("path", "geometry")
+        ],
+        "use_byte_stream_split": (
+            ["path.list.element.list.element"] if "path" in schema.names else False
+        ),
+    }
+
+
+def write_export_columnar(
+    filename,
+    file_format,
+    main_conn,
+    path_conn,
+    username,
+    trip_ids=None,
+    geometry="coordinates",
+    chunk_size=EXPORT_CHUNK_SIZE,
+):
+    """
+    Write the user's trips (or the given trip ids) to a zstd compressed Parquet
+    file or Arrow IPC file, one record batch per chunk of trips.
+    """
+    if file_format not in COLUMNAR_FORMATS:
+        raise ValueError(f"Unsupported format {file_format}")
+    if geometry not in GEOMETRY_ENCODINGS:
+        raise ValueError(f"Unsupported geometry encoding {geometry}")
+
+    writer = schema = None
+    try:
+        for columns, rows, paths in iter_trip_chunks(
+            main_conn, path_conn, username, trip_ids, chunk_size
+        ):
+            if writer is None:
+                schema = trip_arrow_schema(columns, geometry)
+                if file_format == "parquet":
+                    writer = pq.ParquetWriter(
+                        filename, schema, **_parquet_options(schema)
+                    )
+                else:
+                    writer = pa.ipc.new_file(
+                        filename,
+                        schema,
+                        options=pa.ipc.IpcWriteOptions(compression="zstd"),
+                    )
+            writer.write_batch(trip_record_batch(schema, rows, paths, geometry))
+
+        if writer is None:
+            # no trip, the schema is still expected
+            cursor = main_conn.execute("SELECT * FROM trip LIMIT 0")
+            schema = trip_arrow_schema(
+                [column[0] for column in cursor.description], geometry
+            )
+            cursor.close()
+            if file_format == "parquet":
+                pq.write_table(
+                    schema.empty_table(), filename, **_parquet_options(schema)
+                )
+            else:
+                with pa.ipc.new_file(filename, schema) as empty_writer:
+                    empty_writer.write_table(schema.empty_table())
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+if __name__ == "__main__":
+    # Peak memory and time to first byte of the former in-memory export vs the
+    # chunked one, on a synthetic user with 20k trips: python -m src.export [trips]
+    import os
+    import random
+    import sqlite3
+    import sys
+    import tempfile
+    import time
+    import tracemalloc
+
+    from py.db_init import init_main
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    directory = tempfile.mkdtemp()
+    main_conn = sqlite3.connect(os.path.join(directory, "main.db"))
+    path_conn = sqlite3.connect(os.path.join(directory, "path.db"))
+    init_main(os.path.join(directory, "main.db"))
+    with open("sql/initPath.sql") as f:
+        path_conn.execute(f.read())
+    main_conn.row_factory = path_conn.row_factory = sqlite3.Row
+
+    random.seed(0)
+    trips, paths = [], []
+    for uid in range(1, count + 1):
+        lat, lng = random.uniform(40, 55), random.uniform(-5, 20)
+        path = [
+            [lat + i * 0.001, lng + i * 0.0015] for i in range(random.randint(20, 600))
+        ]
+        trips.append(
+            (
+                uid,
+                "bench",
+                "Origin",
+                "Destination",
+                "2024-01-01 10:00:00",
+                "2024-01-01 12:00:00",
+                7200,
+                150000,
+                "SNCF, DB",
+                '{"FR": 100000, "DE": 50000}',
+                "TGV 9577",
+                "train",
+                json.dumps([]),
+                "notes",
+            )
+        )
+        paths.append((uid, json.dumps(path)))
+    main_conn.executemany(
+        """
+        INSERT INTO trip (uid, username, origin_station, destination_station, start_datetime,
+            end_datetime, estimated_trip_duration, trip_length, operator, countries,
+            line_name, type, waypoints, notes)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        trips,
+    )
+    path_conn.executemany("INSERT INTO paths (trip_id, path) VALUES (?, ?)", paths)
+    main_conn.commit()
+    path_conn.commit()
+    del trips, paths
+
+    def former_export():
+        si = StringIO()
+        cw = csv.writer(si)
+        cursor = main_conn.execute("SELECT * FROM trip WHERE username = ?", ("bench",))
+        rows = cursor.fetchall()
+        cw.writerow(
+            [i[0] for i in cursor.description if i[0] != "ticket_id"] + ["path"]
+        )
+        trip_ids = [row["uid"] for row in rows]
+        path_result = path_conn.execute(
+            getUserLines.format(trip_ids=", ".join(("?",) * len(trip_ids))), trip_ids
+        ).fetchall()
+        paths = {path["trip_id"]: path["path"] for path in path_result}
+        cw.writerows([format_csv_row(row, paths[row["uid"]]) for row in rows])
+        yield si.getvalue()
+
+    for name, generate in (
+        ("in memory", former_export),
+        ("chunked", lambda: iter_export_csv(main_conn, path_conn, "bench")),
+        (
+            "chunked gzip",
+            lambda: iter_export_csv(main_conn, path_conn, "bench", compress=True),
+        ),
+    ):
+        tracemalloc.start()
+        start = time.perf_counter()
+        first_byte = None
+        size = 0
+        for chunk in generate():
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)
+        total = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(
+            f"{name:>12}: first byte {first_byte * 1000:7.1f} ms, total {total:5.2f}s, "
+            f"peak {peak / 1024 / 1024:6.1f} MB, {size / 1024 / 1024:6.1f} MB output"
+        )
+
+    # Columnar exports vs CSV: time to write the file, its size, and time to
+    # load it back with the paths decoded (csv + polyline vs pyarrow)
+    def read_csv(filename):
+        with open(filename, newline="", encoding="utf-8") as file:
+            return [(row, polyline.decode(row["path"])) for row in csv.DictReader(file)]
+
+    def read_parquet(filename):
+        return pq.read_table(filename)
+
+    def read_arrow(filename):
+        with pa.memory_map(filename) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    print()
+    for name, write, read in (
+        (
+            "csv",
+            lambda filename: write_export_csv(filename, main_conn, path_conn, "bench"),
+            read_csv,
+        ),
+        (
+            "parquet",
+            lambda filename: write_export_columnar(
+                filename, "parquet", main_conn, path_conn, "bench"
+            ),
+            read_parquet,
+        ),
+        (
+            "parquet wkb",
+            lambda filename: write_export_columnar(
+                filename, "parquet", main_conn, path_conn, "bench", geometry="wkb"
+            ),
+            read_parquet,
+        ),
+        (
+            "arrow",
+            lambda filename: write_export_columnar(
+                filename, "arrow", main_conn, path_conn, "bench"
+            ),
+            read_arrow,
+        ),
+    ):
+        filename = os.path.join(directory, "export." + name.replace(" ", "_"))
+        start = time.perf_counter()
+        write(filename)
+        written = time.perf_counter() - start
+        start = time.perf_counter()
+        read(filename)
+        loaded = time.perf_counter() - start
+        print(
+            f"{name:>12}: write {written:5.2f}s, {os.path.getsize(filename) / 1024 / 1024:6.1f} MB, "
+            f"load with paths {loaded:5.2f}s"
+        )
@@ -0,0 +1,143 @@
+"""
+Import of a myFlightradar24 CSV export: all the flights of the file are parsed
+at once, airports being resolved with an AirportIndex and airlines looked up
+once per ICAO code through a single HTTP session.
+"""
+
+import csv
+import os
+from datetime import datetime, timedelta
+from io import StringIO
+
+import requests
+from flag import flag
+from requests.adapters import HTTPAdapter, Retry
+
+# the export starts with a header and a line that isn't a flight
+FR24_SKIPPED_LINES = 2
+
+
+def read_fr24_csv(data):
+    """Yield (line number, fields) for each flight of the export"""
+    reader = csv.reader(StringIO(data))
+    for index, fields in enumerate(reader):
+        if index < FR24_SKIPPED_LINES or not any(fields):
+            continue
+        yield reader.line_num, fields
+
+
+def _duration(value):
+    hours, minutes, seconds = map(int, value.split(":"))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_fr24_flight(data, airports):
+    """
+    Trip form data (as built by the trip form) and path of a flight, from the
+    fields of its row. Airports are looked up by IATA code in `airports`.
+    """
+    newTrip = {}
+    newPath = []
+
+    newTrip["material_type"] = data[8].rsplit("(")[1].rsplit(")")[0]
+    newTrip["seat"] = data[10]
+    newTrip["reg"] = data[9]
+    newTrip["notes"] = data[14]
+    newTrip["price"] = newTrip["currency"] = newTrip["purchasing_date"] = None
+
+    if "-" not in data[0]:
+        # data[0] contains only a year
+        data[0] = data[0] + "-01-01"  # Set to January 1st of that year
+        data[4] = data[5] = "00:00:01"  # Set time to 00:00:01
+        newTrip["precision"] = "onlyDate"
+        newTrip["onlyDate"] = data[0]
+    elif data[4] == "00:00:00":
+        data[4] = data[5] = "00:00:01"
+        newTrip["precision"] = "onlyDate"
+        newTrip["onlyDate"] = data[0]
+    else:
+        newTrip["newTripStart"] = (data[0] + "T" + data[4])[0:16]
+        end_datetime = (data[0] + "T" + data[5])[0:16]
+        if datetime.strptime(data[5], "%H:%M:%S") - datetime.strptime(
+            data[4], "%H:%M:%S"
+        ) < timedelta(0):
+            end_datetime = datetime.strftime(
+                datetime.strptime(end_datetime, "%Y-%m-%dT%H:%M") + timedelta(days=1),
+                "%Y-%m-%dT%H:%M",
+            )
+        newTrip["newTripEnd"] = end_datetime
+        newTrip["precision"] = "preciseDates"
+
+    if newTrip["precision"] == "onlyDate":
+        try:
+            # Handle estimated trip duration if available
+            newTrip["onlyDateDuration"] = _duration(data[6])
+        except (IndexError, ValueError):
+            # Default duration if data[6] is missing or invalid
+            newTrip["onlyDateDuration"] = 0
+
+    newTrip["lineName"] = data[1]
+    origIata = data[2].rsplit("(")[-1].split("/")[0]
+    destIata = data[3].rsplit("(")[-1].split("/")[0]
+
+    timedeltaObj = datetime.strptime(data[6], "%H:%M:%S") - datetime(1900, 1, 1)
+    newTrip["estimated_trip_duration"] = timedeltaObj.total_seconds()
+
+    for iata, index in (
+        (origIata, "originStation"),
+        (destIata, "destinationStation"),
+    ):
+        airport = airports.iata.get(iata)
+        if airport is None:
+            raise ValueError(f"Unknown airport {iata}")
+        newTrip[index] = [
+            [airport.latitude, airport.longitude],
+            "{} {} ({})".format(flag(airport.iso_country), airport.name, airport.iata),
+        ]
+        newPath.append({"lat": airport.latitude, "lng": airport.longitude})
+
+    newTrip["airline"] = data[7].strip('"').rsplit(" ", 1)[0]
+    newTrip["airline_icao"] = data[7].strip('"').rsplit("/", 1)[1].replace(")", "")
+    return newTrip, newPath
+
+
+class AirlineLookup:
+    """
+    Airline names and logos from API Ninjas, through one session with retries.
+    Each ICAO code is requested once, and each logo downloaded once.
+    """
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.session = requests.Session()
+        retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504])
+        self.session.mount("https://", HTTPAdapter(max_retries=retries))
+        self.airlines = {}
+        self.logos = set()
+
+    def get(self, icao):
+        """API Ninjas data of the airline, None if unknown"""
+        if icao not in self.airlines:
+            response = self.session.get(
+                "https://api.api-ninjas.com/v1/airlines",
+                params={"icao": icao},
+                headers={"X-Api-Key": self.api_key},
+            )
+            airline = None
+            if response.status_code == requests.codes.ok and response.json() != []:
+                airline = response.json()[0]
+            self.airlines[icao] = airline
+        return self.airlines[icao]
+
+    def save_logo(self, operator, logo_url, logo_path):
+        """Download the logo of the operator to `logo_path`, unless it exists"""
+        if operator in self.logos or os.path.exists(logo_path):
+            return
+        self.logos.add(operator)
+        base_url = "https://api-ninjas.com/images/airline_logos/"
+        response = self.session.get(base_url + logo_url.split("/")[-1])
+        with open(logo_path, "wb") as f:
+            f.write(response.content)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,523 @@
+"""
+Background jobs, queued in an SQLite table and run by separate worker
+processes (see worker.py), so that long operations don't hold web workers.
+
+Jobs are registered by type with `@job_handler`, queued with `enqueue_job`
+and followed with `get_job`. A job is a function called with its JSON payload
+as keyword arguments plus a `progress(percent)` callback, and its return value
+must be JSON serializable. Jobs producing a file return a dict with its "file"
+path (in a `new_job_dir()` directory) and optionally "download_name",
+"mimetype" and "as_attachment".
+"""
+
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+
+from flask import has_request_context, request, session
+
+from py.utils import load_config
+from src.consts import DbNames
+
+logger = logging.getLogger(__name__)
+
+jobs_config = load_config().get("jobs", {})
+
+WORKERS = jobs_config.get("workers", 2)
+MAX_ATTEMPTS = jobs_config.get("max_attempts", 3)
+# seconds before the first retry, doubled at each attempt
+RETRY_DELAY = jobs_config.get("retry_delay", 10)
+# jobs of a single user running at the same time
+USER_CONCURRENCY = jobs_config.get("per_user_limit", 2)
+# jobs of all anonymous visitors queued or running at the same time
+ANONYMOUS_LIMIT = jobs_config.get("anonymous_limit", 20)
+# a running job without heartbeat for that long is considered lost
+STALE_AFTER = jobs_config.get("stale_after", 300)
+HEARTBEAT_INTERVAL = 30
+POLL_INTERVAL = 1
+
+# files uploaded for, or produced by, jobs, removed after FILES_TTL seconds
+JOB_FILES_DIR = "databases/job_files"
+FILES_TTL = jobs_config.get("files_ttl", 24 * 3600)
+# finished jobs are forgotten after that many seconds
+HISTORY_TTL = 30 * 24 * 3600
+
+
+class JobStatus:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class JobError(Exception):
+    """
+    Raised by a job to fail without being retried. Its message is shown to the
+    user, unlike the one of any other exception.
+    """
+
+
+class JobQueueFull(Exception):
+    """Raised by enqueue_job when anonymous visitors have too many jobs waiting"""
+
+
+# owners of the jobs of visitors who aren't logged in, followed by an id kept
+# in their session
+ANONYMOUS_OWNER = "public:"
+
+
+COLUMNS = {
+    "uid": "INTEGER PRIMARY KEY AUTOINCREMENT",
+    "username": "TEXT NOT NULL",
+    "type": "TEXT NOT NULL",
+    "status": "TEXT NOT NULL",
+    "progress": "FLOAT DEFAULT 0",
+    "payload": "TEXT",
+    "url": "TEXT",
+    "result": "TEXT",
+    "error": "TEXT",
+    "attempts": "INTEGER DEFAULT 0",
+    "max_attempts": "INTEGER DEFAULT 1",
+    # epoch seconds
+    "run_after": "REAL DEFAULT 0",
+    "heartbeat": "REAL",
+    "worker": "TEXT",
+    "created": "DATETIME",
+    "last_modified": "DATETIME",
+}
+
+_handlers = {}
+
+_conn = None
+_conn_pid = None
+_conn_lock = threading.Lock()
+
+_current_job = None
+_stopping = threading.Event()
+
+
+def _connection():
+    """
+    Connection to the jobs database, opened once per process. The database is
+    shared by the web and job workers.
+    """
+    global _conn, _conn_pid
+    if _conn is None or _conn_pid != os.getpid():
+        _conn = sqlite3.connect(
+            DbNames.JOBS_DB.value, timeout=10, check_same_thread=False
+        )
+        _conn.row_factory = sqlite3.Row
+        _conn.execute("PRAGMA journal_mode=WAL")
+        columns = ", ".join(
+            f"{name} {definition}" for name, definition in COLUMNS.items()
+        )
+        _conn.execute(f"CREATE TABLE IF NOT EXISTS jobs ({columns})")
+        existing = {row["name"] for row in _conn.execute("PRAGMA table_info(jobs)")}
+        for name, definition in COLUMNS.items():
+            if name not in existing:
+                _conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+        _conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, run_after)"
+        )
+        _conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_username ON jobs (username, status)"
+        )
+        _conn.commit()
+        _conn_pid = os.getpid()
+    return _conn
+
+
+def _execute(query, params=()):
+    with _conn_lock:
+        conn = _connection()
+        cursor = conn.execute(query, params)
+        conn.commit()
+        return cursor
+
+
+def _update_job(job_id, **fields):
+    fields["last_modified"] = datetime.now()
+    assignments = ", ".join(f"{name} = :{name}" for name in fields)
+    _execute(
+        f"UPDATE jobs SET {assignments} WHERE uid = :uid", {**fields, "uid": job_id}
+    )
+
+
+def _decode(row):
+    job = dict(row)
+    job["payload"] = json.loads(job["payload"]) if job["payload"] else {}
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def get_job(job_id, username=None):
+    """
+    Return the job as a dict, or None if it doesn't exist (or doesn't belong to
+    `username` when given)
+    """
+    with _conn_lock:
+        row = (
+            _connection()
+            .execute("SELECT * FROM jobs WHERE uid = ?", (job_id,))
+            .fetchone()
+        )
+    if row is None or (username is not None and row["username"] != username):
+        return None
+    return _decode(row)
+
+
+def get_user_jobs(username, limit=50):
+    """Latest jobs of a user, most recent first"""
+    with _conn_lock:
+        rows = (
+            _connection()
+            .execute(
+                "SELECT * FROM jobs WHERE username = ? ORDER BY uid DESC LIMIT ?",
+                (username, limit),
+            )
+            .fetchall()
+        )
+    return [_decode(row) for row in rows]
+
+
+def job_handler(job_type, max_attempts=MAX_ATTEMPTS):
+    """
+    Register the decorated function as the handler of `job_type` jobs.
+    Jobs that can't safely run twice must use max_attempts=1.
+    """
+
+    def decorator(func):
+        _handlers[job_type] = (func, max_attempts)
+        return func
+
+    return decorator
+
+
+def job_owner(create=True):
+    """
+    Owner of the jobs of the current request: the logged in user, or for an
+    anonymous visitor an id kept in their session (created if `create` is set,
+    None otherwise), so that visitors neither share nor see each other's jobs
+    """
+    username = session.get("logged_in")
+    if username:
+        return username
+    if "job_owner" not in session:
+        if not create:
+            return None
+        session["job_owner"] = uuid.uuid4().hex
+    return ANONYMOUS_OWNER + session["job_owner"]
+
+
+def enqueue_job(username, job_type, payload=None):
+    """
+    Queue a job of a registered type for `username` and return its id, or the
+    id of their queued or running job of the same type and payload if any.
+    `payload` is the dict of keyword arguments of the handler. The URL of the
+    current request is kept, the job runs in a request context built from it.
+    Raises JobQueueFull if anonymous visitors already have ANONYMOUS_LIMIT jobs
+    waiting, since each visitor without cookies is a new owner.
+    """
+    _, max_attempts = _handlers[job_type]
+    payload = json.dumps(payload or {}, sort_keys=True)
+    now = datetime.now()
+    pending = (JobStatus.QUEUED, JobStatus.RUNNING)
+    with _conn_lock:
+        conn = _connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """
+                SELECT uid FROM jobs
+                WHERE username = ? AND type = ? AND payload = ? AND status IN (?, ?)
+                ORDER BY uid DESC
+                LIMIT 1
+                """,
+                (username, job_type, payload, *pending),
+            ).fetchone()
+            if row is not None:
+                conn.commit()
+                return row["uid"]
+            if username.startswith(ANONYMOUS_OWNER):
+                (anonymous,) = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE username LIKE ? AND status IN (?, ?)",
+                    (ANONYMOUS_OWNER + "%", *pending),
+                ).fetchone()
+                if anonymous >= ANONYMOUS_LIMIT:
+                    raise JobQueueFull(
+                        f"{anonymous} anonymous jobs waiting, not queuing {job_type}"
+                    )
+            job_id = conn.execute(
+                """
+                INSERT INTO jobs (username, type, status, payload, url, max_attempts, created, last_modified)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    username,
+                    job_type,
+                    JobStatus.QUEUED,
+                    payload,
+                    request.url if has_request_context() else None,
+                    max_attempts,
+                    now,
+                    now,
+                ),
+            ).lastrowid
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    logger.info(f"Queued {job_type} job {job_id} for {username}")
+    return job_id
+
+
+def last_done_job(job_type, payload=None):
+    """
+    Latest job of that type and payload that is done, whoever started it, as a
+    dict, or None
+    """
+    with _conn_lock:
+        row = (
+            _connection()
+            .execute(
+                """
+                SELECT * FROM jobs
+                WHERE type = ? AND payload = ? AND status = ?
+                ORDER BY uid DESC
+                LIMIT 1
+                """,
+                (job_type, json.dumps(payload or {}, sort_keys=True), JobStatus.DONE),
+            )
+            .fetchone()
+        )
+    return None if row is None else _decode(row)
+
+
+def new_job_dir():
+    """Create and return a directory for the files of a job"""
+    directory = os.path.join(JOB_FILES_DIR, uuid.uuid4().hex)
+    os.makedirs(directory)
+    return directory
+
+
+def is_job_file(path):
+    return os.path.realpath(path).startswith(os.path.realpath(JOB_FILES_DIR) + os.sep)
+
+
+def _claim(worker):
+    """
+    Mark the oldest runnable job as running and return it, or None.
+    Jobs of users already running USER_CONCURRENCY jobs are skipped.
+    """
+    now = time.time()
+    with _conn_lock:
+        conn = _connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # jobs of workers that died go back to the queue
+            conn.execute(
+                """
+                UPDATE jobs
+                SET status = CASE WHEN attempts >= max_attempts THEN :failed ELSE :queued END,
+                    error = 'Worker lost', worker = NULL
+                WHERE status = :running AND heartbeat < :stale
+                """,
+                {
+                    "failed": JobStatus.FAILED,
+                    "queued": JobStatus.QUEUED,
+                    "running": JobStatus.RUNNING,
+                    "stale": now - STALE_AFTER,
+                },
+            )
+            row = conn.execute(
+                """
+                SELECT * FROM jobs
+                WHERE status = :queued AND run_after <= :now
+                AND (
+                    SELECT COUNT(*) FROM jobs AS running
+                    WHERE running.username = jobs.username AND running.status = :running
+                ) < :limit
+                ORDER BY uid
+                LIMIT 1
+                """,
+                {
+                    "queued": JobStatus.QUEUED,
+                    "running": JobStatus.RUNNING,
+                    "now": now,
+                    "limit": USER_CONCURRENCY,
+                },
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    """
+                    UPDATE jobs
+                    SET status = ?, worker = ?, attempts = attempts + 1, heartbeat = ?, last_modified = ?
+                    WHERE uid = ?
+                    """,
+                    (JobStatus.RUNNING, worker, now, datetime.now(), row["uid"]),
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    if row is None:
+        return None
+    job = _decode(row)
+    job["attempts"] += 1
+    return job
+
+
+def _heartbeat():
+    while not _stopping.wait(HEARTBEAT_INTERVAL):
+        job_id = _current_job
+        if job_id is not None:
+            try:
+                _execute(
+                    "UPDATE jobs SET heartbeat = ? WHERE uid = ?", (time.time(), job_id)
+                )
+            except Exception as e:
+                logger.warning(f"Job {job_id} heartbeat failed: {e}")
+
+
+def _user_error(e):
+    """
+    Error stored with a failed job, to be shown to the user: only the message
+    of a JobError, other exceptions (SQLite errors, paths...) are only logged
+    """
+    return str(e) if isinstance(e, JobError) else None
+
+
+def _run(app, job):
+    global _current_job
+    job_id = job["uid"]
+
+    def progress(percent):
+        _update_job(job_id, progress=round(percent, 1), heartbeat=time.time())
+
+    if job["type"] not in _handlers:
+        _update_job(job_id, status=JobStatus.FAILED, error="Unknown job type")
+        return
+    func, _ = _handlers[job["type"]]
+
+    _current_job = job_id
+    start = time.perf_counter()
+    try:
+        with app.test_request_context(job["url"] or "/"):
+            # "public" jobs were queued before anonymous visitors had owners
+            owner = job["username"]
+            if owner != "public" and not owner.startswith(ANONYMOUS_OWNER):
+                session["logged_in"] = owner
+            result = func(**job["payload"], progress=progress)
+    except Exception as e:
+        retry = not isinstance(e, JobError) and job["attempts"] < job["max_attempts"]
+        logger.error(
+            f"Job {job_id} ({job['type']}) failed, attempt {job['attempts']}/"
+            f"{job['max_attempts']}: {traceback.format_exc()}"
+        )
+        if retry:
+            _update_job(
+                job_id,
+                status=JobStatus.QUEUED,
+                error=_user_error(e),
+                worker=None,
+                run_after=time.time() + RETRY_DELAY * 2 ** (job["attempts"] - 1),
+            )
+        else:
+            _update_job(job_id, status=JobStatus.FAILED, error=_user_error(e))
+    else:
+        _update_job(
+            job_id,
+            status=JobStatus.DONE,
+            progress=100,
+            error=None,
+            result=json.dumps(result),
+        )
+        logger.info(
+            f"Job {job_id} ({job['type']}) done in {time.perf_counter() - start:.1f}s"
+        )
+    finally:
+        _current_job = None
+
+
+def run_worker(app_module, name):
+    """
+    Job worker process: imports the app (which registers the handlers), then
+    runs the queued jobs one at a time until SIGTERM.
+    """
+    signal.signal(signal.SIGTERM, lambda *args: _stopping.set())
+    # the supervisor stops the workers, let the current job finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    app = importlib.import_module(app_module).app
+    threading.Thread(target=_heartbeat, daemon=True).start()
+    logger.info(f"Job worker {name} started")
+    while not _stopping.is_set():
+        job = _claim(name)
+        if job is None:
+            _stopping.wait(POLL_INTERVAL)
+            continue
+        _run(app, job)
+
+
+def cleanup():
+    """Remove expired job files and forget old finished jobs"""
+    now = time.time()
+    if os.path.isdir(JOB_FILES_DIR):
+        for entry in os.scandir(JOB_FILES_DIR):
+            if now - entry.stat().st_mtime > FILES_TTL:
+                shutil.rmtree(entry.path, ignore_errors=True)
+    _execute(
+        "DELETE FROM jobs WHERE status IN (?, ?) AND created < ?",
+        (
+            JobStatus.DONE,
+            JobStatus.FAILED,
+            datetime.fromtimestamp(now - HISTORY_TTL),
+        ),
+    )
+
+
+def run_workers(app_module="app", count=WORKERS):
+    """
+    Start `count` worker processes and restart them if they die, until SIGTERM
+    or SIGINT. Workers are spawned, each one importing the app on its own.
+    """
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    os.makedirs(JOB_FILES_DIR, exist_ok=True)
+
+    last_cleanup = 0
+    while not stop.is_set():
+        for index in range(count):
+            process = workers.get(index)
+            if process is None or not process.is_alive():
+                if process is not None:
+                    logger.warning(
+                        f"Job worker {index} exited ({process.exitcode}), restarting"
+                    )
+                process = context.Process(
+                    target=run_worker,
+                    args=(app_module, f"{os.uname().nodename}-{index}"),
+                )
+                process.start()
+                workers[index] = process
+        if time.time() - last_cleanup > 3600:
+            cleanup()
+            last_cleanup = time.time()
+        stop.wait(5)
+
+    for process in workers.values():
+        process.terminate()
+    for process in workers.values():
+        process.join()
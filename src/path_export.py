@@ -0,0 +1,277 @@
+"""
+Download of trip paths as GPX or GeoJSON files, zipped when there are several.
+Trips and paths are each read with one query, and every file is encoded a few
+points at a time and written into a zip that is sent while it is being built.
+"""
+
+import json
+import re
+import unicodedata
+import zipfile
+
+PATH_FORMATS = {
+    "gpx": "application/gpx+xml",
+    "geojson": "application/geo+json",
+}
+
+PATHS_CHUNK_SIZE = 100
+POINTS_CHUNK_SIZE = 1000
+
+
+def sanitize_filename(filename):
+    """
+    Sanitize the filename by keeping only alphanumerical characters and
+    accentuated letters. Replace any other characters with underscores.
+    """
+    # Normalize Unicode to decompose characters
+    normalized = unicodedata.normalize("NFKC", filename)
+    # Replace invalid characters with an underscore
+    sanitized = re.sub(r"[^\w\s\-\.À-ÿ]", "", normalized, flags=re.UNICODE)
+    # Optionally replace spaces with underscores
+    return sanitized.strip()
+
+
+def path_filename(trip, format_type):
+    return sanitize_filename(
+        f"{trip['origin_station']} -{trip['destination_station']}-{trip['uid']}.{format_type}"
+    )
+
+
+def get_path_trips(main_conn, trip_ids):
+    """Trips (uid, username and stations) of the given ids, by uid"""
+    cursor = main_conn.execute(
+        """
+        SELECT uid, username, origin_station, destination_station FROM trip
+        WHERE uid IN (SELECT value FROM json_each(?))
+        """,
+        (json.dumps([int(trip_id) for trip_id in trip_ids]),),
+    )
+    try:
+        return {trip["uid"]: trip for trip in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+def get_trips_with_path(path_conn, trip_ids):
+    """Ids among `trip_ids` that have a path"""
+    cursor = path_conn.execute(
+        "SELECT trip_id FROM paths WHERE trip_id IN (SELECT value FROM json_each(?))",
+        (json.dumps([int(trip_id) for trip_id in trip_ids]),),
+    )
+    try:
+        return {row[0] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+def iter_paths(path_conn, trip_ids, chunk_size=PATHS_CHUNK_SIZE):
+    """Yield (trip_id, path) for the given trips, paths being read chunk by chunk"""
+    cursor = path_conn.execute(
+        "SELECT trip_id, path FROM paths WHERE trip_id IN (SELECT value FROM json_each(?))",
+        (json.dumps([int(trip_id) for trip_id in trip_ids]),),
+    )
+    try:
+        while rows := cursor.fetchmany(chunk_size):
+            for row in rows:
+                yield row[0], row[1]
+    finally:
+        cursor.close()
+
+
+def _chunks(coordinates, size=POINTS_CHUNK_SIZE):
+    for start in range(0, len(coordinates), size):
+        yield coordinates[start : start + size]
+
+
+def iter_gpx(coordinates):
+    """GPX track of the [lat, lng] coordinates, as string pieces"""
+    yield '<gpx version="1.1" creator="Trainlog.me"><trk><name>Trip Path</name>'
+    if not coordinates:
+        yield "<trkseg /></trk></gpx>"
+        return
+    yield "<trkseg>"
+    for chunk in _chunks(coordinates):
+        yield "".join(f'<trkpt lat="{lat}" lon="{lng}" />' for lat, lng in chunk)
+    yield "</trkseg></trk></gpx>"
+
+
+def iter_geojson(coordinates):
+    """
+    GeoJSON FeatureCollection of the [lat, lng] coordinates as a LineString,
+    rounded to 6 decimals like the geojson package does
+    """
+    yield (
+        '{"type": "FeatureCollection", "features": [{"type": "Feature", '
+        '"geometry": {"type": "LineString", "coordinates": ['
+    )
+    separator = ""
+    for chunk in _chunks(coordinates):
+        yield separator + ", ".join(
+            f"[{round(lng, 6)}, {round(lat, 6)}]" for lat, lng in chunk
+        )
+        separator = ", "
+    yield ']}, "properties": {}}]}'
+
+
+def iter_path_file(path, format_type):
+    """Encoded pieces of a path (as stored) in the requested format"""
+    coordinates = json.loads(path)
+    if format_type == "gpx":
+        pieces = iter_gpx(coordinates)
+    elif format_type == "geojson":
+        pieces = iter_geojson(coordinates)
+    else:
+        raise ValueError("Unsupported format")
+    for piece in pieces:
+        yield piece.encode("utf-8")
+
+
+class _ZipStream:
+    """Unseekable file object collecting what zipfile writes until it is sent"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_path_zip(path_conn, trips, format_type, chunk_size=PATHS_CHUNK_SIZE):
+    """
+    Zip of the paths of `trips` (as returned by `get_path_trips`), one file per
+    trip, yielded as bytes while each file is being compressed.
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as zf:
+        for trip_id, path in iter_paths(path_conn, list(trips), chunk_size):
+            with zf.open(path_filename(trips[trip_id], format_type), "w") as file:
+                for piece in iter_path_file(path, format_type):
+                    file.write(piece)
+                    if sum(len(chunk) for chunk in stream.chunks) >= 64 * 1024:
+                        yield stream.pop()
+            yield stream.pop()
+    yield stream.pop()
+
+
+def iter_path_download(path_conn, trips, format_type):
+    """The single path file when there is one trip, the zip of all files otherwise"""
+    if len(trips) == 1:
+        for _, path in iter_paths(path_conn, list(trips)):
+            yield from iter_path_file(path, format_type)
+    else:
+        yield from iter_path_zip(path_conn, trips, format_type)
+
+
+if __name__ == "__main__":
+    # Peak memory, time to first byte and total time of the former in-memory
+    # archive vs the streamed one: python -m src.path_export [trips]
+    import io
+    import os
+    import random
+    import sqlite3
+    import sys
+    import tempfile
+    import time
+    import tracemalloc
+    import xml.etree.ElementTree as ET
+
+    import geojson
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    directory = tempfile.mkdtemp()
+    main_conn = sqlite3.connect(os.path.join(directory, "main.db"))
+    path_conn = sqlite3.connect(os.path.join(directory, "path.db"))
+    main_conn.execute(
+        "CREATE TABLE trip (uid INTEGER PRIMARY KEY, username TEXT, "
+        "origin_station TEXT, destination_station TEXT)"
+    )
+    with open("sql/initPath.sql") as f:
+        path_conn.execute(f.read())
+    path_conn.execute("CREATE INDEX paths_trip_id ON paths (trip_id)")
+
+    random.seed(0)
+    trips, paths = [], []
+    for uid in range(1, count + 1):
+        lat, lng = random.uniform(40, 55), random.uniform(-5, 20)
+        path = [
+            [round(lat + i * 0.001, 5), round(lng + i * 0.0015, 5)]
+            for i in range(random.randint(50, 2000))
+        ]
+        trips.append((uid, "bench", f"Origin {uid}", f"Destination {uid}"))
+        paths.append((uid, json.dumps(path)))
+    main_conn.executemany("INSERT INTO trip VALUES (?, ?, ?, ?)", trips)
+    path_conn.executemany("INSERT INTO paths (trip_id, path) VALUES (?, ?)", paths)
+    main_conn.commit()
+    path_conn.commit()
+    main_conn.row_factory = path_conn.row_factory = sqlite3.Row
+    trip_ids = [trip[0] for trip in trips]
+    del trips, paths
+
+    def former_zip(format_type):
+        # per trip queries, files built in memory and zipped into a BytesIO
+        files = []
+        for trip_id in trip_ids:
+            trip = main_conn.execute(
+                "SELECT * FROM trip WHERE uid = ?", (trip_id,)
+            ).fetchone()
+            path = path_conn.execute(
+                "SELECT path FROM paths WHERE trip_id = ?", (trip_id,)
+            ).fetchone()
+            coordinates = json.loads(path["path"])
+            if format_type == "gpx":
+                gpx = ET.Element("gpx", version="1.1", creator="Trainlog.me")
+                trk = ET.SubElement(gpx, "trk")
+                ET.SubElement(trk, "name").text = "Trip Path"
+                trkseg = ET.SubElement(trk, "trkseg")
+                for point in coordinates:
+                    ET.SubElement(trkseg, "trkpt", lat=str(point[0]), lon=str(point[1]))
+                data = ET.tostring(gpx, encoding="utf-8", method="xml").decode("utf-8")
+            else:
+                line = geojson.LineString(
+                    [(point[1], point[0]) for point in coordinates]
+                )
+                data = geojson.dumps(
+                    geojson.FeatureCollection([geojson.Feature(geometry=line)])
+                )
+            files.append((path_filename(trip, format_type), data))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+            for filename, data in files:
+                zf.writestr(filename, data)
+        yield buffer.getvalue()
+
+    def streamed_zip(format_type):
+        trips = get_path_trips(main_conn, trip_ids)
+        get_trips_with_path(path_conn, trip_ids)
+        yield from iter_path_download(path_conn, trips, format_type)
+
+    for format_type in ("gpx", "geojson"):
+        for name, generate in (("in memory", former_zip), ("streamed", streamed_zip)):
+            # timed without tracemalloc, which slows allocations down a lot
+            start = time.perf_counter()
+            first_byte = None
+            size = 0
+            for chunk in generate(format_type):
+                if first_byte is None and chunk:
+                    first_byte = time.perf_counter() - start
+                size += len(chunk)
+            total = time.perf_counter() - start
+            tracemalloc.start()
+            for chunk in generate(format_type):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                f"{format_type:>7} {name:>9}: first byte {first_byte * 1000:8.1f} ms, "
+                f"total {total:6.2f}s, peak {peak / 1024 / 1024:7.1f} MB, "
+                f"{size / 1024 / 1024:6.1f} MB zip"
+            )
@@ -2,17 +2,35 @@ import logging
 import os
 import re
 import threading
+import time
+import traceback
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.orm import sessionmaker
 
+from py.utils import load_config
 from src import sql
 from src.consts import Env
+from src.worker_stats import WorkerStats
 
 logger = logging.getLogger(__name__)
 threadlocal = threading.local()
 
+pool_config = load_config().get("pg", {}).get("pool", {})
+
+# pool of each process (each gunicorn worker has its own), SQLAlchemy defaults
+POOL_SIZE = pool_config.get("size", 5)
+MAX_OVERFLOW = pool_config.get("max_overflow", 10)
+# seconds to wait for a connection before giving up
+POOL_TIMEOUT = pool_config.get("timeout", 30)
+# seconds after which connections are replaced, -1 to keep them
+POOL_RECYCLE = pool_config.get("recycle", -1)
+POOL_PRE_PING = pool_config.get("pre_ping", False)
+# seconds of python work (outside of queries) during a session above which it
+# is reported for holding its connection
+SLOW_SESSION = pool_config.get("slow_session", 1)
+
 
 @contextmanager
 def pg_session():
@@ -21,10 +39,20 @@ def pg_session():
         raise Exception("Cannot open a pg session while already in a pg session")
 
     threadlocal.inside_pg_session = True
+    threadlocal.query_time = 0.0
     session = Session()
+    start = time.perf_counter()
+    checked_out = None
 
     # roll back the transaction if any exception is raised
     try:
+        # check the connection out now, to time the wait for the pool
+        try:
+            session.connection()
+        except exc.TimeoutError:
+            stats.add(timeouts=1)
+            raise
+        checked_out = time.perf_counter()
         yield session
         session.commit()
     except Exception as e:
@@ -34,6 +62,108 @@ def pg_session():
     finally:
         session.close()
         threadlocal.inside_pg_session = False
+        if checked_out is not None:
+            _record_session(checked_out - start, time.perf_counter() - checked_out)
+
+
+def _record_session(wait, held):
+    python_time = held - threadlocal.query_time
+    stats.add(
+        sessions=1,
+        total_wait=wait,
+        total_held=held,
+        slow_sessions=int(python_time > SLOW_SESSION),
+    )
+    stats.maximum(max_wait=wait, max_held=held)
+    if python_time > SLOW_SESSION:
+        # the frame of the `with pg_session()` block
+        caller = next(
+            (
+                frame
+                for frame in reversed(traceback.extract_stack()[:-1])
+                if frame.filename not in (__file__, contextmanager.__code__.co_filename)
+            ),
+            None,
+        )
+        logger.warning(
+            f"PG session held {held:.1f}s ({python_time:.1f}s outside of queries) "
+            f"at {caller.filename}:{caller.lineno} in {caller.name}"
+            if caller
+            else f"PG session held {held:.1f}s ({python_time:.1f}s outside of queries)"
+        )
+
+
+def _pool_gauges():
+    pool = pg_session_engine.pool
+    return {
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(pool.overflow(), 0),
+    }
+
+
+def _summarize_stats(totals):
+    """Pool state (in all the pools) and session counters"""
+    sessions = totals["sessions"]
+    return {
+        "pool": {
+            # of each process
+            "size": POOL_SIZE,
+            "max_overflow": MAX_OVERFLOW,
+            "timeout": POOL_TIMEOUT,
+            "recycle": POOL_RECYCLE,
+            "checked_in": totals["checked_in"],
+            "checked_out": totals["checked_out"],
+            "overflow": totals["overflow"],
+        },
+        "sessions": sessions,
+        "timeouts": totals["timeouts"],
+        "slow_sessions": totals["slow_sessions"],
+        "connects": totals["connects"],
+        "checkouts": totals["checkouts"],
+        "avg_wait_ms": totals["total_wait"] * 1000 / sessions if sessions else None,
+        "max_wait_ms": totals["max_wait"] * 1000,
+        "avg_held_ms": totals["total_held"] * 1000 / sessions if sessions else None,
+        "max_held_ms": totals["max_held"] * 1000,
+        "peak_overflow": totals["peak_overflow"],
+        "max_connection_age_s": totals["max_connection_age"],
+    }
+
+
+stats = WorkerStats(
+    "pg",
+    {
+        "sessions": 0,
+        "timeouts": 0,
+        "connects": 0,
+        "checkouts": 0,
+        "total_wait": 0.0,
+        "max_wait": 0.0,
+        "total_held": 0.0,
+        "max_held": 0.0,
+        "slow_sessions": 0,
+        "peak_overflow": 0,
+        "max_connection_age": 0,
+    },
+    gauges=_pool_gauges,
+    summarize=_summarize_stats,
+)
+
+
+def copy_expert(pg, query, file):
+    """
+    Run a COPY on the raw psycopg2 cursor of the session. It bypasses the
+    cursor events, so its duration is added to the query time of the session
+    here, not to its python time.
+    """
+    start = time.perf_counter()
+    try:
+        with pg.connection().connection.cursor() as cursor:
+            cursor.copy_expert(query, file)
+    finally:
+        threadlocal.query_time = (
+            getattr(threadlocal, "query_time", 0.0) + time.perf_counter() - start
+        )
 
 
 @contextmanager
@@ -162,5 +292,42 @@ def get_db_connection_string():
 
 
 # setup to easily create database sessions
-pg_session_engine = create_engine(get_db_connection_string())
+pg_session_engine = create_engine(
+    get_db_connection_string(),
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
+    pool_recycle=POOL_RECYCLE,
+    pool_pre_ping=POOL_PRE_PING,
+)
 Session = sessionmaker(bind=pg_session_engine)
+
+
+@event.listens_for(pg_session_engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    connection_record.info["connected_at"] = time.monotonic()
+    stats.add(connects=1)
+
+
+@event.listens_for(pg_session_engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    age = time.monotonic() - connection_record.info.get(
+        "connected_at", time.monotonic()
+    )
+    overflow = pg_session_engine.pool.overflow()
+    stats.add(checkouts=1)
+    stats.maximum(peak_overflow=overflow, max_connection_age=round(age))
+
+
+@event.listens_for(pg_session_engine, "before_cursor_execute")
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start"] = time.perf_counter()
+
+
+@event.listens_for(pg_session_engine, "after_cursor_execute")
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("query_start", None)
+    if start is not None:
+        threadlocal.query_time = (
+            getattr(threadlocal, "query_time", 0.0) + time.perf_counter() - start
+        )
@@ -0,0 +1,401 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+from py.utils import load_config
+from src.consts import DbNames
+from src.worker_stats import WorkerStats
+
+logger = logging.getLogger(__name__)
+
+routing_config = load_config().get("routing", {})
+
+# (connect, read) timeouts in seconds, used when the caller doesn't give one
+DEFAULT_TIMEOUT = (
+    routing_config.get("connect_timeout", 3.05),
+    routing_config.get("read_timeout", 30),
+)
+POOL_MAXSIZE = routing_config.get("pool_maxsize", 20)
+CACHE_MAX_BYTES = routing_config.get("cache_size_mb", 256) * 1024 * 1024
+# seconds to wait for a regional router before also asking the fallback one
+HEDGE_DELAY = routing_config.get("hedge_delay", 1.5)
+# seconds during which the access time of a cached route isn't refreshed on hits,
+# so that a hit only writes to the cache once in a while
+CACHE_TOUCH_INTERVAL = routing_config.get("cache_touch_interval", 300)
+# 5 decimals is roughly one metre, well below the routers' snapping radius
+COORDINATES_PRECISION = 5
+
+
+class RouteResponse:
+    """
+    Minimal response object returned by `get_route`, either from the router or
+    from the cache. Mimics the parts of `requests.Response` used by forwardRouting.
+    """
+
+    def __init__(self, status_code, text, from_cache=False):
+        self.status_code = status_code
+        self.text = text
+        self.from_cache = from_cache
+
+    def json(self):
+        return json.loads(self.text)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def backend_name(base_url):
+    parsed = urlparse(base_url)
+    return f"{parsed.netloc}{parsed.path}"
+
+
+def get_session(base_url):
+    """
+    Return the keep-alive session dedicated to the given router, creating it if
+    needed. Sessions are per process, so they are never shared across a fork.
+    """
+    key = (os.getpid(), backend_name(base_url))
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            # only retry failed connections, a slow router must not be hit twice
+            retries = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.1)
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retries
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+    return session
+
+
+def get_executor():
+    """
+    Thread pool used to run router requests concurrently, created once per process.
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=POOL_MAXSIZE, thread_name_prefix="routing"
+            )
+            _executor_pid = os.getpid()
+    return _executor
+
+
+def _record(backend, hits=0, misses=0, errors=0, latency=None):
+    stats.add(
+        "backends",
+        backend,
+        hits=hits,
+        misses=misses,
+        errors=errors,
+        requests=0 if latency is None else 1,
+        total_latency=latency or 0.0,
+    )
+
+
+def _summarize_stats(totals):
+    """Hit rate and latency of each backend, plus the state of the shared route cache"""
+    backends = {}
+    for backend, counts in totals["backends"].items():
+        lookups = counts["hits"] + counts["misses"]
+        backends[backend] = {
+            **counts,
+            "hit_rate": counts["hits"] / lookups if lookups else None,
+            "avg_latency_ms": counts["total_latency"] * 1000 / counts["requests"]
+            if counts["requests"]
+            else None,
+        }
+    return {"backends": backends, "cache": route_cache.info()}
+
+
+stats = WorkerStats("routing", {"backends": {}}, summarize=_summarize_stats)
+
+
+def cache_key(base_url, path, query):
+    """
+    Build the cache key of a routing request: backend, profile, coordinates rounded
+    to COORDINATES_PRECISION decimals and options in a stable order.
+    """
+    prefix, _, coordinates = path.rpartition("/")
+    rounded = []
+    for pair in coordinates.split(";"):
+        try:
+            lng, lat = pair.split(",")
+            rounded.append(
+                f"{round(float(lng), COORDINATES_PRECISION)},"
+                f"{round(float(lat), COORDINATES_PRECISION)}"
+            )
+        except ValueError:
+            rounded.append(pair)
+    options = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    raw = f"{backend_name(base_url)}|{prefix}|{';'.join(rounded)}|{options}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class RouteCache:
+    """
+    LRU cache of router responses stored in a SQLite file, so that it is shared
+    by all the gunicorn workers. The total size of the stored (compressed)
+    responses is kept under `max_bytes`; it is maintained by triggers in the
+    one-row routes_size table rather than summed on each write.
+
+    The access time of a route is only refreshed by hits once it is older than
+    `touch_interval` seconds, the LRU order is approximate to that extent.
+    """
+
+    def __init__(self, filename, max_bytes, touch_interval=CACHE_TOUCH_INTERVAL):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+
+    def _connection(self):
+        # connections must not survive a fork, open one per process
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(
+                self.filename, timeout=5, check_same_thread=False
+            )
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS routes (
+                    key TEXT PRIMARY KEY,
+                    backend TEXT NOT NULL,
+                    status INTEGER NOT NULL,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS routes_last_access ON routes (last_access)"
+            )
+            # the total is computed once, when the table is added to a cache file
+            self.conn.executescript(
+                """
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS routes_size (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    total INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO routes_size (id, total)
+                    SELECT 0, COALESCE(SUM(size), 0) FROM routes;
+                CREATE TRIGGER IF NOT EXISTS routes_size_insert
+                AFTER INSERT ON routes BEGIN
+                    UPDATE routes_size SET total = total + new.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS routes_size_update
+                AFTER UPDATE OF size ON routes BEGIN
+                    UPDATE routes_size SET total = total + new.size - old.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS routes_size_delete
+                AFTER DELETE ON routes BEGIN
+                    UPDATE routes_size SET total = total - old.size;
+                END;
+                COMMIT;
+                """
+            )
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, key):
+        try:
+            with self.lock:
+                conn = self._connection()
+                row = conn.execute(
+                    "SELECT status, body, last_access FROM routes WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is None:
+                    return None
+                now = time.time()
+                if now - row[2] > self.touch_interval:
+                    conn.execute(
+                        "UPDATE routes SET last_access = ? WHERE key = ?", (now, key)
+                    )
+                    conn.commit()
+            return RouteResponse(
+                row[0], zlib.decompress(row[1]).decode("utf-8"), from_cache=True
+            )
+        except Exception as e:
+            logger.warning(f"Route cache read failed: {e}")
+            return None
+
+    def set(self, key, backend, response):
+        body = zlib.compress(response.text.encode("utf-8"), 6)
+        if len(body) > self.max_bytes:
+            return
+        try:
+            with self.lock:
+                conn = self._connection()
+                # an upsert rather than INSERT OR REPLACE, whose implicit delete
+                # wouldn't fire the routes_size_delete trigger
+                conn.execute(
+                    """
+                    INSERT INTO routes (key, backend, status, body, size, last_access)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET
+                        backend = excluded.backend,
+                        status = excluded.status,
+                        body = excluded.body,
+                        size = excluded.size,
+                        last_access = excluded.last_access
+                    """,
+                    (key, backend, response.status_code, body, len(body), time.time()),
+                )
+                self._evict(conn)
+                conn.commit()
+        except Exception as e:
+            logger.warning(f"Route cache write failed: {e}")
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT total FROM routes_size").fetchone()[0]
+        while total > self.max_bytes:
+            oldest = conn.execute(
+                "SELECT key, size FROM routes ORDER BY last_access LIMIT 100"
+            ).fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                conn.execute("DELETE FROM routes WHERE key = ?", (key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def info(self):
+        try:
+            with self.lock:
+                entries, size = (
+                    self._connection()
+                    .execute(
+                        "SELECT (SELECT COUNT(*) FROM routes), total FROM routes_size"
+                    )
+                    .fetchone()
+                )
+        except Exception as e:
+            logger.warning(f"Route cache stats failed: {e}")
+            return None
+        return {"entries": entries, "size": size, "max_size": self.max_bytes}
+
+
+route_cache = RouteCache(DbNames.ROUTING_CACHE_DB.value, CACHE_MAX_BYTES)
+
+
+def is_valid_route(response):
+    if response.status_code != 200:
+        return False
+    try:
+        return response.json().get("code") == "Ok"
+    except ValueError:
+        return False
+
+
+def get_route(base_url, path, query, timeout=DEFAULT_TIMEOUT):
+    """
+    GET `{base_url}/{path}?{query}` on an OSRM-compatible router, through the
+    backend's pooled session and the shared route cache.
+    Only successful routes are cached. Network errors are raised to the caller.
+    """
+    backend = backend_name(base_url)
+    key = cache_key(base_url, path, query)
+
+    cached = route_cache.get(key)
+    if cached is not None:
+        _record(backend, hits=1)
+        return cached
+    _record(backend, misses=1)
+
+    start = time.perf_counter()
+    try:
+        response = get_session(base_url).get(
+            f"{base_url}/{path}?{query}", timeout=timeout
+        )
+    except Exception:
+        _record(backend, errors=1, latency=time.perf_counter() - start)
+        raise
+    _record(backend, latency=time.perf_counter() - start)
+
+    result = RouteResponse(response.status_code, response.text)
+    if is_valid_route(result):
+        route_cache.set(key, backend, result)
+    return result
+
+
+def _check_primary(future):
+    """
+    Return the primary router's response if it holds a usable route, raise otherwise
+    """
+    response = future.result()
+    if response.status_code != 200:
+        raise Exception("Non-200 response")
+    if response.json().get("status") == "NoRoute":
+        raise Exception("Router responded with NoRoute")
+    return response
+
+
+def get_route_hedged(
+    primary_url,
+    fallback_url,
+    path,
+    query,
+    hedge_delay=HEDGE_DELAY,
+    timeout=5,
+):
+    """
+    Ask the primary router for a route, and if it hasn't answered with a usable
+    route after `hedge_delay` seconds (or failed before that), also ask the
+    fallback router. The first usable answer wins; the fallback's answer is
+    returned as is, like the sequential fallback did.
+
+    Return a tuple (response, used_fallback).
+    """
+    executor = get_executor()
+    primary = executor.submit(get_route, primary_url, path, query, timeout)
+
+    wait([primary], timeout=hedge_delay)
+    if primary.done():
+        try:
+            return _check_primary(primary), False
+        except Exception as e:
+            logger.info(f"Router failed: {primary_url}, falling back. Reason: {e}")
+            return get_route(fallback_url, path, query), True
+
+    logger.info(f"Router {primary_url} slower than {hedge_delay}s, hedging")
+    fallback = executor.submit(get_route, fallback_url, path, query)
+    pending = {primary, fallback}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        if primary in done:
+            try:
+                return _check_primary(primary), False
+            except Exception as e:
+                logger.info(f"Router failed: {primary_url}. Reason: {e}")
+        # keep waiting for the primary router if the fallback one errored out
+        if fallback.done() and (fallback.exception() is None or primary.done()):
+            return fallback.result(), True
@@ -0,0 +1,11 @@
+-- Paths of the trips as PostGIS geometries, read instead of the paths of
+-- path.db when the "postgis" paths backend is configured (see src/trip_paths.py)
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+CREATE TABLE trip_paths (
+    trip_id INTEGER PRIMARY KEY,
+    path geometry(LineString, 4326) NOT NULL,
+    synced TIMESTAMP DEFAULT now() NOT NULL
+);
+
+CREATE INDEX trip_paths_path_idx ON trip_paths USING GIST (path);
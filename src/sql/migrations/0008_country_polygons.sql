@@ -0,0 +1,12 @@
+-- Country polygons of static/data/countries-filtered.geojson, cut into small
+-- parts so that intersections with trip paths only touch a few vertices, for
+-- the "postgis" countries engine (see src/country_split.py)
+CREATE TABLE country_polygons (
+    id SERIAL PRIMARY KEY,
+    country_code TEXT NOT NULL,
+    -- area of the whole feature, the smallest one wins where features overlap
+    feature_area DOUBLE PRECISION NOT NULL,
+    geom geometry(MultiPolygon, 4326) NOT NULL
+);
+
+CREATE INDEX country_polygons_geom_idx ON country_polygons USING GIST (geom);
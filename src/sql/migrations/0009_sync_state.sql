@@ -0,0 +1,8 @@
+-- High-water marks of the syncs from SQLite (see src/db_sync.py): the latest
+-- SQLite last_modified covered by the last successful sync, written in the
+-- same transaction as the synced rows
+CREATE TABLE sync_state (
+    name TEXT PRIMARY KEY,
+    watermark TIMESTAMP NOT NULL,
+    synced TIMESTAMP DEFAULT now() NOT NULL
+);
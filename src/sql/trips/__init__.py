@@ -1,6 +1,7 @@
 from src.sql import SqlTemplate
 
 insert_trip_query = SqlTemplate("src/sql/trips/insert_trip.sql")
+copy_trips_query = SqlTemplate("src/sql/trips/copy_trips.sql")
 duplicate_trip_query = SqlTemplate("src/sql/trips/duplicate_trip.sql")
 update_trip_query = SqlTemplate("src/sql/trips/update_trip.sql")
 update_trip_type_query = SqlTemplate("src/sql/trips/update_trip_type.sql")
@@ -0,0 +1,30 @@
+COPY trips (
+    trip_id,
+    user_id,
+    origin_station,
+    destination_station,
+    start_datetime,
+    end_datetime,
+    is_project,
+    utc_start_datetime,
+    utc_end_datetime,
+    estimated_trip_duration,
+    manual_trip_duration,
+    trip_length,
+    operator,
+    countries,
+    line_name,
+    created,
+    last_modified,
+    trip_type,
+    material_type,
+    seat,
+    reg,
+    waypoints,
+    notes,
+    price,
+    currency,
+    ticket_id,
+    purchase_date
+)
+FROM STDIN
@@ -0,0 +1,150 @@
+"""
+Facts derived from the trips of a user that are needed on every page: the
+types of their trips (for the menus, see inject_distinct_types in app.py) and
+whether they are on a trip right now (for the live-trip banner). They are
+cached by username in each process, and forgotten after the trip writes of
+src/trips.py.
+
+Whether a user is on a trip only holds until their current trip ends or their
+next one starts, so the cached answer expires then. Writes made by other
+processes are seen after `trip_facts.ttl` seconds at most.
+"""
+
+import logging
+import threading
+import time
+
+from py.sql import getCurrentTripState
+from py.utils import load_config
+from src.utils import mainConn, managed_cursor
+from src.worker_stats import WorkerStats
+
+logger = logging.getLogger(__name__)
+
+trip_facts_config = load_config().get("trip_facts", {})
+
+# seconds the facts of a user are kept by each process
+TRIP_FACTS_TTL = trip_facts_config.get("ttl", 300)
+# users kept by each process, beyond which the expired ones are dropped
+MAX_USERS = 10000
+
+# types of trips that aren't trips (and aren't in the menus)
+HIDDEN_TYPES = ("poi", "accommodation", "restaurant")
+
+# {username: (expires, value)}, expires being a time.time() timestamp, since
+# the current trip fact expires at a date
+_trip_types = {}
+_current_trip = {}
+_lock = threading.Lock()
+
+
+def _load_trip_types(username):
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            f"""
+            SELECT DISTINCT type
+            FROM trip
+            WHERE username = ?
+              AND type NOT IN ({", ".join("?" * len(HIDDEN_TYPES))})
+            """,
+            (username, *HIDDEN_TYPES),
+        )
+        return tuple(row[0] for row in cursor.fetchall())
+
+
+def _load_current_trip(username):
+    """Whether the user is on a trip, and until when that holds"""
+    with managed_cursor(mainConn) as cursor:
+        current, seconds_valid = cursor.execute(
+            getCurrentTripState, {"username": username}
+        ).fetchone()
+    expires = time.time() + TRIP_FACTS_TTL
+    if seconds_valid is not None:
+        expires = min(expires, time.time() + seconds_valid)
+    return expires, bool(current)
+
+
+def _cached(facts, username, name, load):
+    now = time.time()
+    with _lock:
+        expires, value = facts.get(username, (0, None))
+        hit = expires > now
+    stats.add(**{f"{name}_hits" if hit else f"{name}_queries": 1})
+    if hit:
+        return value
+    expires, value = load(username)
+    with _lock:
+        if len(facts) >= MAX_USERS:
+            for key in [key for key, (e, _) in facts.items() if e <= now]:
+                del facts[key]
+        facts[username] = (expires, value)
+    return value
+
+
+def get_trip_types(username):
+    """Types of the trips of the user, counted as one rendered page"""
+    stats.add(renders=1)
+    return _cached(
+        _trip_types,
+        username,
+        "trip_types",
+        lambda username: (
+            time.time() + TRIP_FACTS_TTL,
+            _load_trip_types(username),
+        ),
+    )
+
+
+def is_current_trip(username):
+    """Whether one of the trips of the user is happening now"""
+    return _cached(_current_trip, username, "current_trip", _load_current_trip)
+
+
+def invalidate_trip_facts(*usernames):
+    """Forget the cached facts of the users, after their trips were written"""
+    with _lock:
+        for username in usernames:
+            _trip_types.pop(username, None)
+            _current_trip.pop(username, None)
+    stats.add(invalidations=len(usernames))
+
+
+def _cache_gauges():
+    with _lock:
+        return {
+            "cached_trip_types": len(_trip_types),
+            "cached_current_trips": len(_current_trip),
+        }
+
+
+def _summarize_stats(totals):
+    """Hit rates of the trip facts, and trip queries saved per rendered page"""
+    hits = totals["trip_types_hits"] + totals["current_trip_hits"]
+    queries = totals["trip_types_queries"] + totals["current_trip_queries"]
+    return {
+        **totals,
+        "hit_rate": hits / (hits + queries) if hits + queries else None,
+        # queries of the trip table avoided, and still run, per rendered page
+        "queries_saved_per_render": hits / totals["renders"]
+        if totals["renders"]
+        else None,
+        "queries_per_render": queries / totals["renders"]
+        if totals["renders"]
+        else None,
+    }
+
+
+stats = WorkerStats(
+    "trip_facts",
+    {
+        # pages rendered for a logged in user
+        "renders": 0,
+        "trip_types_hits": 0,
+        "trip_types_queries": 0,
+        "current_trip_hits": 0,
+        "current_trip_queries": 0,
+        "invalidations": 0,
+    },
+    gauges=_cache_gauges,
+    summarize=_summarize_stats,
+)
@@ -0,0 +1,170 @@
+"""
+Import of trips from a Trainlog CSV export (see src/export.py): the whole file
+is parsed and validated first, then the trips are created in bulk.
+"""
+
+import csv
+import json
+import urllib.parse
+from datetime import datetime
+from io import StringIO
+
+import polyline
+
+from src.trips import Trip
+from src.utils import processDates
+
+REQUIRED_COLUMNS = (
+    "origin_station",
+    "destination_station",
+    "trip_length",
+    "type",
+    "path",
+)
+
+
+class TripImportError(Exception):
+    """The file can't be imported, `errors` lists (line, message) for each bad row"""
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} invalid rows")
+        self.errors = errors
+
+
+def detect_precision(start_date, end_date):
+    if (
+        start_date is None
+        or start_date in ["", "1", 1, "-1", -1]
+        or end_date is None
+        or end_date in ["", "1", 1, "-1", -1]
+    ):
+        return "unknown"
+
+    try:
+        datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S")
+        datetime.strptime(end_date, "%Y-%m-%d %H:%M:%S")
+        return "preciseDates"
+    except ValueError:
+        pass
+
+    datetime.strptime(start_date, "%Y-%m-%d")
+    datetime.strptime(end_date, "%Y-%m-%d")
+    return "onlyDate"
+
+
+def _row_to_trip(dataDict, username, user_id, now):
+    missing = [column for column in REQUIRED_COLUMNS if dataDict.get(column) is None]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    float(dataDict["trip_length"])
+
+    if dataDict.get("countries") is not None:
+        dataDict["countries"] = (
+            dataDict["countries"].replace(' "', ', "').replace(",,", ",")
+        )
+    if dataDict.get("waypoints") is not None:
+        dataDict["waypoints"] = json.loads(dataDict["waypoints"])
+    # the export quotes these two columns
+    if dataDict.get("operator") is not None:
+        dataDict["operator"] = urllib.parse.unquote(dataDict["operator"]).replace(
+            "&&", ","
+        )
+    if dataDict.get("line_name") is not None:
+        dataDict["line_name"] = urllib.parse.unquote(dataDict["line_name"])
+
+    path = [list(node) for node in polyline.decode(dataDict["path"])]
+    if not path:
+        raise ValueError("empty path")
+
+    dataDict["precision"] = detect_precision(
+        dataDict.get("start_datetime"), dataDict.get("end_datetime")
+    )
+    dataDict["onlyDateDuration"] = dataDict.get("manual_trip_duration")
+    if dataDict["precision"] == "unknown":
+        dataDict["unknownType"] = (
+            "future"
+            if dataDict.get("start_datetime") in [1, "1"]
+            or dataDict.get("end_datetime") in [1, "1"]
+            else "past"
+        )
+    elif dataDict["precision"] == "preciseDates":
+        dataDict["newTripStart"] = datetime.strftime(
+            datetime.strptime(dataDict["start_datetime"], "%Y-%m-%d %H:%M:%S"),
+            "%Y-%m-%dT%H:%M",
+        )
+        dataDict["newTripEnd"] = datetime.strftime(
+            datetime.strptime(dataDict["end_datetime"], "%Y-%m-%d %H:%M:%S"),
+            "%Y-%m-%dT%H:%M",
+        )
+    else:
+        dataDict["onlyDate"] = dataDict["start_datetime"]
+        dataDict["unknownType"] = None
+
+    manDuration, start_datetime, end_datetime, utc_start_datetime, utc_end_datetime = (
+        processDates(
+            dataDict, [{"lat": lat, "lng": lng} for lat, lng in (path[0], path[-1])]
+        )
+    )
+    is_project = start_datetime in [1, "1"] or end_datetime in [1, "1"]
+    if start_datetime in [-1, 1, "-1", "1"]:
+        start_datetime = None
+    if end_datetime in [-1, 1, "-1", "1"]:
+        end_datetime = None
+
+    return Trip(
+        trip_id=None,
+        username=username,
+        user_id=user_id,
+        origin_station=dataDict["origin_station"],
+        destination_station=dataDict["destination_station"],
+        start_datetime=start_datetime,
+        end_datetime=end_datetime,
+        trip_length=dataDict["trip_length"],
+        estimated_trip_duration=dataDict.get("estimated_trip_duration"),
+        operator=dataDict.get("operator"),
+        countries=dataDict.get("countries"),
+        manual_trip_duration=manDuration,
+        utc_start_datetime=utc_start_datetime,
+        utc_end_datetime=utc_end_datetime,
+        created=now,
+        last_modified=now,
+        line_name=dataDict.get("line_name"),
+        type=dataDict["type"],
+        material_type=dataDict.get("material_type"),
+        seat=dataDict.get("seat"),
+        reg=dataDict.get("reg"),
+        waypoints=dataDict.get("waypoints"),
+        notes=dataDict.get("notes"),
+        price=dataDict.get("price"),
+        currency=dataDict.get("currency"),
+        purchasing_date=dataDict.get("purchasing_date"),
+        ticket_id=None,
+        is_project=is_project,
+        path=path,
+    )
+
+
+def parse_trips_csv(data, username, user_id):
+    """
+    Parse and validate all the rows of a CSV export, returning the trips to pass
+    to `create_trips`. Raise TripImportError listing every invalid row, so that
+    nothing is imported until the whole file is valid.
+    """
+    reader = csv.DictReader(StringIO(data))
+    now = datetime.now()
+    trips = []
+    errors = []
+    for row in reader:
+        if not any(row.values()):
+            continue
+        dataDict = {
+            k: (v if v != "" else None) for k, v in row.items() if k is not None
+        }
+        dataDict.pop("uid", None)
+        try:
+            trips.append(_row_to_trip(dataDict, username, user_id, now))
+        except Exception as e:
+            errors.append((reader.line_num, f"{type(e).__name__}: {e}"))
+    if errors:
+        raise TripImportError(errors)
+    return trips
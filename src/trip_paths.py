@@ -0,0 +1,319 @@
+"""
+Trip paths as PostGIS geometries: the `trip_paths` table (migration 0007)
+holds each path as a LineString with a GiST index, and the read API below
+answers path, bounding box, simplification and length queries either from it
+or from the paths of path.db, depending on the `paths.backend` setting.
+
+When the PostGIS backend is enabled, trip writes (src/trips.py) also write the
+geometries. The table is filled beforehand, and repaired, with:
+
+    python -m src.trip_paths --sync [--full]
+
+and both backends are compared with `python -m src.trip_paths --bench [trips]`.
+"""
+
+import datetime
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+import shapely
+
+from py.geometry import path_length
+from py.utils import load_config
+from src.paths import Path
+from src.pg import get_or_create_pg_session, pg_session
+from src.utils import managed_cursor, pathConn
+
+logger = logging.getLogger(__name__)
+
+paths_config = load_config().get("paths", {})
+
+BACKENDS = ("sqlite", "postgis")
+BACKEND = paths_config.get("backend", "sqlite")
+# trip writes only maintain the geometries when they are read
+PATHS_IN_POSTGIS = BACKEND == "postgis"
+CHUNK_SIZE = 1000
+
+UPSERT_PATH_QUERY = """
+    INSERT INTO trip_paths (trip_id, path, synced)
+    VALUES (:trip_id, ST_GeomFromEWKB(decode(:path, 'hex')), :synced)
+    ON CONFLICT (trip_id) DO UPDATE SET path = EXCLUDED.path, synced = EXCLUDED.synced
+"""
+
+
+def to_coordinates(path):
+    """
+    [[lat, lng], ...] of a path given as a Path, a list of {"lat", "lng"} or a
+    list of [lat, lng]
+    """
+    if isinstance(path, Path):
+        return [[node.lat, node.lng] for node in path.list]
+    return [
+        [point["lat"], point["lng"]]
+        if isinstance(point, dict)
+        else [point[0], point[1]]
+        for point in path
+    ]
+
+
+def _linestring(coordinates):
+    """LineString of [lat, lng] coordinates"""
+    points = np.asarray(coordinates, dtype=float)[:, ::-1]
+    if len(points) == 1:
+        # a LineString needs two points, the ones of single point trips are doubled
+        points = np.repeat(points, 2, axis=0)
+    return shapely.linestrings(points)
+
+
+def _ewkb(coordinates):
+    """Hex EWKB of the LineString of [lat, lng] coordinates"""
+    line = shapely.set_srid(_linestring(coordinates), 4326)
+    return shapely.to_wkb(line, hex=True, include_srid=True)
+
+
+def _coordinates(line):
+    """[[lat, lng], ...] of a LineString"""
+    coordinates = shapely.get_coordinates(line)[:, ::-1]
+    if len(coordinates) == 2 and (coordinates[0] == coordinates[1]).all():
+        coordinates = coordinates[:1]
+    return coordinates.tolist()
+
+
+def _from_wkb(wkb):
+    return _coordinates(shapely.from_wkb(bytes(wkb)))
+
+
+def save_paths(pg, paths):
+    """Insert or replace the geometries of {trip_id: path}"""
+    synced = datetime.datetime.now()
+    rows = []
+    for trip_id, path in paths.items():
+        coordinates = to_coordinates(path)
+        if coordinates:
+            rows.append(
+                {"trip_id": int(trip_id), "path": _ewkb(coordinates), "synced": synced}
+            )
+    if rows:
+        pg.execute(UPSERT_PATH_QUERY, rows)
+
+
+def copy_path(pg, trip_id, new_trip_id):
+    pg.execute(
+        """
+        INSERT INTO trip_paths (trip_id, path, synced)
+        SELECT :new_trip_id, path, synced FROM trip_paths WHERE trip_id = :trip_id
+        """,
+        {"trip_id": trip_id, "new_trip_id": new_trip_id},
+    )
+
+
+def delete_paths(pg, trip_ids):
+    pg.execute(
+        "DELETE FROM trip_paths WHERE trip_id = ANY(:trip_ids)",
+        {"trip_ids": [int(trip_id) for trip_id in trip_ids]},
+    )
+
+
+def _iter_sqlite_paths(trip_ids):
+    """Yield (trip_id, [[lat, lng], ...]) for the paths of path.db"""
+    with managed_cursor(pathConn) as cursor:
+        cursor.execute(
+            "SELECT trip_id, path FROM paths WHERE trip_id IN (SELECT value FROM json_each(?))",
+            (json.dumps([int(trip_id) for trip_id in trip_ids]),),
+        )
+        while rows := cursor.fetchmany(CHUNK_SIZE):
+            for trip_id, path in rows:
+                yield trip_id, json.loads(path)
+
+
+def _check_backend(backend):
+    backend = backend or BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown paths backend {backend}")
+    return backend
+
+
+def get_paths(trip_ids, backend=None):
+    """Paths of the given trips, as {trip_id: [[lat, lng], ...]}"""
+    if _check_backend(backend) == "sqlite":
+        return dict(_iter_sqlite_paths(trip_ids))
+    with pg_session() as pg:
+        rows = pg.execute(
+            "SELECT trip_id, ST_AsBinary(path) FROM trip_paths WHERE trip_id = ANY(:trip_ids)",
+            {"trip_ids": [int(trip_id) for trip_id in trip_ids]},
+        ).fetchall()
+    return {trip_id: _from_wkb(wkb) for trip_id, wkb in rows}
+
+
+def get_paths_in_bbox(trip_ids, west, south, east, north, backend=None):
+    """Ids of the given trips whose path crosses the bounding box"""
+    if _check_backend(backend) == "sqlite":
+        ids, lines = [], []
+        for trip_id, coordinates in _iter_sqlite_paths(trip_ids):
+            if coordinates:
+                ids.append(trip_id)
+                lines.append(_linestring(coordinates))
+        crossing = shapely.intersects(lines, shapely.box(west, south, east, north))
+        return {trip_id for trip_id, crosses in zip(ids, crossing) if crosses}
+    with pg_session() as pg:
+        rows = pg.execute(
+            """
+            SELECT trip_id FROM trip_paths
+            WHERE trip_id = ANY(:trip_ids)
+            AND ST_Intersects(path, ST_MakeEnvelope(:west, :south, :east, :north, 4326))
+            """,
+            {
+                "trip_ids": [int(trip_id) for trip_id in trip_ids],
+                "west": west,
+                "south": south,
+                "east": east,
+                "north": north,
+            },
+        ).fetchall()
+    return {row[0] for row in rows}
+
+
+def get_simplified_paths(trip_ids, tolerance, backend=None):
+    """
+    Paths of the given trips simplified with Douglas-Peucker, `tolerance`
+    being in degrees, as {trip_id: [[lat, lng], ...]}
+    """
+    if _check_backend(backend) == "sqlite":
+        simplified = {}
+        for trip_id, coordinates in _iter_sqlite_paths(trip_ids):
+            if coordinates:
+                line = _linestring(coordinates)
+                simplified[trip_id] = _coordinates(
+                    line.simplify(tolerance, preserve_topology=True)
+                )
+        return simplified
+    with pg_session() as pg:
+        rows = pg.execute(
+            """
+            SELECT trip_id, ST_AsBinary(ST_SimplifyPreserveTopology(path, :tolerance))
+            FROM trip_paths WHERE trip_id = ANY(:trip_ids)
+            """,
+            {
+                "trip_ids": [int(trip_id) for trip_id in trip_ids],
+                "tolerance": tolerance,
+            },
+        ).fetchall()
+    return {trip_id: _from_wkb(wkb) for trip_id, wkb in rows}
+
+
+def get_path_lengths(trip_ids, backend=None):
+    """Great circle length in meters of the paths of the given trips, by trip id"""
+    if _check_backend(backend) == "sqlite":
+        return {
+            trip_id: path_length([[lng, lat] for lat, lng in coordinates])
+            for trip_id, coordinates in _iter_sqlite_paths(trip_ids)
+        }
+    with pg_session() as pg:
+        # on the sphere, like py.geometry.path_length
+        rows = pg.execute(
+            """
+            SELECT trip_id, ST_Length(path::geography, false) FROM trip_paths
+            WHERE trip_id = ANY(:trip_ids)
+            """,
+            {"trip_ids": [int(trip_id) for trip_id in trip_ids]},
+        ).fetchall()
+    return {trip_id: length for trip_id, length in rows}
+
+
+def sync_paths_from_sqlite(pg_session=None, full=False):
+    """
+    Write the paths of path.db into trip_paths: all of them, or only those of
+    the trips missing from the table or modified since their path was written.
+    Geometries of trips that no longer have a path are removed.
+    """
+    start = time.perf_counter()
+    with managed_cursor(pathConn) as cursor:
+        cursor.execute("SELECT trip_id FROM paths")
+        sqlite_ids = {row[0] for row in cursor.fetchall()}
+
+    with get_or_create_pg_session(pg_session) as pg:
+        pg_ids = {
+            row[0] for row in pg.execute("SELECT trip_id FROM trip_paths").fetchall()
+        }
+        if full:
+            trip_ids = sqlite_ids
+        else:
+            modified = {
+                row[0]
+                for row in pg.execute(
+                    """
+                    SELECT trip_id FROM trips JOIN trip_paths USING (trip_id)
+                    WHERE trips.last_modified > trip_paths.synced
+                    """
+                ).fetchall()
+            }
+            trip_ids = (sqlite_ids - pg_ids) | (modified & sqlite_ids)
+        trip_ids = sorted(trip_ids)
+        logger.info(f"Syncing {len(trip_ids)} paths to PostGIS")
+
+        for i in range(0, len(trip_ids), CHUNK_SIZE):
+            save_paths(pg, dict(_iter_sqlite_paths(trip_ids[i : i + CHUNK_SIZE])))
+            if i % (CHUNK_SIZE * 20) == 0:
+                logger.info(f"Synced {i}/{len(trip_ids)} paths")
+        deleted_ids = pg_ids - sqlite_ids
+        if deleted_ids:
+            delete_paths(pg, deleted_ids)
+
+    logger.info(
+        f"Synced {len(trip_ids)} paths and removed {len(deleted_ids)} in "
+        f"{time.perf_counter() - start:.1f}s"
+    )
+    return {"written": len(trip_ids), "deleted": len(deleted_ids)}
+
+
+def benchmark(count=2000):
+    """
+    Time each read of the API with both backends, on `count` random trips
+    having a path, and check that they give the same answers.
+    """
+    with managed_cursor(pathConn) as cursor:
+        cursor.execute("SELECT trip_id FROM paths ORDER BY random() LIMIT ?", (count,))
+        trip_ids = [row[0] for row in cursor.fetchall()]
+    # central Europe, where most trips are
+    bbox = (5.0, 45.0, 15.0, 52.0)
+    reads = {
+        "paths": lambda backend: get_paths(trip_ids, backend),
+        "bbox": lambda backend: get_paths_in_bbox(trip_ids, *bbox, backend=backend),
+        "simplified": lambda backend: get_simplified_paths(trip_ids, 0.01, backend),
+        "lengths": lambda backend: get_path_lengths(trip_ids, backend),
+    }
+    for name, read in reads.items():
+        results = {}
+        for backend in BACKENDS:
+            start = time.perf_counter()
+            results[backend] = read(backend)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:>10} {backend:>7}: {elapsed * 1000:8.1f} ms for {len(trip_ids)} trips"
+            )
+        sqlite_result, postgis_result = results["sqlite"], results["postgis"]
+        if name == "lengths":
+            same = all(
+                abs(sqlite_result[trip_id] - postgis_result.get(trip_id, 0))
+                <= max(1, sqlite_result[trip_id] * 1e-3)
+                for trip_id in sqlite_result
+            )
+        elif name == "bbox":
+            same = sqlite_result == postgis_result
+        else:
+            same = sqlite_result.keys() == postgis_result.keys() and all(
+                len(sqlite_result[trip_id]) == len(postgis_result[trip_id])
+                for trip_id in sqlite_result
+            )
+        print(f"{name:>10}: {'same results' if same else 'DIFFERENT RESULTS'}")
+
+
+if __name__ == "__main__":
+    if "--sync" in sys.argv:
+        sync_paths_from_sqlite(full="--full" in sys.argv)
+    elif "--bench" in sys.argv:
+        args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+        benchmark(int(args[0]) if args else 2000)
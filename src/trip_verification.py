@@ -0,0 +1,180 @@
+"""
+Verification that the trips written to both SQLite and PG have the same data
+in both, off the write path. Writes only queue the ids of the trips they
+touched (a sample of them, or all in full-check mode), and a background thread
+of each process compares the queued trips in batches, with one query per
+database. Differences are checked again one batch later, so that a trip caught
+between its two writes isn't reported, and the drift that remains is reported
+in one alert per `alert_interval`.
+"""
+
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import traceback
+
+from py.utils import load_config
+from src.consts import DbNames
+from src.worker_stats import WorkerStats
+
+logger = logging.getLogger(__name__)
+
+verification_config = load_config().get("verification", {})
+
+# share of the written trips that are verified
+SAMPLE_RATE = verification_config.get("sample_rate", 0.1)
+# verify every written trip, whatever the sample rate
+FULL_CHECK = verification_config.get("full_check", False)
+# seconds between two batches
+INTERVAL = verification_config.get("interval", 30)
+BATCH_SIZE = verification_config.get("batch_size", 1000)
+# seconds between two drift alerts
+ALERT_INTERVAL = verification_config.get("alert_interval", 900)
+# trips waiting for verification, beyond which new ones are dropped
+MAX_PENDING = 100000
+
+_pending = set()
+_recheck = set()
+_drift = {}
+_last_alert = None
+_lock = threading.Lock()
+
+_verifier = None
+_verifier_pid = None
+
+
+def verify_trips(*trip_ids):
+    """Queue trips that were just written for verification"""
+    if FULL_CHECK:
+        sampled = trip_ids
+    else:
+        sampled = [trip_id for trip_id in trip_ids if random.random() < SAMPLE_RATE]
+    queued = dropped = 0
+    with _lock:
+        for trip_id in map(int, sampled):
+            if len(_pending) >= MAX_PENDING:
+                dropped += 1
+            elif trip_id not in _pending:
+                _pending.add(trip_id)
+                queued += 1
+        if sampled:
+            _start_verifier()
+    stats.add(sampled_out=len(trip_ids) - len(sampled), dropped=dropped, queued=queued)
+
+
+def _start_verifier():
+    """Start the verifier thread of this process, if needed (under _lock)"""
+    global _verifier, _verifier_pid
+    if _verifier is None or _verifier_pid != os.getpid() or not _verifier.is_alive():
+        _verifier = threading.Thread(
+            target=_run_verifier, name="trip-verifier", daemon=True
+        )
+        _verifier_pid = os.getpid()
+        _verifier.start()
+
+
+def _run_verifier():
+    # own connection, so that trips are read as committed and not through
+    # the transaction of a request running at the same time
+    conn = sqlite3.connect(DbNames.MAIN_DB.value, timeout=10)
+    conn.row_factory = sqlite3.Row
+    while True:
+        time.sleep(INTERVAL)
+        while _verify_batch(conn) == BATCH_SIZE:
+            pass
+
+
+def _verify_batch(conn):
+    """Compare the next batch of queued trips, return the number of trips compared"""
+    from src.trips import find_drift
+
+    global _recheck
+    with _lock:
+        recheck, _recheck = _recheck, set()
+        batch = set()
+        while _pending and len(batch) < BATCH_SIZE - len(recheck):
+            batch.add(_pending.pop())
+    trip_ids = batch | recheck
+    if not trip_ids:
+        _alert()
+        return 0
+
+    start = time.perf_counter()
+    try:
+        drift = find_drift(trip_ids, conn)
+    except Exception:
+        logger.error(
+            f"Could not verify {len(trip_ids)} trips: {traceback.format_exc()}"
+        )
+        stats.add(failed_batches=1)
+        with _lock:
+            _pending.update(batch)
+            _recheck.update(recheck)
+        return 0
+
+    drifted = 0
+    with _lock:
+        for trip_id, message in drift.items():
+            if trip_id in recheck:
+                _drift[trip_id] = message
+                drifted += 1
+            else:
+                _recheck.add(trip_id)
+    stats.add(checked=len(batch), rechecked=len(recheck), drifted=drifted)
+    stats.set(last_batch_ms=round((time.perf_counter() - start) * 1000, 1))
+    _alert()
+    return len(trip_ids)
+
+
+def _alert():
+    """Report the drift found since the last alert, at most once per ALERT_INTERVAL"""
+    from src.trips import _report_drift
+
+    global _last_alert
+    with _lock:
+        if not _drift or (
+            _last_alert is not None and time.monotonic() - _last_alert < ALERT_INTERVAL
+        ):
+            return
+        drift = dict(_drift)
+        _drift.clear()
+        _last_alert = time.monotonic()
+    try:
+        _report_drift(
+            f"{len(drift)} trips have drifted between SQLite and PG",
+            f"{len(drift)} trips have drifted between SQLite and PG "
+            f"(worker {os.getpid()}, {stats.snapshot()['checked']} trips verified "
+            "so far)!",
+            "<br>".join(drift.values()),
+        )
+    except Exception as e:
+        logger.warning(f"Drift alert failed: {e}")
+
+
+def _pending_gauges():
+    with _lock:
+        return {"pending": len(_pending) + len(_recheck)}
+
+
+def _summarize_stats(totals):
+    return {"sample_rate": 1 if FULL_CHECK else SAMPLE_RATE, **totals}
+
+
+stats = WorkerStats(
+    "trip_verification",
+    {
+        "queued": 0,
+        "sampled_out": 0,
+        "dropped": 0,
+        "checked": 0,
+        "rechecked": 0,
+        "drifted": 0,
+        "failed_batches": 0,
+        "last_batch_ms": None,
+    },
+    gauges=_pending_gauges,
+    summarize=_summarize_stats,
+)
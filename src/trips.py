@@ -2,16 +2,18 @@ import datetime
 import json
 import logging
 import traceback
+from io import StringIO
 
-from flask import abort, request
+from flask import abort, has_request_context, request
 
 from py.sql import deletePathQuery, getUserLines, saveQuery, updatePath, updateTripQuery
-from py.utils import getCountriesFromPath
 from src.consts import TripTypes
+from src.country_split import get_countries_from_path
 from src.paths import Path
-from src.pg import get_or_create_pg_session, pg_session
+from src.pg import copy_expert, get_or_create_pg_session, pg_session
 from src.sql.trips import (
     attach_ticket_query,
+    copy_trips_query,
     delete_trip_query,
     duplicate_trip_query,
     insert_trip_query,
@@ -19,6 +21,14 @@ from src.sql.trips import (
     update_trip_query,
     update_trip_type_query,
 )
+from src.trip_facts import invalidate_trip_facts
+from src.trip_paths import (
+    PATHS_IN_POSTGIS,
+    copy_path,
+    delete_paths,
+    save_paths,
+)
+from src.trip_verification import verify_trips
 from src.utils import (
     get_user_id,
     getUser,
@@ -103,129 +113,158 @@ class Trip:
         return tuple(vars(self).values())
 
 
+SQLITE_TRIP_COLUMNS = (
+    "username",
+    "origin_station",
+    "destination_station",
+    "start_datetime",
+    "end_datetime",
+    "trip_length",
+    "estimated_trip_duration",
+    "manual_trip_duration",
+    "operator",
+    "countries",
+    "utc_start_datetime",
+    "utc_end_datetime",
+    "created",
+    "last_modified",
+    "line_name",
+    "type",
+    "material_type",
+    "seat",
+    "reg",
+    "waypoints",
+    "notes",
+    "price",
+    "currency",
+    "purchasing_date",
+    "ticket_id",
+)
+
+
+def _pg_trip_params(trip: Trip):
+    """Parameters of `insert_trip_query`, in the order of its columns"""
+    return {
+        "trip_id": trip.trip_id,
+        "user_id": trip.user_id,
+        "origin_station": trip.origin_station,
+        "destination_station": trip.destination_station,
+        "start_datetime": trip.start_datetime,
+        "end_datetime": trip.end_datetime,
+        "is_project": trip.is_project,
+        "utc_start_datetime": trip.utc_start_datetime,
+        "utc_end_datetime": trip.utc_end_datetime,
+        "estimated_trip_duration": trip.estimated_trip_duration,
+        "manual_trip_duration": trip.manual_trip_duration,
+        "trip_length": trip.trip_length,
+        "operator": trip.operator,
+        "countries": trip.countries,
+        "line_name": trip.line_name,
+        "created": trip.created,
+        "last_modified": trip.last_modified,
+        "trip_type": trip.type,
+        "material_type": trip.material_type,
+        "seat": trip.seat,
+        "reg": trip.reg,
+        "waypoints": trip.waypoints,
+        "notes": trip.notes,
+        "price": trip.price,
+        "currency": trip.currency,
+        "ticket_id": trip.ticket_id,
+        "purchase_date": trip.purchasing_date,
+    }
+
+
+def _sqlite_trip_values(trip: Trip):
+    """Values of the trip in the order of SQLITE_TRIP_COLUMNS"""
+    values = {column: getattr(trip, column) for column in SQLITE_TRIP_COLUMNS}
+    # unknown dates are stored as 1 for projects and -1 for past trips
+    if trip.start_datetime is None:
+        values["start_datetime"] = 1 if trip.is_project else -1
+    if trip.end_datetime is None:
+        values["end_datetime"] = 1 if trip.is_project else -1
+    return tuple(values.values())
+
+
+def _copy_value(value):
+    """Value in the text format of COPY"""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
 def create_trip(trip: Trip, pg_session=None):
     with get_or_create_pg_session(pg_session) as pg:
         if trip.trip_id is None:
             # need to create the trip in sqlite first
             trip.trip_id = _create_trip_in_sqlite(trip)
 
-        pg.execute(
-            insert_trip_query(),
-            {
-                "trip_id": trip.trip_id,
-                "user_id": trip.user_id,
-                "origin_station": trip.origin_station,
-                "destination_station": trip.destination_station,
-                "start_datetime": trip.start_datetime,
-                "end_datetime": trip.end_datetime,
-                "is_project": trip.is_project,
-                "utc_start_datetime": trip.utc_start_datetime,
-                "utc_end_datetime": trip.utc_end_datetime,
-                "estimated_trip_duration": trip.estimated_trip_duration,
-                "manual_trip_duration": trip.manual_trip_duration,
-                "trip_length": trip.trip_length,
-                "operator": trip.operator,
-                "countries": trip.countries,
-                "line_name": trip.line_name,
-                "created": trip.created,
-                "last_modified": trip.last_modified,
-                "trip_type": trip.type,
-                "material_type": trip.material_type,
-                "seat": trip.seat,
-                "reg": trip.reg,
-                "waypoints": trip.waypoints,
-                "notes": trip.notes,
-                "price": trip.price,
-                "currency": trip.currency,
-                "ticket_id": trip.ticket_id,
-                "purchase_date": trip.purchasing_date,
-            },
-        )
+        pg.execute(insert_trip_query(), _pg_trip_params(trip))
+        if PATHS_IN_POSTGIS:
+            save_paths(pg, {trip.trip_id: trip.path})
 
-    compare_trip(trip.trip_id)
+    verify_trips(trip.trip_id)
     logger.info(f"Successfully created trip {trip.trip_id}")
 
 
+def create_trips(trips: list[Trip], pg_session=None):
+    """
+    Bulk version of `create_trip`, for imports: the trips and their paths (as
+    lists of [lat, lng]) are inserted in one sqlite transaction and copied into
+    pg with COPY.
+
+    Return the ids of the new trips.
+    """
+    if not trips:
+        return []
+
+    trip_ids = _create_trips_in_sqlite(trips)
+    try:
+        with get_or_create_pg_session(pg_session) as pg:
+            buffer = StringIO()
+            for trip in trips:
+                buffer.write(
+                    "\t".join(_copy_value(v) for v in _pg_trip_params(trip).values())
+                )
+                buffer.write("\n")
+            buffer.seek(0)
+            copy_expert(pg, copy_trips_query(), buffer)
+            if PATHS_IN_POSTGIS:
+                save_paths(pg, {trip.trip_id: trip.path for trip in trips})
+    except Exception:
+        # don't leave trips that only exist in sqlite
+        _delete_trips_in_sqlite(trip_ids)
+        invalidate_trip_facts(*{trip.username for trip in trips})
+        raise
+
+    verify_trips(*trip_ids)
+    logger.info(f"Successfully created {len(trip_ids)} trips")
+    return trip_ids
+
+
 def _create_trip_in_sqlite(trip: Trip):
     """
     Temporary function to write trips in sqlite
     Will be replaced by PG eventually
     """
     saveTripQuery = """
-        INSERT INTO trip (
-            'username',
-            'origin_station',
-            'destination_station',
-            'start_datetime',
-            'end_datetime',
-            'trip_length',
-            'estimated_trip_duration',
-            'manual_trip_duration',
-            'operator',
-            'countries',
-            'utc_start_datetime',
-            'utc_end_datetime',
-            'created',
-            'last_modified',
-            'line_name',
-            'type',
-            'material_type',
-            'seat',
-            'reg',
-            'waypoints',
-            'notes',
-            'price',
-            'currency',
-            'purchasing_date',
-            'ticket_id'
-        ) VALUES (
-            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
-            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
-        ) RETURNING uid;
-    """
-    if trip.start_datetime is None:
-        start_datetime = 1 if trip.is_project else -1
-    else:
-        start_datetime = trip.start_datetime
-    if trip.end_datetime is None:
-        end_datetime = 1 if trip.is_project else -1
-    else:
-        end_datetime = trip.end_datetime
+        INSERT INTO trip ({}) VALUES ({}) RETURNING uid;
+    """.format(
+        ", ".join(f"'{column}'" for column in SQLITE_TRIP_COLUMNS),
+        ", ".join("?" * len(SQLITE_TRIP_COLUMNS)),
+    )
 
     try:
         # Begin transactions in both databases
         mainConn.execute("BEGIN TRANSACTION")
         with managed_cursor(mainConn) as cursor:
-            cursor.execute(
-                saveTripQuery,
-                (
-                    trip.username,
-                    trip.origin_station,
-                    trip.destination_station,
-                    start_datetime,
-                    end_datetime,
-                    trip.trip_length,
-                    trip.estimated_trip_duration,
-                    trip.manual_trip_duration,
-                    trip.operator,
-                    trip.countries,
-                    trip.utc_start_datetime,
-                    trip.utc_end_datetime,
-                    trip.created,
-                    trip.last_modified,
-                    trip.line_name,
-                    trip.type,
-                    trip.material_type,
-                    trip.seat,
-                    trip.reg,
-                    trip.waypoints,
-                    trip.notes,
-                    trip.price,
-                    trip.currency,
-                    trip.purchasing_date,
-                    trip.ticket_id,
-                ),
-            )
+            cursor.execute(saveTripQuery, _sqlite_trip_values(trip))
             # Retrieve the trip_id directly from the INSERT statement
             trip_id = cursor.fetchone()[0]
 
@@ -249,6 +288,7 @@ def _create_trip_in_sqlite(trip: Trip):
         # Commit both transactions
         mainConn.commit()
         pathConn.commit()
+        invalidate_trip_facts(trip.username)
 
         return trip_id
     except Exception as e:
@@ -259,6 +299,60 @@ def _create_trip_in_sqlite(trip: Trip):
         raise e
 
 
+def _create_trips_in_sqlite(trips: list[Trip]):
+    """
+    Insert the trips and their paths with executemany. The write lock is taken
+    before reading the last uid so that the ids can be given up front.
+    """
+    saveTripsQuery = "INSERT INTO trip (uid, {}) VALUES (?, {})".format(
+        ", ".join(SQLITE_TRIP_COLUMNS), ", ".join("?" * len(SQLITE_TRIP_COLUMNS))
+    )
+    try:
+        mainConn.execute("BEGIN IMMEDIATE")
+        with managed_cursor(mainConn) as cursor:
+            first_id = cursor.execute(
+                "SELECT COALESCE(MAX(uid), 0) + 1 FROM trip"
+            ).fetchone()[0]
+            for trip_id, trip in enumerate(trips, first_id):
+                trip.trip_id = trip_id
+            cursor.executemany(
+                saveTripsQuery,
+                ((trip.trip_id, *_sqlite_trip_values(trip)) for trip in trips),
+            )
+
+        pathConn.execute("BEGIN TRANSACTION")
+        with managed_cursor(pathConn) as cursor:
+            cursor.executemany(
+                "INSERT INTO paths (trip_id, path) VALUES (?, ?)",
+                ((trip.trip_id, json.dumps(trip.path)) for trip in trips),
+            )
+
+        mainConn.commit()
+        pathConn.commit()
+        invalidate_trip_facts(*{trip.username for trip in trips})
+        return [trip.trip_id for trip in trips]
+    except Exception:
+        mainConn.rollback()
+        pathConn.rollback()
+        for trip in trips:
+            trip.trip_id = None
+        raise
+
+
+def _delete_trips_in_sqlite(trip_ids):
+    ids = (json.dumps(trip_ids),)
+    with managed_cursor(mainConn) as cursor:
+        cursor.execute(
+            "DELETE FROM trip WHERE uid IN (SELECT value FROM json_each(?))", ids
+        )
+    with managed_cursor(pathConn) as cursor:
+        cursor.execute(
+            "DELETE FROM paths WHERE trip_id IN (SELECT value FROM json_each(?))", ids
+        )
+    mainConn.commit()
+    pathConn.commit()
+
+
 def duplicate_trip(trip_id: int):
     with pg_session() as pg:
         new_trip_id = _duplicate_trip_in_sqlite(trip_id)
@@ -269,9 +363,10 @@ def duplicate_trip(trip_id: int):
                 "new_trip_id": new_trip_id,
             },
         )
+        if PATHS_IN_POSTGIS:
+            copy_path(pg, trip_id, new_trip_id)
 
-    compare_trip(trip_id)
-    compare_trip(new_trip_id)
+    verify_trips(trip_id, new_trip_id)
     logger.info(f"Successfully duplicated trip {trip_id} into {new_trip_id}")
     return new_trip_id
 
@@ -298,6 +393,7 @@ def _duplicate_trip_in_sqlite(trip_id):
             insert_query = f"INSERT INTO trip ({columns_str}) VALUES ({placeholders})"
             cursor.execute(insert_query, row_to_duplicate)
             new_trip_id = cursor.lastrowid
+            username = row_to_duplicate[column_names.index("username")]
     with managed_cursor(pathConn) as cursor:
         cursor.execute("select path from paths where trip_id = ?", (trip_id,))
         path_to_duplicate = cursor.fetchone()["path"]
@@ -307,12 +403,15 @@ def _duplicate_trip_in_sqlite(trip_id):
         )
     mainConn.commit()
     pathConn.commit()
+    invalidate_trip_facts(username)
     return new_trip_id
 
 
 def update_trip(trip_id: int, trip: Trip, formData=None, updateCreated=False):
     with pg_session() as pg:
-        _update_trip_in_sqlite(formData, trip.last_modified, trip_id, updateCreated)
+        path = _update_trip_in_sqlite(
+            formData, trip.last_modified, trip_id, updateCreated, pg
+        )
         pg.execute(
             update_trip_query(),
             {
@@ -344,8 +443,10 @@ def update_trip(trip_id: int, trip: Trip, formData=None, updateCreated=False):
                 "purchase_date": trip.purchasing_date,
             },
         )
+        if PATHS_IN_POSTGIS and path:
+            save_paths(pg, {trip_id: path})
 
-    compare_trip(trip_id)
+    verify_trips(trip_id)
     logger.info(f"Successfully updated trip {trip_id}")
 
 
@@ -354,6 +455,7 @@ def _update_trip_in_sqlite(
     last_modified,
     tripId=None,
     updateCreated=False,
+    pg_session=None,
 ):
     if tripId is None:
         tripId = formData["trip_id"]
@@ -424,8 +526,10 @@ def _update_trip_in_sqlite(
         updateData["created"] = datetime.datetime.now()
 
     if "estimated_trip_duration" in formData and "trip_length" in formData:
-        updateData["countries"] = getCountriesFromPath(
-            [{"lat": coord[0], "lng": coord[1]} for coord in path], formData["type"]
+        updateData["countries"] = get_countries_from_path(
+            [{"lat": coord[0], "lng": coord[1]} for coord in path],
+            formData["type"],
+            pg_session,
         )
         updateData["estimated_trip_duration"] = formData["estimated_trip_duration"]
         updateData["trip_length"] = formData["trip_length"]
@@ -444,14 +548,18 @@ def _update_trip_in_sqlite(
             cursor.execute(updatePath, {"trip_id": int(tripId), "path": str(path)})
         pathConn.commit()
     mainConn.commit()
+    invalidate_trip_facts(row["username"])
+    return path
 
 
 def delete_trip(trip_id: int, username: str):
     with pg_session() as pg:
         _delete_trip_in_sqlite(username, trip_id)
         pg.execute(delete_trip_query(), {"trip_id": trip_id})
+        if PATHS_IN_POSTGIS:
+            delete_paths(pg, [trip_id])
 
-    compare_trip(trip_id)
+    verify_trips(trip_id)
     logger.info(f"Successfully deleted trip {trip_id}")
 
 
@@ -480,6 +588,7 @@ def _delete_trip_in_sqlite(username, tripId):
         cursor.execute(deletePathQuery, {"trip_id": tripId})
     mainConn.commit()
     pathConn.commit()
+    invalidate_trip_facts(username)
 
 
 def update_trip_type(trip_id, new_type: TripTypes):
@@ -492,11 +601,13 @@ def update_trip_type(trip_id, new_type: TripTypes):
 
 def update_trip_type_in_sqlite(trip_id, new_type: TripTypes):
     with managed_cursor(mainConn) as cursor:
-        cursor.execute(
-            "UPDATE trip SET type = :newType WHERE uid = :tripId",
+        row = cursor.execute(
+            "UPDATE trip SET type = :newType WHERE uid = :tripId RETURNING username",
             {"newType": new_type.value, "tripId": trip_id},
-        )
+        ).fetchone()
     mainConn.commit()
+    if row is not None:
+        invalidate_trip_facts(row["username"])
 
 
 def delete_ticket_from_db(username, ticket_id):
@@ -531,10 +642,9 @@ def delete_ticket_from_db(username, ticket_id):
         with pg_session() as pg:
             for trip_id in trip_ids:
                 pg.execute(update_ticket_null_query(), {"trip_id": trip_id})
-        for trip_id in trip_ids:
-            compare_trip(trip_id)
 
         mainConn.commit()
+        verify_trips(*trip_ids)
         return True, None
     except Exception as e:
         mainConn.rollback()
@@ -579,10 +689,9 @@ def attach_ticket_to_trips(username, ticket_id, trip_ids):
                 pg.execute(
                     attach_ticket_query(), {"trip_id": trip_id, "ticket_id": ticket_id}
                 )
-        for trip_id in trip_ids:
-            compare_trip(trip_id)
 
         mainConn.commit()
+        verify_trips(*trip_ids)
         return True, None
     except Exception as e:
         mainConn.rollback()
@@ -639,6 +748,131 @@ def parse_date(date: str):
         raise
 
 
+COMPARED_FIELDS = (
+    "user_id",
+    "origin_station",
+    "destination_station",
+    "start_datetime",
+    "end_datetime",
+    "is_project",
+    "utc_start_datetime",
+    "utc_end_datetime",
+    "estimated_trip_duration",
+    "manual_trip_duration",
+    "trip_length",
+    "operator",
+    "countries",
+    "line_name",
+    "created",
+    "last_modified",
+    "trip_type",
+    "material_type",
+    "seat",
+    "reg",
+    "waypoints",
+    "notes",
+    "price",
+    "currency",
+    "ticket_id",
+    "purchase_date",
+)
+
+
+def _normalize_sqlite_trip(sqlite_trip, user_id):
+    """Convert a sqlite trip row (as a dict) to the pg representation"""
+    sqlite_trip["trip_id"] = sqlite_trip["uid"]
+    sqlite_trip["user_id"] = user_id
+    sqlite_trip["is_project"] = (
+        sqlite_trip["start_datetime"] == 1 or sqlite_trip["end_datetime"] == 1
+    )
+    if sqlite_trip["start_datetime"] in [-1, 1]:
+        sqlite_trip["start_datetime"] = None
+    else:
+        sqlite_trip["start_datetime"] = parse_date(sqlite_trip["start_datetime"])
+    if sqlite_trip["end_datetime"] in [-1, 1]:
+        sqlite_trip["end_datetime"] = None
+    else:
+        sqlite_trip["end_datetime"] = parse_date(sqlite_trip["end_datetime"])
+    if sqlite_trip["utc_start_datetime"] is not None:
+        sqlite_trip["utc_start_datetime"] = parse_date(
+            sqlite_trip["utc_start_datetime"]
+        )
+    if sqlite_trip["utc_end_datetime"] is not None:
+        sqlite_trip["utc_end_datetime"] = parse_date(sqlite_trip["utc_end_datetime"])
+    if sqlite_trip["operator"] == "":
+        sqlite_trip["operator"] = None
+    if sqlite_trip["operator"] is not None:
+        sqlite_trip["operator"] = str(sqlite_trip["operator"])
+    if sqlite_trip["line_name"] == "":
+        sqlite_trip["line_name"] = None
+    if sqlite_trip["created"] is not None:
+        sqlite_trip["created"] = parse_date(sqlite_trip["created"])
+    if sqlite_trip["last_modified"] is not None:
+        sqlite_trip["last_modified"] = parse_date(sqlite_trip["last_modified"])
+    sqlite_trip["trip_type"] = sqlite_trip["type"]
+    if sqlite_trip["material_type"] == "":
+        sqlite_trip["material_type"] = None
+    if sqlite_trip["seat"] == "":
+        sqlite_trip["seat"] = None
+    if sqlite_trip["reg"] == "":
+        sqlite_trip["reg"] = None
+    if sqlite_trip["waypoints"] == "":
+        sqlite_trip["waypoints"] = None
+    if sqlite_trip["notes"] == "":
+        sqlite_trip["notes"] = None
+    if sqlite_trip["price"] == "":
+        sqlite_trip["price"] = None
+    if sqlite_trip["ticket_id"] == "":
+        sqlite_trip["ticket_id"] = None
+    sqlite_trip["purchase_date"] = sqlite_trip["purchasing_date"]
+    if sqlite_trip["purchase_date"] == "":
+        sqlite_trip["purchase_date"] = None
+    if sqlite_trip["purchase_date"] is not None:
+        sqlite_trip["purchase_date"] = parse_date(sqlite_trip["purchase_date"])
+    return sqlite_trip
+
+
+def _compare_trip_rows(trip_id, sqlite_trip, pg_trip, user_id):
+    """Raise if the sqlite row (as a dict) and the pg row of a trip differ"""
+    if sqlite_trip is None and pg_trip is None:
+        return
+    if sqlite_trip is None or pg_trip is None:
+        msg = (
+            f"Trip {trip_id} exists in one db but not the other: "
+            f"{sqlite_trip} (sqlite) vs {pg_trip} (pg)"
+        )
+        logger.error(msg)
+        raise Exception(msg)
+
+    sqlite_trip = _normalize_sqlite_trip(sqlite_trip, user_id)
+    for field in COMPARED_FIELDS:
+        ensure_values_equal(sqlite_trip, pg_trip, field)
+
+
+def _report_drift(subject, description, trace):
+    if has_request_context():
+        url = request.url
+        user = getUser()
+    else:
+        # background verification
+        url = user = None
+    msg = f"""
+            {description}<br>
+            URL : {url} <br>
+            <br>
+            Logged in user : {user}<br>
+            <br>
+            Trace : <br>
+            <br>
+            {trace}
+        """
+    logger.error(msg)
+
+    if url is None or ("127.0.0.1" not in url and "localhost" not in url):
+        msg = ""
+        sendOwnerEmail("Error : " + subject, msg)
+
+
 def compare_trip(trip_id: int):
     """
     Check that the given trip has the same data in sqlite and pg
@@ -656,108 +890,80 @@ def compare_trip(trip_id: int):
                 "SELECT * FROM trips WHERE trip_id = :trip_id", {"trip_id": trip_id}
             ).fetchone()
 
-        if sqlite_trip is None and pg_trip is None:
-            return
-        if sqlite_trip is None or pg_trip is None:
-            msg = (
-                f"Trip {trip_id} exists in one db but not the other: "
-                f"{sqlite_trip} (sqlite) vs {pg_trip} (pg)"
-            )
-            logger.error(msg)
-            raise Exception(msg)
-
-        sqlite_trip["trip_id"] = sqlite_trip["uid"]
-        sqlite_trip["user_id"] = get_user_id(sqlite_trip["username"])
-        sqlite_trip["is_project"] = (
-            sqlite_trip["start_datetime"] == 1 or sqlite_trip["end_datetime"] == 1
+        _compare_trip_rows(
+            trip_id,
+            sqlite_trip,
+            pg_trip,
+            get_user_id(sqlite_trip["username"]) if sqlite_trip else None,
         )
-        if sqlite_trip["start_datetime"] in [-1, 1]:
-            sqlite_trip["start_datetime"] = None
-        else:
-            sqlite_trip["start_datetime"] = parse_date(sqlite_trip["start_datetime"])
-        if sqlite_trip["end_datetime"] in [-1, 1]:
-            sqlite_trip["end_datetime"] = None
-        else:
-            sqlite_trip["end_datetime"] = parse_date(sqlite_trip["end_datetime"])
-        if sqlite_trip["utc_start_datetime"] is not None:
-            sqlite_trip["utc_start_datetime"] = parse_date(
-                sqlite_trip["utc_start_datetime"]
-            )
-        if sqlite_trip["utc_end_datetime"] is not None:
-            sqlite_trip["utc_end_datetime"] = parse_date(
-                sqlite_trip["utc_end_datetime"]
-            )
-        if sqlite_trip["operator"] == "":
-            sqlite_trip["operator"] = None
-        if sqlite_trip["operator"] is not None:
-            sqlite_trip["operator"] = str(sqlite_trip["operator"])
-        if sqlite_trip["line_name"] == "":
-            sqlite_trip["line_name"] = None
-        if sqlite_trip["created"] is not None:
-            sqlite_trip["created"] = parse_date(sqlite_trip["created"])
-        if sqlite_trip["last_modified"] is not None:
-            sqlite_trip["last_modified"] = parse_date(sqlite_trip["last_modified"])
-        sqlite_trip["trip_type"] = sqlite_trip["type"]
-        if sqlite_trip["material_type"] == "":
-            sqlite_trip["material_type"] = None
-        if sqlite_trip["seat"] == "":
-            sqlite_trip["seat"] = None
-        if sqlite_trip["reg"] == "":
-            sqlite_trip["reg"] = None
-        if sqlite_trip["waypoints"] == "":
-            sqlite_trip["waypoints"] = None
-        if sqlite_trip["notes"] == "":
-            sqlite_trip["notes"] = None
-        if sqlite_trip["price"] == "":
-            sqlite_trip["price"] = None
-        if sqlite_trip["ticket_id"] == "":
-            sqlite_trip["ticket_id"] = None
-        sqlite_trip["purchase_date"] = sqlite_trip["purchasing_date"]
-        if sqlite_trip["purchase_date"] == "":
-            sqlite_trip["purchase_date"] = None
-        if sqlite_trip["purchase_date"] is not None:
-            sqlite_trip["purchase_date"] = parse_date(sqlite_trip["purchase_date"])
-        ensure_values_equal(sqlite_trip, pg_trip, "user_id")
-        ensure_values_equal(sqlite_trip, pg_trip, "origin_station")
-        ensure_values_equal(sqlite_trip, pg_trip, "destination_station")
-        ensure_values_equal(sqlite_trip, pg_trip, "start_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "end_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "is_project")
-        ensure_values_equal(sqlite_trip, pg_trip, "utc_start_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "utc_end_datetime")
-        ensure_values_equal(sqlite_trip, pg_trip, "estimated_trip_duration")
-        ensure_values_equal(sqlite_trip, pg_trip, "manual_trip_duration")
-        ensure_values_equal(sqlite_trip, pg_trip, "trip_length")
-        ensure_values_equal(sqlite_trip, pg_trip, "operator")
-        ensure_values_equal(sqlite_trip, pg_trip, "countries")
-        ensure_values_equal(sqlite_trip, pg_trip, "line_name")
-        ensure_values_equal(sqlite_trip, pg_trip, "created")
-        ensure_values_equal(sqlite_trip, pg_trip, "last_modified")
-        ensure_values_equal(sqlite_trip, pg_trip, "trip_type")
-        ensure_values_equal(sqlite_trip, pg_trip, "material_type")
-        ensure_values_equal(sqlite_trip, pg_trip, "seat")
-        ensure_values_equal(sqlite_trip, pg_trip, "reg")
-        ensure_values_equal(sqlite_trip, pg_trip, "waypoints")
-        ensure_values_equal(sqlite_trip, pg_trip, "notes")
-        ensure_values_equal(sqlite_trip, pg_trip, "price")
-        ensure_values_equal(sqlite_trip, pg_trip, "currency")
-        ensure_values_equal(sqlite_trip, pg_trip, "ticket_id")
-        ensure_values_equal(sqlite_trip, pg_trip, "purchase_date")
     except Exception as e:
         logger.exception(e)
         trace = traceback.format_exc().replace("\n", "<br>")
-        msg = f"""
-            Trip {trip_id} has drifted between SQLite and PG!<br>
-            URL : {request.url} <br>
-            <br>
-            Logged in user : {getUser()}<br>
-            <br>
-            Trace : <br>
-            <br>
-            {trace}
-        """
-        logger.error(msg)
+        _report_drift(
+            str(e), f"Trip {trip_id} has drifted between SQLite and PG!", trace
+        )
+
+
+def find_drift(trip_ids, conn=mainConn):
+    """
+    Compare the given trips in sqlite and pg, fetched with one query per
+    database. Return the differences found, as a message by trip id.
+    """
+    trip_ids = list(trip_ids)
+    cursor = conn.execute(
+        "SELECT * FROM trip WHERE uid IN (SELECT value FROM json_each(?))",
+        (json.dumps(trip_ids),),
+    )
+    try:
+        sqlite_trips = {row["uid"]: dict(row) for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+    with pg_session() as pg:
+        pg_trips = {
+            row["trip_id"]: row
+            for row in pg.execute(
+                "SELECT * FROM trips WHERE trip_id = ANY(:trip_ids)",
+                {"trip_ids": trip_ids},
+            ).fetchall()
+        }
+
+    user_ids = {}
+    drift = {}
+    for trip_id in trip_ids:
+        sqlite_trip = sqlite_trips.get(trip_id)
+        if sqlite_trip and sqlite_trip["username"] not in user_ids:
+            user_ids[sqlite_trip["username"]] = get_user_id(sqlite_trip["username"])
+        try:
+            _compare_trip_rows(
+                trip_id,
+                sqlite_trip,
+                pg_trips.get(trip_id),
+                user_ids[sqlite_trip["username"]] if sqlite_trip else None,
+            )
+        except Exception as e:
+            drift[trip_id] = str(e)
+    return drift
 
-        if "127.0.0.1" not in request.url and "localhost" not in request.url:
-            msg = ""
-            sendOwnerEmail("Error : " + str(e), msg)
+
+def compare_trips(trip_ids):
+    """
+    Set-based `compare_trip`: the trips are fetched with one query per database
+    and all the differences are reported at once.
+    """
+    if not trip_ids:
+        return
+    try:
+        drift = find_drift(trip_ids)
+    except Exception as e:
+        logger.exception(e)
+        trace = traceback.format_exc().replace("\n", "<br>")
+        _report_drift(str(e), f"Could not compare {len(trip_ids)} trips", trace)
+        return
+
+    if drift:
+        _report_drift(
+            f"{len(drift)} trips have drifted between SQLite and PG",
+            f"{len(drift)} of {len(trip_ids)} trips have drifted between SQLite and PG!",
+            "<br>".join(drift.values()),
+        )
@@ -0,0 +1,163 @@
+"""
+Read-only records of the users of auth.db, cached by username so that a page
+doesn't look the same user up once per decorator and helper: for the duration
+of a request (in flask.g), and for `user_cache.ttl` seconds in each process.
+
+Users written through the User model are invalidated by its mapper events (see
+app.py). Other processes see the change once their copy expires.
+"""
+
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from flask import g, has_request_context
+
+from py.utils import load_config
+from src.utils import authConn, managed_cursor
+from src.worker_stats import WorkerStats
+
+logger = logging.getLogger(__name__)
+
+user_cache_config = load_config().get("user_cache", {})
+
+# seconds a user is kept by each process
+USER_CACHE_TTL = user_cache_config.get("ttl", 30)
+# users kept by each process, beyond which the expired ones are dropped
+MAX_USERS = 10000
+
+# columns of the user table that are cached, last_login (written on most
+# requests) and the secrets aren't
+USER_FIELDS = (
+    "uid",
+    "username",
+    "lang",
+    "share_level",
+    "leaderboard",
+    "admin",
+    "alpha",
+    "translator",
+    "user_currency",
+    "friend_search",
+    "default_landing",
+    "appear_on_global",
+    "tileserver",
+    "globe",
+    "premium",
+)
+
+
+class UserRecord(namedtuple("UserRecord", USER_FIELDS)):
+    __slots__ = ()
+
+    def is_public(self):
+        return self.share_level >= 2
+
+    def is_public_trips(self):
+        return self.share_level >= 1
+
+
+_users = {}
+_lock = threading.Lock()
+
+
+def _load_user(username):
+    with managed_cursor(authConn) as cursor:
+        cursor.execute(
+            f"SELECT {', '.join(USER_FIELDS)} FROM user WHERE username = ?",
+            (username,),
+        )
+        row = cursor.fetchone()
+    return UserRecord(*row) if row else None
+
+
+def _request_users():
+    """Users already looked up by the current request, None outside of one"""
+    if not has_request_context():
+        return None
+    users = g.get("cached_users")
+    if users is None:
+        users = g.cached_users = {}
+        stats.add(requests=1)
+    return users
+
+
+def _drop_expired(now):
+    for username in [key for key, (expires, _) in _users.items() if expires <= now]:
+        del _users[username]
+
+
+def get_user_record(username):
+    """UserRecord of the user, None if there is no such user"""
+    if not username:
+        return None
+    request_users = _request_users()
+    now = time.monotonic()
+    with _lock:
+        if request_users is not None and username in request_users:
+            stats.add(lookups=1, request_hits=1)
+            return request_users[username]
+        expires, user = _users.get(username, (0, None))
+        hit = expires > now
+        stats.add(lookups=1, **{"worker_hits" if hit else "misses": 1})
+    if not hit:
+        user = _load_user(username)
+        with _lock:
+            if len(_users) >= MAX_USERS:
+                _drop_expired(now)
+            _users[username] = (now + USER_CACHE_TTL, user)
+    if request_users is not None:
+        request_users[username] = user
+    return user
+
+
+def invalidate_user(*usernames):
+    """Forget the cached records of the users, after they were written"""
+    request_users = _request_users()
+    with _lock:
+        for username in usernames:
+            _users.pop(username, None)
+            if request_users is not None:
+                request_users.pop(username, None)
+        stats.add(invalidations=len(usernames))
+
+
+def _cache_gauges():
+    with _lock:
+        return {"cached_users": len(_users)}
+
+
+def _summarize_stats(totals):
+    """Hit rates of the user caches, and user lookups per request"""
+    lookups = totals["lookups"]
+    return {
+        **totals,
+        "hit_rate": (totals["request_hits"] + totals["worker_hits"]) / lookups
+        if lookups
+        else None,
+        # users read from the database per request, 1 at most for a page
+        # about a single user
+        "loads_per_request": totals["misses"] / totals["requests"]
+        if totals["requests"]
+        else None,
+        "lookups_per_request": lookups / totals["requests"]
+        if totals["requests"]
+        else None,
+    }
+
+
+stats = WorkerStats(
+    "user_cache",
+    {
+        "lookups": 0,
+        "request_hits": 0,
+        "worker_hits": 0,
+        "misses": 0,
+        "invalidations": 0,
+        # requests that looked a user up
+        "requests": 0,
+    },
+    gauges=_cache_gauges,
+    summarize=_summarize_stats,
+)
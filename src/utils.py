@@ -1,7 +1,11 @@
 import json
+import os
 import re
 import smtplib
 import sqlite3
+import threading
+import time
+from collections.abc import Mapping
 from contextlib import contextmanager
 from datetime import datetime
 from email.mime.text import MIMEText
@@ -9,10 +13,9 @@ from functools import wraps
 from glob import glob
 
 import pytz
-from flask import abort, request, session
+from flask import abort, has_request_context, request, session
 from timezonefinder import TimezoneFinder
 
-from py.sql import getCurrentTrip
 from py.utils import load_config
 from src.consts import DbNames
 
@@ -28,20 +31,86 @@ authConn.row_factory = sqlite3.Row
 
 owner = load_config()["owner"]["username"]
 
+_timezone_finder = None
+_timezone_finder_pid = None
+_timezone_lock = threading.Lock()
+
 
 def getNameFromPath(path):
     return re.search(r"[A-Za-z0-9_\-\.]+(?=\.[A-Za-z0-9]+$)", path).group(0)
 
 
-def readLang():
-    languages = {}
-    for lang_path in glob("lang/*.json"):
-        with open(lang_path, "r", encoding="utf-8") as lang:
-            languages[getNameFromPath(lang_path)] = json.loads(lang.read())
-    return languages
-
-
-lang = readLang()
+# seconds between two checks of the language files for changes
+LANG_CHECK_INTERVAL = 2
+DEFAULT_LANG = "en"
+
+
+class LanguageRegistry(Mapping):
+    """
+    Translations of each language of lang/, by language code, merged over the
+    English ones so that missing keys fall back to English. They are read once
+    per process, and read again when a file is added, removed or modified
+    (checked at most every LANG_CHECK_INTERVAL seconds on access).
+    """
+
+    def __init__(self, directory="lang"):
+        self.directory = directory
+        # the same in every process for the same files
+        self.version = None
+        self.available_languages = []
+        self._languages = {}
+        self._mtimes = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def _read_mtimes(self):
+        return {
+            lang_path: os.stat(lang_path).st_mtime_ns
+            for lang_path in glob(f"{self.directory}/*.json")
+        }
+
+    def reload(self, force=True):
+        """Read the files again if they changed (or if `force` is set)"""
+        with self._lock:
+            self._checked = time.monotonic()
+            mtimes = self._read_mtimes()
+            if not force and mtimes == self._mtimes:
+                return
+            languages = {}
+            for lang_path in mtimes:
+                with open(lang_path, "r", encoding="utf-8") as lang_file:
+                    languages[getNameFromPath(lang_path)] = json.load(lang_file)
+            english = languages.get(DEFAULT_LANG, {})
+            merged = {
+                code: {**english, **translations}
+                for code, translations in languages.items()
+            }
+            # replaced at once, readers see either the old or the new files
+            self._languages = merged
+            self.available_languages = [
+                {"id": code, "name": merged[code][code]} for code in merged
+            ]
+            self._mtimes = mtimes
+            self.version = f"{len(mtimes)}-{max(mtimes.values(), default=0)}"
+
+    def _check(self):
+        if time.monotonic() - self._checked > LANG_CHECK_INTERVAL:
+            self.reload(force=False)
+
+    def __getitem__(self, code):
+        self._check()
+        return self._languages[code]
+
+    def __iter__(self):
+        self._check()
+        return iter(self._languages)
+
+    def __len__(self):
+        return len(self._languages)
+
+
+lang = LanguageRegistry()
 
 
 @contextmanager
@@ -68,12 +137,10 @@ def getUser():
 
 
 def isCurrentTrip(username):
-    with managed_cursor(mainConn) as cursor:
-        trip = cursor.execute(getCurrentTrip, {"username": username}).fetchone()
-    if trip is not None:
-        return True
-    else:
-        return False
+    # cached until the trips of the user are written, or the trip ends
+    from src.trip_facts import is_current_trip
+
+    return is_current_trip(username)
 
 
 def processDates(newTrip, newPath):
@@ -110,9 +177,21 @@ def processDates(newTrip, newPath):
     )
 
 
+def timezone_at(lat, lng):
+    """
+    Timezone name at the given coordinates. The finder takes about half a second
+    to load, it is created once per process and shared by its threads.
+    """
+    global _timezone_finder, _timezone_finder_pid
+    with _timezone_lock:
+        if _timezone_finder is None or _timezone_finder_pid != os.getpid():
+            _timezone_finder = TimezoneFinder()
+            _timezone_finder_pid = os.getpid()
+        return _timezone_finder.timezone_at(lat=lat, lng=lng)
+
+
 def getUtcDatetime(lat, lng, dateTime):
-    tf = TimezoneFinder()
-    timezone_str = tf.timezone_at(lat=lat, lng=lng)
+    timezone_str = timezone_at(lat=lat, lng=lng)
 
     # Handle override for specific zones
     if timezone_str in ["Asia/Urumqi", "Asia/Kashgar"]:
@@ -128,10 +207,11 @@ def getUtcDatetime(lat, lng, dateTime):
 
 
 def getLocalDatetime(lat, lng, dateTime):
-    # Instantiate TimezoneFinder and find timezone for given lat, lng
-    tf = TimezoneFinder()
-    timezone_str = tf.timezone_at(lat=lat, lng=lng)
+    return localDatetimeIn(timezone_at(lat=lat, lng=lng), dateTime)
+
 
+def localDatetimeIn(timezone_str, dateTime):
+    """Naive local time in the given timezone of an aware datetime"""
     if timezone_str in ["Asia/Urumqi", "Asia/Kashgar"]:
         local_timezone = pytz.FixedOffset(480)  # 480 minutes = 8 hours
     else:
@@ -178,7 +258,9 @@ def sendEmail(address, subject, message):
 
 def sendOwnerEmail(subject, message):
     address = load_config()["owner"]["email"]
-    if "127.0.0.1" in request.url or "localhost" in request.url:
+    if has_request_context() and (
+        "127.0.0.1" in request.url or "localhost" in request.url
+    ):
         print(f"Email to: {address}\nSubject: {subject}\nMessage: {message}")
     else:
         sendEmail(address, subject, message)
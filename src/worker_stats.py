@@ -0,0 +1,229 @@
+"""
+Counters of the worker processes of the app, gathered across them for the
+/admin/*_stats endpoints.
+
+Each process counts in memory, in the WorkerStats of a module, and a
+background thread of the process writes all its counters to a SQLite file
+every `worker_stats.interval` seconds. Gathering the stats of a module adds up
+the counters written by the processes still running: counters are summed,
+except the `max_*` and `peak_*` ones (the highest is kept) and the `last_*`
+ones (the most recent is kept). The counters of the processes that exited are
+dropped after a few intervals.
+"""
+
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from py.utils import load_config
+from src.consts import DbNames
+
+logger = logging.getLogger(__name__)
+
+worker_stats_config = load_config().get("worker_stats", {})
+
+# seconds between two writes of the counters of a process
+INTERVAL = worker_stats_config.get("interval", 10)
+# seconds without a write after which a process is considered gone
+EXPIRY = 3 * INTERVAL
+
+# {name: WorkerStats}
+_sources = {}
+_lock = threading.Lock()
+
+_conn = None
+_conn_pid = None
+
+_publisher = None
+_publisher_pid = None
+
+
+class WorkerStats:
+    """
+    Counters of a module in the current process, nested in groups when needed.
+
+    `counters` holds their initial values, `gauges` returns values read from
+    the state of the process when the counters are written (queue depths,
+    cached entries...), and `summarize` turns the counters added up across
+    processes into the reported stats.
+    """
+
+    def __init__(self, name, counters=None, gauges=None, summarize=None):
+        self.name = name
+        self.counters = counters or {}
+        self.gauges = gauges
+        self.summarize = summarize
+        self.lock = threading.Lock()
+        with _lock:
+            _sources[name] = self
+
+    def _group(self, path):
+        group = self.counters
+        for key in path:
+            group = group.setdefault(key, {})
+        return group
+
+    def add(self, *path, **counts):
+        """Add to the counters of the group `path`"""
+        _ensure_publisher()
+        with self.lock:
+            group = self._group(path)
+            for key, count in counts.items():
+                group[key] = group.get(key, 0) + count
+
+    def maximum(self, *path, **values):
+        """Raise the counters of the group `path` to the values, if higher"""
+        _ensure_publisher()
+        with self.lock:
+            group = self._group(path)
+            for key, value in values.items():
+                group[key] = max(group.get(key, value), value)
+
+    def set(self, *path, **values):
+        """Set the counters of the group `path`"""
+        _ensure_publisher()
+        with self.lock:
+            self._group(path).update(values)
+
+    def snapshot(self):
+        """Counters and gauges of the current process"""
+        with self.lock:
+            stats = copy.deepcopy(self.counters)
+        # outside of self.lock, gauges take the locks of their module
+        if self.gauges:
+            stats.update(self.gauges())
+        return stats
+
+    def gather(self):
+        """
+        Stats added up across the running processes, the current one included
+        with its counters of now
+        """
+        try:
+            _publish([self])
+            with _lock:
+                conn = _connection()
+                conn.execute(
+                    "DELETE FROM worker_stats WHERE updated < ?",
+                    (time.time() - EXPIRY,),
+                )
+                rows = conn.execute(
+                    """
+                    SELECT pid, stats FROM worker_stats
+                    WHERE name = ?
+                    ORDER BY updated
+                    """,
+                    (self.name,),
+                ).fetchall()
+                conn.commit()
+        except Exception as e:
+            logger.warning(f"Worker stats read failed: {e}")
+            rows = [(os.getpid(), json.dumps(self.snapshot()))]
+
+        totals = {}
+        for _, stats in rows:
+            _merge(totals, json.loads(stats))
+        return {
+            "pids": sorted(pid for pid, _ in rows),
+            **(self.summarize(totals) if self.summarize else totals),
+        }
+
+
+def gather(name):
+    """Stats of the WorkerStats `name`, added up across the running processes"""
+    return _sources[name].gather()
+
+
+def _merge(totals, stats):
+    for key, value in stats.items():
+        current = totals.get(key)
+        if isinstance(value, dict):
+            _merge(totals.setdefault(key, {}), value)
+        elif current is None or value is None:
+            totals[key] = current if value is None else value
+        elif key.startswith(("max_", "peak_")):
+            totals[key] = max(current, value)
+        elif key.startswith("last_"):
+            totals[key] = value
+        else:
+            totals[key] = current + value
+
+
+def _connection():
+    """Connection of the current process (under _lock)"""
+    global _conn, _conn_pid
+    # connections must not survive a fork, open one per process
+    if _conn is None or _conn_pid != os.getpid():
+        _conn = sqlite3.connect(
+            DbNames.WORKER_STATS_DB.value, timeout=5, check_same_thread=False
+        )
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS worker_stats (
+                name TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                updated REAL NOT NULL,
+                stats TEXT NOT NULL,
+                PRIMARY KEY (name, pid)
+            )
+            """
+        )
+        _conn.commit()
+        _conn_pid = os.getpid()
+    return _conn
+
+
+def _publish(sources):
+    """Write the counters of the current process"""
+    now = time.time()
+    rows = [
+        (source.name, os.getpid(), now, json.dumps(source.snapshot()))
+        for source in sources
+    ]
+    with _lock:
+        conn = _connection()
+        conn.executemany(
+            """
+            INSERT INTO worker_stats (name, pid, updated, stats)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (name, pid) DO UPDATE SET
+                updated = excluded.updated,
+                stats = excluded.stats
+            """,
+            rows,
+        )
+        conn.commit()
+
+
+def _ensure_publisher():
+    if _publisher_pid != os.getpid():
+        with _lock:
+            _start_publisher()
+
+
+def _start_publisher():
+    """Start the publisher thread of this process, if needed (under _lock)"""
+    global _publisher, _publisher_pid
+    if _publisher is None or _publisher_pid != os.getpid():
+        _publisher = threading.Thread(
+            target=_run_publisher, name="worker-stats", daemon=True
+        )
+        _publisher_pid = os.getpid()
+        _publisher.start()
+
+
+def _run_publisher():
+    while True:
+        time.sleep(INTERVAL)
+        try:
+            with _lock:
+                sources = list(_sources.values())
+            _publish(sources)
+        except Exception as e:
+            logger.warning(f"Worker stats write failed: {e}")
@@ -980,3 +980,31 @@ function renderOperators(data, type, row) {
     // Fallback to operator name
     return row.operator;
 }
+
+// Follow a background job started by a request answering 202 with its status_url.
+// Resolves with a Response holding the job's result (or its file), or an error
+// Response if the job failed.
+async function waitForJob(response, interval = 2000, onProgress = null) {
+  if (response.status !== 202) return response;
+  const { status_url } = await response.json();
+  while (true) {
+    await new Promise(resolve => setTimeout(resolve, interval));
+    const jobResponse = await fetch(status_url);
+    if (!jobResponse.ok) return jobResponse;
+    const job = await jobResponse.json();
+    if (onProgress && job.progress != null) onProgress(job.progress);
+    if (job.status === "done") {
+      if (job.download_url) return fetch(job.download_url);
+      return new Response(JSON.stringify(job.result), {
+        status: 200,
+        headers: { "Content-Type": "application/json" },
+      });
+    }
+    if (job.status === "failed") {
+      return new Response(JSON.stringify({ error: job.error }), {
+        status: 500,
+        headers: { "Content-Type": "application/json" },
+      });
+    }
+  }
+}
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import py
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+# pytest imports its own `py` module (a shim of the py library) before the
+# tests, which hides the py/ package of the repo: make it the package of the
+# repo's modules
+if not hasattr(py, "__path__"):
+    py.__path__ = [os.path.join(ROOT, "py")]
+# config.yaml and the databases are read relative to the working directory
+os.chdir(ROOT)
@@ -0,0 +1,41 @@
+import numpy as np
+
+from py.gps_preprocessing import simplify_track
+
+
+def _track_with_stop(pause):
+    """
+    Moving north for 50 points, stationary for 40 points with a `pause` seconds
+    logging pause in the middle, then moving north again for 49 points
+    """
+    lat = (
+        [46 + i * 0.0003 for i in range(50)]
+        + [46.015] * 40
+        + [46.015 + i * 0.0003 for i in range(1, 50)]
+    )
+    seconds = (
+        list(range(0, 500, 10))
+        + [500 + 15 * i for i in range(20)]
+        + [785 + pause + 15 * i for i in range(20)]
+        + [1085 + pause + 10 * i for i in range(1, 50)]
+    )
+    return [[point, 6.0] for point in lat], np.array(seconds, dtype=float)
+
+
+def test_stop_without_gap():
+    latlngs, seconds = _track_with_stop(pause=0)
+    indices, stats = simplify_track(latlngs, seconds)
+    assert stats["stops"] == 1
+    # first and last points of the stop are kept, not the ones inside
+    assert 50 in indices and 89 in indices
+    assert not any(50 < index < 89 for index in indices)
+
+
+def test_gap_inside_stop():
+    latlngs, seconds = _track_with_stop(pause=600)
+    indices, stats = simplify_track(latlngs, seconds, max_time_gap=300)
+    # the stop is cut in two at the gap, whose points are both kept
+    assert stats["stops"] == 2
+    assert 69 in indices and 70 in indices
+    assert indices == sorted(indices)
+    assert stats["output"] == len(indices)
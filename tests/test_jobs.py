@@ -0,0 +1,33 @@
+import pytest
+
+from src import jobs
+from src.jobs import JobQueueFull, JobStatus
+
+
+@pytest.fixture
+def jobs_db(tmp_path, monkeypatch):
+    (tmp_path / "databases").mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(jobs, "_conn", None)
+    monkeypatch.setitem(jobs._handlers, "test", (None, 1))
+    monkeypatch.setattr(jobs, "ANONYMOUS_LIMIT", 2)
+    yield
+    monkeypatch.setattr(jobs, "_conn", None)
+
+
+def test_enqueue_reuses_pending_job(jobs_db):
+    job_id = jobs.enqueue_job("alice", "test", {"a": 1, "b": 2})
+    assert jobs.enqueue_job("alice", "test", {"b": 2, "a": 1}) == job_id
+    assert jobs.enqueue_job("bob", "test", {"a": 1, "b": 2}) != job_id
+    jobs._update_job(job_id, status=JobStatus.DONE, result='{"file": "x"}')
+    assert jobs.enqueue_job("alice", "test", {"a": 1, "b": 2}) != job_id
+    assert jobs.last_done_job("test", {"b": 2, "a": 1})["uid"] == job_id
+
+
+def test_anonymous_limit(jobs_db):
+    jobs.enqueue_job(jobs.ANONYMOUS_OWNER + "1", "test", {"n": 1})
+    jobs.enqueue_job(jobs.ANONYMOUS_OWNER + "2", "test", {"n": 2})
+    with pytest.raises(JobQueueFull):
+        jobs.enqueue_job(jobs.ANONYMOUS_OWNER + "3", "test", {"n": 3})
+    # logged in users aren't limited
+    jobs.enqueue_job("alice", "test", {"n": 4})
@@ -0,0 +1,49 @@
+import sqlite3
+
+from src.routing import RouteCache, RouteResponse
+
+
+def _size(filename):
+    with sqlite3.connect(filename) as conn:
+        total = conn.execute("SELECT total FROM routes_size").fetchone()[0]
+        summed = conn.execute("SELECT COALESCE(SUM(size), 0) FROM routes").fetchone()
+    return total, summed[0]
+
+
+def test_size_is_tracked(tmp_path):
+    filename = str(tmp_path / "routes.db")
+    cache = RouteCache(filename, max_bytes=2000)
+    for i in range(50):
+        cache.set(f"key{i % 30}", "backend", RouteResponse(200, str(i) * (10 + i)))
+    total, summed = _size(filename)
+    assert total == summed
+    assert 0 < total <= 2000
+    assert cache.info()["size"] == total
+
+
+def test_size_of_an_existing_cache(tmp_path):
+    filename = str(tmp_path / "routes.db")
+    cache = RouteCache(filename, max_bytes=10**6)
+    cache.set("key", "backend", RouteResponse(200, "route"))
+    with sqlite3.connect(filename) as conn:
+        conn.execute("DROP TABLE routes_size")
+    cache = RouteCache(filename, max_bytes=10**6)
+    cache.set("other", "backend", RouteResponse(200, "other route"))
+    total, summed = _size(filename)
+    assert total == summed > 0
+
+
+def test_hits_only_touch_old_routes(tmp_path):
+    filename = str(tmp_path / "routes.db")
+    cache = RouteCache(filename, max_bytes=10**6, touch_interval=60)
+    cache.set("key", "backend", RouteResponse(200, "route"))
+    with sqlite3.connect(filename) as conn:
+        conn.execute("UPDATE routes SET last_access = last_access - 30")
+    before = cache._connection().total_changes
+    assert cache.get("key").text == "route"
+    assert cache._connection().total_changes == before
+
+    with sqlite3.connect(filename) as conn:
+        conn.execute("UPDATE routes SET last_access = last_access - 60")
+    assert cache.get("key").text == "route"
+    assert cache._connection().total_changes == before + 1
@@ -0,0 +1,57 @@
+import multiprocessing
+
+from src import worker_stats
+from src.worker_stats import WorkerStats
+
+
+def test_merge():
+    totals = {}
+    worker_stats._merge(
+        totals, {"hits": 1, "max_wait": 2.0, "last_ms": 5, "backends": {"a": {"n": 1}}}
+    )
+    worker_stats._merge(
+        totals, {"hits": 2, "max_wait": 1.0, "last_ms": 3, "backends": {"b": {"n": 4}}}
+    )
+    worker_stats._merge(totals, {"hits": 0, "max_wait": 0.5, "last_ms": None})
+    assert totals == {
+        "hits": 3,
+        "max_wait": 2.0,
+        "last_ms": 3,
+        "backends": {"a": {"n": 1}, "b": {"n": 4}},
+    }
+
+
+def _count_in_child(stats):
+    stats.add(hits=2)
+    stats.maximum(max_wait=5.0)
+    stats.add("backends", "osrm", requests=1)
+    worker_stats._publish([stats])
+
+
+def test_gather_across_processes(tmp_path, monkeypatch):
+    (tmp_path / "databases").mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(worker_stats, "_conn", None)
+    stats = WorkerStats(
+        "test",
+        {"hits": 0, "max_wait": 0.0},
+        gauges=lambda: {"pending": 1},
+        summarize=lambda totals: {**totals, "summarized": True},
+    )
+    child = multiprocessing.get_context("fork").Process(
+        target=_count_in_child, args=(stats,)
+    )
+    child.start()
+    child.join()
+    assert child.exitcode == 0
+
+    stats.add(hits=1)
+    stats.maximum(max_wait=1.0)
+    gathered = stats.gather()
+    assert len(gathered["pids"]) == 2
+    assert gathered["hits"] == 3
+    assert gathered["max_wait"] == 5.0
+    assert gathered["pending"] == 2
+    assert gathered["backends"] == {"osrm": {"requests": 1}}
+    assert gathered["summarized"]
+    assert worker_stats.gather("test") == gathered
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+"""
+Run the background job workers (see src/jobs.py) next to the web app:
+
+    python worker.py [number of workers]
+"""
+
+import logging.config
+import sys
+
+logging.config.fileConfig("logging.conf", disable_existing_loggers=False)
+
+from src.jobs import WORKERS, run_workers  # noqa: E402
+
+if __name__ == "__main__":
+    run_workers("app", int(sys.argv[1]) if len(sys.argv) > 1 else WORKERS)